@@ -1,12 +1,6 @@
-from mapGenerator import MapCreator
-
-class SystemTestGenerator:
-    def system_test(self, lat, long, name, radius, water_buffer_size, road_buffer_size, cameras, passage_points):
-        """Returns the name of the map, the completeness of the map should be inspected visually"""
-        map_creator = MapCreator(lat, long, name, radius, water_buffer_size, road_buffer_size, cameras, passage_points)
-        return map_creator.create_detailed_map()
-
-systemTestGenerator = SystemTestGenerator()
+import json
+from batchGenerator import BatchGenerator
+from multiSite import MultiSiteMapCreator
 
 cameras = [
         {
@@ -91,77 +85,45 @@ passage_points = [
     (51.115297, 5.829746)
 ]
 
-#Test 1, Rotterdam
-try:
-    name1 = systemTestGenerator.system_test(51.9225,4.47917,"Rotterdam", 1000, 100, 20, cameras, passage_points)
-    print("Test 1 succeeded")
-except Exception as e:
-    print("Test 1 failed: ", e)
-
-# Test 2, Utrecht
-try:
-    name2 = systemTestGenerator.system_test(52.090737,5.121420,"Utrecht", 1000, 100, 20, cameras, passage_points)
-    print("Test 2 succeeded")
-except Exception as e:
-    print("Test 2 failed: ", e)
-
-# Test 3, Amsterdam
-try:
-    name3 = systemTestGenerator.system_test(52.3676,4.9041,"Amsterdam", 1000, 100, 20, cameras, passage_points)
-    print("Test 3 succeeded")
-except Exception as e:
-    print("Test 2 failed: ", e)
-
-# Test 4, Maastricht
-try:
-    name4 = systemTestGenerator.system_test(50.851368,5.690972,"Maastricht", 1000, 100, 20, cameras, passage_points)
-    print("Test 4 succeeded")
-except Exception as e:
-    print("Test 2 failed: ", e)
-
-# Test 5, Boschmolenplas
-try:
-    name5 = systemTestGenerator.system_test(51.1797305,5.8812762,"Boschmolenplas", 1000, 100, 20, cameras, passage_points)
-    print("Test 5 succeeded")
-except Exception as e:
-    print("Test 2 failed: ", e)
-
-# Test 6, Maasterp_ohe_en_laak
-try:
-    name6 = systemTestGenerator.system_test(51.114697,5.8301484,"Maasterp_ohe_en_laak", 1000, 100, 20, cameras, passage_points)
-    print("Test 6 succeeded")
-except Exception as e:
-    print("Test 2 failed: ", e)
-
-# Test 7, Eindhoven
-try:
-    name7 = systemTestGenerator.system_test(51.4416,5.4697,"Eindhoven", 1000, 100, 20, cameras, passage_points)
-    print("Test 7 succeeded")
-except Exception as e:
-    print("Test 7 failed: ", e)
-
-# Test 8, Breda
-try:
-    name8 = systemTestGenerator.system_test(51.5864,4.7759,"Breda", 1000, 100, 20, cameras, passage_points)
-    print("Test 8 succeeded")
-except Exception as e:
-    print("Test 8 failed: ", e)
-
-# Test 9, Tilburg
-try:
-    name9 = systemTestGenerator.system_test(51.5590,5.0913,"Tilburg", 1000, 100, 20, cameras, passage_points)
-    print("Test 9 succeeded")
-except Exception as e:
-    print("Test 9 failed: ", e)
-
-# Test 10, Den Bosch
-try:
-    name10 = systemTestGenerator.system_test(51.6978,5.3037,"Den Bosch", 1000, 100, 20, cameras, passage_points)
-    print("Test 10 succeeded")
-except Exception as e:
-    print("Test 10 failed: ", e)
-
-print("system tests completed successfully")
-print("The names of the maps are: ", name1, name2, name3, name4, name5, name6, name7, name8, name9, name10)
-
+# Sites to test, every site gets the same cameras and passage points
+system_test_sites = [
+    (51.9225, 4.47917, "Rotterdam"),
+    (52.090737, 5.121420, "Utrecht"),
+    (52.3676, 4.9041, "Amsterdam"),
+    (50.851368, 5.690972, "Maastricht"),
+    (51.1797305, 5.8812762, "Boschmolenplas"),
+    (51.114697, 5.8301484, "Maasterp_ohe_en_laak"),
+    (51.4416, 5.4697, "Eindhoven"),
+    (51.5864, 4.7759, "Breda"),
+    (51.5590, 5.0913, "Tilburg"),
+    (51.6978, 5.3037, "Den Bosch")
+]
 
+if __name__ == '__main__':
+    # all tests run in parallel, the summary tells which succeeded, how long they took and how large the output is
+    sites = [{'latitude': lat, 'longitude': long, 'name': name, 'radius': 1000, 'water_buffer_size': 100, 'road_buffer_size': 20,
+              'cameras': cameras, 'passage_points': passage_points} for lat, long, name in system_test_sites]
+    summary = BatchGenerator(sites).run()
+
+    for number, result in enumerate(summary['sites'], start=1):
+        if result['status'] == 'succeeded':
+            print(f"Test {number} succeeded")
+        else:
+            print(f"Test {number} failed: ", result['error'])
+
+    # the cameras and passage points belong to Boschmolenplas and Maasterp Ohé en Laak, both sites are also tested in one map
+    # where every camera and passage point has to end up at its own site
+    twin_sites = [site for site in sites if site['name'] in ('Boschmolenplas', 'Maasterp_ohe_en_laak')]
+    try:
+        multiSiteMapCreator = MultiSiteMapCreator(twin_sites, 'Boschmolenplas_Maasterp', cameras, passage_points)
+        summary['multi_site'] = {'status': 'succeeded', 'map': multiSiteMapCreator.create_map(), 'assignments': multiSiteMapCreator.assignments}
+        print("Multi-site test succeeded")
+    except Exception as e:
+        summary['multi_site'] = {'status': 'failed', 'error': f"{type(e).__name__}: {e}"}
+        print("Multi-site test failed: ", summary['multi_site']['error'])
+
+    with open('system_test_summary.json', 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=4)
+
+    print(f"system tests completed, {summary['succeeded']} succeeded and {summary['failed']} failed")
+    print("The names of the maps are: ", *[result['map'] for result in summary['sites']])
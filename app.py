@@ -1,7 +1,58 @@
-from flask import Flask, render_template, request
-from mapGenerator import MapCreator
+import os
+import time
+from flask import Flask, Response, abort, jsonify, redirect, render_template, request, send_file, url_for
+from werkzeug.exceptions import BadRequestKeyError
+from costEstimator import CostEstimator, OverBudgetError
+from instrumentation import METRICS, process_uptime_seconds
+from resultCache import ResultCache
+from tileProxy import tile_blueprint
+
+# mapGenerator is imported on first use and not here, it pulls in osmnx, geopandas, folium and scipy which takes about a second,
+# so the app (and every new worker) can serve its first page right away. Set APP_PRELOAD=1 to import and warm it up when the app is imported instead
+IMPORT_STARTED = time.perf_counter()
 
 app = Flask(__name__)
+app.register_blueprint(tile_blueprint)
+first_response_served = False
+
+# maps that were made before are served from here, the least recently used ones are removed when there are more than RESULT_CACHE_MAX_MAPS
+RESULTS = ResultCache(max_maps=int(os.environ.get('RESULT_CACHE_MAX_MAPS', 100)))
+
+# every new map is estimated before it is made, maps over MAP_BUDGET_SECONDS or MAP_BUDGET_MB are made lighter or rejected
+ESTIMATOR = CostEstimator(max_seconds=float(os.environ.get('MAP_BUDGET_SECONDS', 600)), max_bytes=float(os.environ.get('MAP_BUDGET_MB', 200)) * 1e6)
+
+# the generated maps load their basemaps through the tile proxy of the app (/tiles), set TILE_PROXY_URL to another proxy or to nothing for the public servers
+TILE_PROXY_URL = os.environ.get('TILE_PROXY_URL', '/tiles') or None
+
+# the layers of the generated sites in memory for the query api, made on the first query (spatialStore imports geopandas)
+spatial_store = None
+
+# query string parameters of the query api that are not attribute filters
+QUERY_PARAMETERS = {'bbox', 'limit', 'lat', 'lon', 'count', 'max_distance', 'of', 'distance'}
+
+def warm_up():
+    """
+    Imports mapGenerator and loads its caches now instead of in the first request (see mapGenerator.warm_up).
+    In the parent process of a server that forks its workers (like gunicorn --preload) every worker then starts warm
+    """
+    start = time.perf_counter()
+    import mapGenerator
+    timings = mapGenerator.warm_up()
+    seconds = time.perf_counter() - start
+    METRICS.set('app_warm_up_seconds', {}, round(seconds, 4))
+    print(f"Warmed up in {seconds:.2f} seconds ({', '.join(f'{name} {step:.2f}s' for name, step in timings.items())}, the rest is importing)")
+
+@app.after_request
+def measure_first_response(response):
+    # cold start to the first served page, from the start of the process when the platform tells it, otherwise from importing the app
+    global first_response_served
+    if not first_response_served:
+        first_response_served = True
+        uptime = process_uptime_seconds()
+        seconds = uptime if uptime is not None else time.perf_counter() - IMPORT_STARTED
+        METRICS.set('app_first_response_seconds', {}, round(seconds, 4))
+        print(f"First response served {seconds:.2f} seconds after starting")
+    return response
 
 @app.route('/')
 def index():
@@ -61,14 +112,137 @@ def generate_map():
         (51.180796, 5.883265)
     ]
 
-    latitude = float(request.form['latitude'])
-    longitude = float(request.form['longitude'])
-    name = request.form['name']
-    area = int(request.form['area'])
-    map_creator = MapCreator(latitude, longitude, name, area, 150, 20, cameras=cameras, passage_points=passage_points)
-    map_name = map_creator.create_detailed_map()
-    print(map_name)
-    return render_template('template_map.html', map_name=map_name)
+    parameters = {
+        'latitude': float(request.form['latitude']),
+        'longitude': float(request.form['longitude']),
+        'name': request.form['name'],
+        'load_dist': int(request.form['area']),
+        'water_buffer_size': 150,
+        'road_buffer_size': 20,
+        'cameras': cameras,
+        'passage_points': passage_points,
+        'tile_url': TILE_PROXY_URL
+    }
+    key = RESULTS.make_key(parameters)
+    entry = RESULTS.lookup(key)
+    METRICS.increment('mapgen_result_cache_requests_total', {'result': 'hit' if entry is not None else 'miss'})
+    if entry is None:
+        # the key stays the one of the request, a map that was made lighter is served again for the same request
+        try:
+            plan = ESTIMATOR.plan(parameters['latitude'], parameters['longitude'], parameters['load_dist'])
+        except OverBudgetError as e:
+            METRICS.increment('mapgen_budget_requests_total', {'result': 'rejected'})
+            return render_template('index.html', error=str(e)), 422
+        METRICS.increment('mapgen_budget_requests_total', {'result': 'degraded' if plan['degradations'] else 'accepted'})
+        from mapGenerator import MapCreator
+        # the result cache removes the files of the maps it evicts, the maps it still serves are not pruned by age
+        map_creator = MapCreator(**parameters, **plan['options'], versions_kept=0)
+        map_name = map_creator.create_detailed_map()
+        RESULTS.store(key, map_name, map_creator.job_files(), {**parameters, **plan['options'], 'degradations': plan['degradations']})
+    # the map is shown on its own page, so reloading it or going back does not post the form again and a GET there can be answered with 304 Not Modified
+    return redirect(url_for('result_page', key=key), code=303)
+
+@app.route('/maps/<key>')
+def result_page(key):
+    # the page with a generated map, the same map gives the same page until the map is made again
+    entry = RESULTS.lookup(key)
+    if entry is None:
+        abort(404)
+    degradations = (entry.get('parameters') or {}).get('degradations', [])
+    response = app.make_response(render_template('template_map.html', map_name=entry['map_name'], map_url=url_for('result_map', key=key), degradations=degradations))
+    response.set_etag(f"{key}-{int(entry['created'])}")
+    response.last_modified = entry['created']
+    return response.make_conditional(request)
+
+@app.route('/maps/<key>/map')
+def result_map(key):
+    # the map of a result, with ETag and Last-Modified so the browser only downloads it again when the map was made again
+    entry = RESULTS.lookup(key)
+    if entry is None:
+        abort(404)
+    return send_file(os.path.abspath(os.path.join('static', entry['map_name'])), mimetype='text/html', conditional=True,
+                     etag=f"{key}-{int(entry['created'])}", last_modified=entry['created'], max_age=0)
+
+@app.route('/estimate')
+def estimate():
+    # what a map of ?latitude=..&longitude=..&area=.. would cost and how it would be made lighter, before asking for it
+    try:
+        latitude, longitude, load_dist = float(request.args['latitude']), float(request.args['longitude']), int(request.args['area'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'latitude, longitude and area are needed as numbers'}), 400
+    try:
+        plan = ESTIMATOR.plan(latitude, longitude, load_dist)
+    except OverBudgetError as e:
+        return jsonify({'error': str(e), 'estimate': e.estimate, 'budget': ESTIMATOR.budget_text()}), 422
+    return jsonify({**plan, 'budget': ESTIMATOR.budget_text()})
+
+def get_spatial_store():
+    global spatial_store
+    if spatial_store is None:
+        from spatialStore import SpatialStore
+        spatial_store = SpatialStore(max_sites=int(os.environ.get('SPATIAL_STORE_MAX_SITES', 8)))
+    return spatial_store
+
+def query_answer(query):
+    # runs a query of the api, a missing site or layer is a 404 and a bad parameter a 400, the time the query took is added to the answer
+    start = time.perf_counter()
+    try:
+        answer = query()
+    except BadRequestKeyError as e:
+        return jsonify({'error': f"Missing parameter: {e.args[0]}"}), 400
+    except KeyError as e:
+        return jsonify({'error': e.args[0]}), 404
+    except ValueError as e:
+        return jsonify({'error': f"Bad parameter: {e}"}), 400
+    answer['query_ms'] = round((time.perf_counter() - start) * 1000, 2)
+    return jsonify(answer)
+
+def attribute_filters():
+    return {key: value for key, value in request.args.items() if key not in QUERY_PARAMETERS}
+
+@app.route('/api/sites')
+def api_sites():
+    return jsonify({'sites': get_spatial_store().site_names()})
+
+@app.route('/api/sites/<site>')
+def api_site(site):
+    return query_answer(lambda: get_spatial_store().site(site).summary())
+
+@app.route('/api/sites/<site>/<layer>')
+def api_features(site, layer):
+    # features of a layer, optionally within ?bbox=min_lon,min_lat,max_lon,max_lat and with attribute filters like ?building=house or ?levels__gte=3
+    def query():
+        bbox = request.args.get('bbox')
+        bbox = tuple(float(value) for value in bbox.split(',')) if bbox else None
+        if bbox is not None and len(bbox) != 4:
+            raise ValueError("bbox needs min_lon,min_lat,max_lon,max_lat")
+        return get_spatial_store().site(site).query(layer, bbox, attribute_filters(), int(request.args.get('limit', 1000)))
+    return query_answer(query)
+
+@app.route('/api/sites/<site>/<layer>/nearest')
+def api_nearest(site, layer):
+    # the features closest to ?lat=..&lon=.., with their distance in meters
+    def query():
+        max_distance = request.args.get('max_distance')
+        return get_spatial_store().site(site).nearest(layer, float(request.args['lat']), float(request.args['lon']),
+                                                      float(max_distance) if max_distance else None, attribute_filters(), int(request.args.get('count', 1)))
+    return query_answer(query)
+
+@app.route('/api/sites/<site>/<layer>/within')
+def api_within(site, layer):
+    # the features within ?distance=.. meters of a feature of the layer ?of=.., like the buildings within 50 m of water
+    def query():
+        return get_spatial_store().site(site).within_distance(layer, request.args.get('of', 'waterways'), float(request.args['distance']),
+                                                             attribute_filters(), int(request.args.get('limit', 1000)))
+    return query_answer(query)
+
+@app.route('/metrics')
+def metrics():
+    # the stage timings, memory, sizes and retries of all maps generated by this process, in the Prometheus text format
+    return Response(METRICS.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+if os.environ.get('APP_PRELOAD') == '1':
+    warm_up()
 
 if __name__ == '__main__':
     app.run(debug=False)
\ No newline at end of file
@@ -0,0 +1,127 @@
+import argparse
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import osmnx as ox
+
+from mapGenerator import MapCreator
+
+# keys of a site spec that are passed on to the MapCreator when they are given
+OPTIONAL_SITE_KEYS = ['water_buffer_size', 'road_buffer_size', 'cameras', 'passage_points', 'tile_size']
+
+def configure_shared_caches(osm_cache_dir, srtm_cache_dir):
+    """
+    Points osmnx and srtm at cache directories that are shared by all worker processes,
+    so a site that overlaps with another one (or ran before) does not download the same data again
+
+    Parameters:
+    osm_cache_dir: str, directory for the cached Overpass responses
+    srtm_cache_dir: str, directory for the hgt files
+    """
+    ox.settings.use_cache = True
+    ox.settings.cache_folder = osm_cache_dir
+    os.environ['SRTM_CACHE_DIR'] = srtm_cache_dir
+    os.makedirs(osm_cache_dir, exist_ok=True)
+    os.makedirs(srtm_cache_dir, exist_ok=True)
+
+def generate_site(site, osm_cache_dir, srtm_cache_dir):
+    """
+    Generates the map of one site, this runs in a worker process. Failures are returned in the result instead of raised,
+    so one broken site does not stop the batch
+
+    Parameters:
+    site: dict, site spec with latitude, longitude, name, radius and optionally the keys in OPTIONAL_SITE_KEYS
+    osm_cache_dir: str, shared directory for the cached Overpass responses
+    srtm_cache_dir: str, shared directory for the hgt files
+    """
+    configure_shared_caches(osm_cache_dir, srtm_cache_dir)
+    result = {'name': site.get('name'), 'status': 'failed', 'map': None, 'duration_seconds': None, 'output_bytes': 0, 'error': None}
+    start = time.perf_counter()
+    map_creator = None
+    try:
+        options = {key: site[key] for key in OPTIONAL_SITE_KEYS if key in site}
+        if 'passage_points' in options:
+            options['passage_points'] = [tuple(point) for point in options['passage_points']]
+        map_creator = MapCreator(site['latitude'], site['longitude'], site['name'], site['radius'], **options)
+        result['map'] = map_creator.create_detailed_map()
+        result['output_bytes'] = sum(os.path.getsize(path) for path in map_creator.output_files())
+        result['status'] = 'succeeded'
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+        result['traceback'] = traceback.format_exc()
+    result['duration_seconds'] = round(time.perf_counter() - start, 3)
+    if map_creator is not None:
+        result['metrics'] = map_creator.metrics # the measurements of every stage
+    return result
+
+class BatchGenerator:
+    """
+    Generates the maps of several sites in parallel over a pool of processes
+
+    Parameters:
+    sites: list, site specs, every spec is a dict with latitude, longitude, name, radius and optionally
+           water_buffer_size, road_buffer_size, cameras, passage_points and tile_size
+    max_workers: int, number of processes, None uses the number of cores
+    osm_cache_dir: str, directory for the Overpass responses, shared by all sites
+    srtm_cache_dir: str, directory for the SRTM files, shared by all sites
+    """
+    def __init__(self, sites, max_workers=None, osm_cache_dir='cache/osm', srtm_cache_dir='cache/srtm'):
+        self.sites = sites
+        self.max_workers = max_workers
+        self.osm_cache_dir = osm_cache_dir
+        self.srtm_cache_dir = srtm_cache_dir
+
+        names = [site['name'] for site in self.sites]
+        duplicates = sorted(set(name for name in names if names.count(name) > 1))
+        if duplicates:
+            raise ValueError(f"Site names must be unique within a batch, duplicates: {duplicates}")
+
+    @staticmethod
+    def load_sites(sites_file):
+        """Reads the site specs from a json file containing a list of specs"""
+        with open(sites_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def run(self):
+        """Generates all sites and returns the summary, the results of the sites are in the order of the specs"""
+        started = time.strftime('%Y-%m-%dT%H:%M:%S')
+        start = time.perf_counter()
+        results = {}
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(generate_site, site, self.osm_cache_dir, self.srtm_cache_dir): site['name'] for site in self.sites}
+            for future in as_completed(futures):
+                result = future.result()
+                results[futures[future]] = result
+                print(f"{result['name']} {result['status']} in {result['duration_seconds']} seconds" + (f": {result['error']}" if result['error'] else ""))
+
+        site_results = [results[site['name']] for site in self.sites]
+        return {
+            'started': started,
+            'max_workers': self.max_workers or os.cpu_count(),
+            'total_duration_seconds': round(time.perf_counter() - start, 3),
+            'succeeded': sum(result['status'] == 'succeeded' for result in site_results),
+            'failed': sum(result['status'] == 'failed' for result in site_results),
+            'sites': site_results
+        }
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Generate the digital twins of several sites in parallel")
+    parser.add_argument('sites_file', help="json file with a list of site specs (latitude, longitude, name, radius, and optionally water_buffer_size, road_buffer_size, cameras, passage_points, tile_size)")
+    parser.add_argument('--workers', type=int, default=None, help="number of processes, defaults to the number of cores")
+    parser.add_argument('--summary', default='batch_summary.json', help="path of the json summary with per site durations, output sizes and failures")
+    parser.add_argument('--osm-cache-dir', default='cache/osm', help="shared directory for the Overpass responses")
+    parser.add_argument('--srtm-cache-dir', default='cache/srtm', help="shared directory for the SRTM files")
+    args = parser.parse_args(args)
+
+    batchGenerator = BatchGenerator(BatchGenerator.load_sites(args.sites_file), args.workers, args.osm_cache_dir, args.srtm_cache_dir)
+    summary = batchGenerator.run()
+    with open(args.summary, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=4)
+    print(f"{summary['succeeded']} sites succeeded, {summary['failed']} failed, summary saved as {args.summary}")
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
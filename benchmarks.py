@@ -0,0 +1,307 @@
+import argparse
+import glob
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+import folium
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from mapGenerator import MapCreator
+
+# size of the synthetic site per scale: the radius in meters, the number of buildings and the spacing of the road grid in meters
+SCALES = {
+    'small': {'load_dist': 250, 'buildings': 300, 'road_spacing': 100},
+    'medium': {'load_dist': 500, 'buildings': 1500, 'road_spacing': 80},
+    'large': {'load_dist': 1000, 'buildings': 6000, 'road_spacing': 60}
+}
+BENCHMARK_LATITUDE = 51.1797305 # Boschmolenplas, any on-land location works as the data is synthetic
+BENCHMARK_LONGITUDE = 5.8812762
+RESULTS_DIR = 'benchmarkResults'
+METERS_PER_DEGREE = 111320
+
+def meters_to_degrees(latitude, dx, dy):
+    """Returns the offsets in degrees of longitude and latitude of offsets in meters"""
+    return dx / (METERS_PER_DEGREE * math.cos(math.radians(latitude))), dy / METERS_PER_DEGREE
+
+def make_fixture(scale, latitude=BENCHMARK_LATITUDE, longitude=BENCHMARK_LONGITUDE, seed=0):
+    """
+    Returns synthetic buildings, roads and waterways around the location, with the columns the attribute schemas keep.
+    The same scale and seed always give the same layers, so runs can be compared
+
+    Parameters:
+    scale: str, one of SCALES
+    latitude: float, latitude of the middle of the site
+    longitude: float, longitude of the middle of the site
+    seed: int, seed of the random generator
+    """
+    settings = SCALES[scale]
+    rng = np.random.default_rng(seed)
+    radius = settings['load_dist']
+
+    # buildings are rectangles of 6 to 25 meters, with a height for some and levels for others like in OpenStreetMap
+    count = settings['buildings']
+    centers = rng.uniform(-radius, radius, (count, 2))
+    sizes = rng.uniform(6, 25, (count, 2))
+    lon_offset, lat_offset = meters_to_degrees(latitude, centers[:, 0], centers[:, 1])
+    half_width, half_height = meters_to_degrees(latitude, sizes[:, 0] / 2, sizes[:, 1] / 2)
+    geometries = shapely.box(longitude + lon_offset - half_width, latitude + lat_offset - half_height, longitude + lon_offset + half_width, latitude + lat_offset + half_height)
+    buildings = gpd.GeoDataFrame({
+        'osm_type': 'way',
+        'osmid': np.arange(count),
+        'building': rng.choice(['yes', 'house', 'apartments', 'commercial'], count),
+        'name': [f'Building {index}' if index % 10 == 0 else None for index in range(count)],
+        'levels': [str(levels) if index % 3 == 0 else None for index, levels in enumerate(rng.integers(1, 6, count))],
+        'height': [f'{height:.1f}' if index % 5 == 0 else None for index, height in enumerate(rng.uniform(3, 30, count))],
+        'street': [f'Street {index % 25}' for index in range(count)],
+        'housenr': [str(index % 200 + 1) for index in range(count)]
+    }, geometry=geometries, crs='EPSG:4326')
+
+    # roads are a grid, every line is cut into one edge per block like the edges of a road network
+    steps = np.arange(-radius, radius + 1, settings['road_spacing'])
+    lines, highways = [], []
+    for position in steps:
+        for start, end in zip(steps[:-1], steps[1:]):
+            highway = 'primary' if position == steps[len(steps) // 2] else 'residential'
+            for (x1, y1), (x2, y2) in (((start, position), (end, position)), ((position, start), (position, end))):
+                lon1, lat1 = meters_to_degrees(latitude, x1, y1)
+                lon2, lat2 = meters_to_degrees(latitude, x2, y2)
+                lines.append(shapely.LineString([(longitude + lon1, latitude + lat1), (longitude + lon2, latitude + lat2)]))
+                highways.append(highway)
+    roads = gpd.GeoDataFrame({
+        'u': np.arange(len(lines)), 'v': np.arange(len(lines)) + 1, 'key': 0, 'osmid': np.arange(len(lines)),
+        'highway': highways, 'name': [f'Street {index % 25}' for index in range(len(lines))],
+        'oneway': False, 'maxspeed': None, 'lanes': None,
+        'length': float(settings['road_spacing'])
+    }, geometry=lines, crs='EPSG:4326')
+
+    # a few meandering waterways crossing the site
+    waterways = []
+    for index in range(max(1, radius // 250)):
+        x = np.linspace(-radius, radius, 50)
+        y = (index - radius // 500) * 300 + 60 * np.sin(x / 90 + index)
+        lon_offset, lat_offset = meters_to_degrees(latitude, x, y)
+        waterways.append(shapely.LineString(np.column_stack([longitude + lon_offset, latitude + lat_offset])))
+    waterways = gpd.GeoDataFrame({'osm_type': 'way', 'osmid': np.arange(len(waterways)), 'waterway': 'stream', 'name': None, 'width': None},
+                                 geometry=waterways, crs='EPSG:4326')
+    return buildings, roads, waterways
+
+def write_fake_hgt(directory, latitude=BENCHMARK_LATITUDE, longitude=BENCHMARK_LONGITUDE, side=1201):
+    """
+    Writes a synthetic SRTM hgt file (smooth hills) for the 1x1 degree square of the location and returns its path,
+    with SRTM_CACHE_DIR pointing at the directory the elevation is read from it instead of downloaded
+
+    Parameters:
+    directory: str, directory to write the hgt file in
+    latitude: float, latitude in the square
+    longitude: float, longitude in the square
+    side: int, number of points on a side, 1201 is SRTM3 and 3601 is SRTM1
+    """
+    lat_floor, lon_floor = math.floor(latitude), math.floor(longitude)
+    name = f"{'N' if lat_floor >= 0 else 'S'}{abs(lat_floor):02d}{'E' if lon_floor >= 0 else 'W'}{abs(lon_floor):03d}.hgt"
+    rows, columns = np.mgrid[0:side, 0:side]
+    elevations = 40 + 25 * np.sin(rows / 37) * np.cos(columns / 53) + rows * 0.01
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    elevations.astype('>i2').tofile(path)
+    return path
+
+def benchmark_cameras(latitude=BENCHMARK_LATITUDE, longitude=BENCHMARK_LONGITUDE):
+    """Returns a few cameras in the format of the cameras of MapCreator, spread around the location"""
+    cameras = []
+    for index, (dx, dy, direction) in enumerate([(-100, -50, 45), (80, 60, 200), (0, 120, 300)]):
+        lon_offset, lat_offset = meters_to_degrees(latitude, dx, dy)
+        cameras.append({'latitude': latitude + lat_offset, 'longitude': longitude + lon_offset, 'direction': direction, 'width': 90, 'reach': 200,
+                        'name': f'benchmark camera {index + 1}', 'video_source': ''})
+    return cameras
+
+class StageBenchmark:
+    """
+    Times the stages of MapCreator one by one on synthetic layers and a synthetic hgt file, without internet.
+    Every run starts from a fresh MapCreator that gets the layers like the download stage would give them,
+    then every stage is timed on its own. The results are stored as json in RESULTS_DIR so runs can be compared for regressions
+
+    Parameters:
+    scales: list, scales of SCALES to run
+    repeat: int, number of runs per scale, the median and the minimum of the runs are reported
+    results_dir: str, directory where the results are stored
+    """
+    def __init__(self, scales=('small', 'medium'), repeat=3, results_dir=RESULTS_DIR):
+        self.scales = list(scales)
+        self.repeat = repeat
+        self.results_dir = results_dir
+        self.srtm_dir = tempfile.mkdtemp(prefix='benchmark_srtm_')
+        write_fake_hgt(self.srtm_dir)
+
+    def make_map_creator(self, scale, run, layers):
+        """Returns a MapCreator with the synthetic layers set like after the download stage, nothing is cached"""
+        buildings, roads, waterways = layers
+        cameras = benchmark_cameras()
+        passage_points = [(camera['latitude'], camera['longitude']) for camera in cameras]
+        map_creator = MapCreator(BENCHMARK_LATITUDE, BENCHMARK_LONGITUDE, f'benchmark_{scale}', SCALES[scale]['load_dist'], cameras=cameras, passage_points=passage_points,
+                                 use_cache=False, job_id=f'benchmark_{scale}_{run}_{os.getpid()}', isochrone_minutes=[], use_viewsheds=False)
+        map_creator.buildings = buildings
+        map_creator.all_buildings = buildings
+        map_creator.roads = roads
+        map_creator.waterways = waterways
+        return map_creator
+
+    def stages(self, map_creator):
+        """Returns the stages to time in order, as (name, function) pairs, every stage uses what the stages before it made"""
+        injector = map_creator.javaScriptInjector
+        camera = map_creator.cameras[0]
+
+        def buffer_geojson():
+            return {'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'geometry': shapely.geometry.mapping(map_creator.road_buffer_union), 'properties': {}}]}
+
+        def tooltips():
+            map_creator.add_buildings_tooltips(map_creator.all_buildings, folium.FeatureGroup(name='benchmark'), map_creator.mapStyler.style_buildings, {'Digital Twin Name': map_creator.name})
+
+        def base_map():
+            # every injector gets a fresh copy of the saved map without scripts
+            with open(map_creator.map_name, 'w', encoding='utf-8') as f:
+                f.write(map_creator.base_html)
+
+        def injector_stage(inject):
+            def run():
+                base_map()
+                inject()
+            return run
+
+        return [
+            ('project', map_creator.project_layers),
+            ('buffer', map_creator.compute_buffer_areas),
+            ('classify', map_creator.classify_nearby_buildings),
+            ('add_buildings_tooltips', tooltips),
+            ('render_altitude_heatmap', map_creator.render_altitude_heatmap),
+            ('compute_contours', map_creator.compute_contours),
+            ('render_layers', lambda: (setattr(map_creator, 'm', folium.Map(location=[map_creator.latitude, map_creator.longitude], zoom_start=8)), map_creator.render_layers())),
+            ('save_map', lambda: map_creator.save_map()),
+            ('inject_interactive_marker', injector_stage(lambda: injector.inject_interactive_marker(map_creator.map_name))),
+            ('inject_camera_simulation_script', injector_stage(lambda: injector.inject_camera_simulation_script(
+                map_creator.map_name, camera['latitude'], camera['longitude'], camera['direction'], camera['width'], camera['reach'], camera['name'], camera['video_source']))),
+            ('inject_weather_report_script', injector_stage(lambda: injector.inject_weather_report_script(map_creator.map_name, map_creator.latitude, map_creator.longitude, 'benchmark'))),
+            ('inject_passage_simulation_script', injector_stage(lambda: injector.inject_passage_simulation_script(map_creator.map_name, map_creator.passage_points[0]))),
+            ('inject_geojson_layer', injector_stage(lambda: injector.inject_geojson_layer(map_creator.map_name, buffer_geojson(), 'Benchmark layer')))
+        ]
+
+    def run_scale(self, scale):
+        """Returns the timings of every stage of one scale, with the seconds of every run, the median and the minimum"""
+        layers = make_fixture(scale)
+        timings = {}
+        for run in range(self.repeat):
+            map_creator = self.make_map_creator(scale, run, layers)
+            try:
+                for name, stage in self.stages(map_creator):
+                    start = time.perf_counter()
+                    stage()
+                    timings.setdefault(name, []).append(time.perf_counter() - start)
+            finally:
+                shutil.rmtree(map_creator.workspace, ignore_errors=True)
+        return {
+            'features': {'buildings': len(layers[0]), 'roads': len(layers[1]), 'waterways': len(layers[2])},
+            'stages': {name: {'median_seconds': round(statistics.median(runs), 4), 'min_seconds': round(min(runs), 4), 'runs': [round(seconds, 4) for seconds in runs]}
+                       for name, runs in timings.items()}
+        }
+
+    def run(self):
+        """Runs all scales and returns the results, with the commit and the machine so stored runs can be told apart"""
+        previous_srtm_dir = os.environ.get('SRTM_CACHE_DIR')
+        os.environ['SRTM_CACHE_DIR'] = self.srtm_dir
+        try:
+            results = {
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'commit': current_commit(),
+                'python': platform.python_version(),
+                'machine': platform.node(),
+                'repeat': self.repeat,
+                'scales': {}
+            }
+            for scale in self.scales:
+                print(f"Benchmarking scale {scale}..")
+                results['scales'][scale] = self.run_scale(scale)
+            return results
+        finally:
+            if previous_srtm_dir is None:
+                os.environ.pop('SRTM_CACHE_DIR', None)
+            else:
+                os.environ['SRTM_CACHE_DIR'] = previous_srtm_dir
+            shutil.rmtree(self.srtm_dir, ignore_errors=True)
+
+    def save(self, results):
+        """Stores the results as benchmark_<time>_<commit>.json in the results directory and returns the path"""
+        os.makedirs(self.results_dir, exist_ok=True)
+        path = os.path.join(self.results_dir, f"benchmark_{time.strftime('%Y%m%d%H%M%S')}_{results['commit'] or 'nocommit'}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+        return path
+
+def current_commit():
+    """Returns the short hash of the current git commit, or None outside a git repository"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def latest_results(results_dir=RESULTS_DIR, exclude=None):
+    """Returns the path of the newest stored results, None when there are none"""
+    paths = sorted(path for path in glob.glob(os.path.join(results_dir, 'benchmark_*.json')) if path != exclude)
+    return paths[-1] if paths else None
+
+def compare(baseline, current, threshold=1.25, min_seconds=0.01):
+    """
+    Compares two benchmark results and returns the regressions, the stages whose median got more than threshold times slower.
+    Stages faster than min_seconds in both runs are left out, their timings are mostly noise
+
+    Parameters:
+    baseline: dict, results of the earlier run
+    current: dict, results of the new run
+    threshold: float, ratio of the medians above which a stage counts as a regression
+    min_seconds: float, stages below this median in both runs are not compared
+    """
+    regressions = []
+    print(f"{'scale':<8} {'stage':<34} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for scale, scale_results in current['scales'].items():
+        baseline_stages = baseline.get('scales', {}).get(scale, {}).get('stages', {})
+        for stage, timing in scale_results['stages'].items():
+            if stage not in baseline_stages:
+                continue
+            before, after = baseline_stages[stage]['median_seconds'], timing['median_seconds']
+            ratio = after / before if before > 0 else float('inf')
+            regressed = ratio > threshold and max(before, after) >= min_seconds
+            print(f"{scale:<8} {stage:<34} {before:>10.4f} {after:>10.4f} {ratio:>7.2f}{'  REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append({'scale': scale, 'stage': stage, 'baseline_seconds': before, 'current_seconds': after, 'ratio': round(ratio, 3)})
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Times the map generation stages on synthetic data and compares with earlier runs')
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=list(SCALES), help='scales to run')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs per scale')
+    parser.add_argument('--results-dir', default=RESULTS_DIR, help='directory where the results are stored')
+    parser.add_argument('--compare', default='latest', help="results file to compare with, 'latest' for the newest stored run or 'none'")
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio that counts as a regression')
+    args = parser.parse_args()
+
+    baseline_path = latest_results(args.results_dir) if args.compare == 'latest' else (None if args.compare == 'none' else args.compare)
+    benchmark = StageBenchmark(args.scales, args.repeat, args.results_dir)
+    results = benchmark.run()
+    path = benchmark.save(results)
+    print(f"Results saved as {path}")
+
+    if baseline_path is not None:
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"Comparing with {baseline_path} (commit {baseline.get('commit')})")
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} stages got slower than {args.threshold}x")
+            raise SystemExit(1)
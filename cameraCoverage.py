@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+def camera_cones(cameras, epsg_code, cone_points=32):
+    """
+    Returns the view cones of the cameras as polygons in the crs of the epsg code (in meters), made the same way as the cones
+    that are drawn in the map: the direction is in degrees clockwise from north and the arc spans width degrees at reach meters.
+    All cones are made at once with numpy, a camera with a width of 360 degrees or more sees a full circle
+
+    Parameters:
+    cameras: list, dicts with at least latitude, longitude, direction, width and reach
+    epsg_code: int, epsg code of a projection in meters, like the UTM zone of the map
+    cone_points: int, number of points on the arc of a cone
+    """
+    if len(cameras) == 0:
+        return gpd.GeoSeries([], crs=f'EPSG:{epsg_code}')
+    locations = gpd.GeoSeries(gpd.points_from_xy([camera['longitude'] for camera in cameras], [camera['latitude'] for camera in cameras]), crs='EPSG:4326').to_crs(epsg=epsg_code)
+    x, y = locations.x.to_numpy(), locations.y.to_numpy()
+    direction = np.array([camera['direction'] for camera in cameras], dtype=float)
+    width = np.minimum(np.array([camera['width'] for camera in cameras], dtype=float), 360)
+    reach = np.array([camera['reach'] for camera in cameras], dtype=float)
+
+    # angles of the arc points of every camera, one row per camera
+    angles = np.radians(direction[:, None] - width[:, None] / 2 + np.linspace(0, 1, cone_points + 1)[None, :] * width[:, None])
+    arc_x = x[:, None] + reach[:, None] * np.sin(angles)
+    arc_y = y[:, None] + reach[:, None] * np.cos(angles)
+    # apex, arc and back to the apex
+    ring_x = np.column_stack([x, arc_x, x])
+    ring_y = np.column_stack([y, arc_y, y])
+    cones = shapely.polygons(np.stack([ring_x, ring_y], axis=-1))
+
+    full_circles = width >= 360
+    if full_circles.any():
+        cones[full_circles] = shapely.buffer(shapely.points(x[full_circles], y[full_circles]), reach[full_circles], quad_segs=max(cone_points // 4, 1))
+    return gpd.GeoSeries(cones, crs=f'EPSG:{epsg_code}')
+
+class CameraCoverage:
+    """
+    Computes what the cameras see of the roads and buildings, instead of only drawing their cones.
+    The cones are intersected with the layers through the spatial index of the layers, so only the roads and buildings near a cone
+    are looked at and the intersections are computed for all pairs at once. This stays fast with hundreds of cameras
+
+    Parameters:
+    cameras: list, dicts with the properties of the cameras (latitude, longitude, direction, width, reach and name)
+    roads: GeoDataFrame, road layer
+    buildings: GeoDataFrame, building layer
+    epsg_code: int, epsg code of a projection in meters, like the UTM zone of the map
+    cone_points: int, number of points on the arc of a cone
+    cones: array, polygons in the projection to use as what every camera sees instead of the plain cones, like the viewsheds of camera_viewsheds
+    """
+    def __init__(self, cameras, roads, buildings, epsg_code, cone_points=32, cones=None):
+        self.cameras = cameras
+        self.names = [camera.get('name', f'camera {index}') for index, camera in enumerate(cameras)]
+        self.epsg_code = epsg_code
+        self.roads = roads.geometry.to_crs(epsg=epsg_code).reset_index(drop=True)
+        # a two way road is in the road network once per direction, it should only be counted once
+        self.roads = self.roads[~pd.Series(shapely.to_wkb(shapely.normalize(self.roads.to_numpy()))).duplicated().to_numpy()].reset_index(drop=True)
+        self.buildings = buildings.geometry.to_crs(epsg=epsg_code).reset_index(drop=True)
+        self.cones = camera_cones(cameras, epsg_code, cone_points) if cones is None else gpd.GeoSeries(list(cones), crs=f'EPSG:{epsg_code}')
+
+    def overlap_regions(self):
+        """Returns per camera the part of its cone that is also seen by at least one other camera"""
+        cones = self.cones.to_numpy()
+        regions = np.full(len(cones), shapely.Polygon(), dtype=object)
+        left, right = self.cones.sindex.query(cones, predicate='intersects')
+        others = left != right
+        order = np.argsort(left[others], kind='stable')
+        left, right = left[others][order], right[others][order]
+        if len(left) == 0:
+            return regions
+        pieces = shapely.intersection(cones[left], cones[right])
+        # the pairs are sorted by the first camera, so every camera has one run of pieces
+        starts = np.flatnonzero(np.concatenate([[True], left[1:] != left[:-1]]))
+        ends = np.concatenate([starts[1:], [len(left)]])
+        for start, end in zip(starts, ends):
+            regions[left[start]] = shapely.union_all(pieces[start:end])
+        return regions
+
+    def analyze(self):
+        """
+        Returns the coverage report: a DataFrame with per camera the road length and the number of buildings it sees, the area of its cone
+        that other cameras also see and the road length that only this camera sees, a GeoDataFrame with the blind spots
+        (the parts of the roads no camera sees) and a summary of the whole site
+        """
+        cones = self.cones.to_numpy()
+        road_geometries = self.roads.to_numpy()
+        overlap = self.overlap_regions()
+
+        # every cone with every road it touches, the seen part of the road is the intersection
+        cone_index, road_index = self.roads.sindex.query(cones, predicate='intersects')
+        seen = shapely.intersection(cones[cone_index], road_geometries[road_index])
+        seen_length = shapely.length(seen)
+        shared_length = shapely.length(shapely.intersection(seen, overlap[cone_index]))
+        road_length = np.bincount(cone_index, weights=seen_length, minlength=len(cones))
+        unique_road_length = road_length - np.bincount(cone_index, weights=shared_length, minlength=len(cones))
+
+        building_cone_index, building_index = self.buildings.sindex.query(cones, predicate='intersects')
+        buildings_seen = np.bincount(building_cone_index, minlength=len(cones))
+
+        per_camera = pd.DataFrame({
+            'camera': self.names,
+            'road_length_m': np.round(road_length, 1),
+            'unique_road_length_m': np.round(unique_road_length, 1),
+            'buildings': buildings_seen,
+            'cone_area_m2': np.round(shapely.area(cones), 1),
+            'overlap_area_m2': np.round(shapely.area(overlap), 1)
+        })
+
+        # the blind spots are the roads minus everything any camera sees, roads away from all cones are blind as a whole
+        seen_by_any = shapely.union_all(cones) if len(cones) > 0 else shapely.Polygon()
+        near = np.zeros(len(road_geometries), dtype=bool)
+        near[np.unique(road_index)] = True
+        blind = road_geometries.copy()
+        blind[near] = shapely.difference(road_geometries[near], seen_by_any)
+        blind_spots = gpd.GeoDataFrame({'length_m': shapely.length(blind)}, geometry=blind, crs=f'EPSG:{self.epsg_code}')
+        blind_spots = blind_spots[~blind_spots.geometry.is_empty & (blind_spots['length_m'] > 0)]
+        blind_spots = blind_spots.sort_values('length_m', ascending=False).reset_index(drop=True)
+
+        total_road_length = float(shapely.length(road_geometries).sum())
+        blind_road_length = float(blind_spots['length_m'].sum())
+        summary = {
+            'cameras': len(cones),
+            'road_length_m': round(total_road_length, 1),
+            'covered_road_length_m': round(total_road_length - blind_road_length, 1),
+            'covered_road_ratio': round((total_road_length - blind_road_length) / total_road_length, 4) if total_road_length > 0 else 0.0,
+            'buildings': len(self.buildings),
+            'covered_buildings': int(len(np.unique(building_index))),
+            'overlap_area_m2': round(float(shapely.area(shapely.union_all(overlap))) if len(overlap) > 0 else 0.0, 1)
+        }
+        return {'per_camera': per_camera, 'blind_spots': blind_spots.to_crs(epsg=4326), 'summary': summary}
@@ -0,0 +1,199 @@
+import heapq
+import time
+
+import numpy as np
+import shapely
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+
+class CameraPlacement:
+    """
+    Chooses where to put a number of cameras so that together they see as much of the roads and the passage points as possible.
+    The candidates are positions on the road graph (the crossings and points every spacing meters along the roads), each tried in a number of directions.
+    What every candidate sees is computed once as a sparse matrix of candidates x targets, the targets are short pieces of road
+    (weighted by their length) and the passage points. The cameras are then picked with (lazy) greedy max coverage,
+    every next camera is the one that sees the most that is not seen yet. Greedy is within 63% of the best possible placement.
+    What a candidate sees is its plain cone, buildings are not taken into account (the viewsheds are too slow for thousands of candidates)
+
+    Parameters:
+    road_graph: RoadGraph, road network of the site, from the download stage
+    passage_points: list, tuples with lat, lon of the passage points that should be seen
+    width: float, width of the cone of the cameras in degrees
+    reach: float, reach of the cameras in meters
+    directions: int, number of directions every candidate position is tried in, evenly spread over the circle
+    spacing: float, meters between the candidate positions along the roads, None only uses the crossings
+    segment_length: float, the roads are split in pieces of this length, a piece counts as seen when its middle is in a cone
+    passage_weight: float, a passage point counts as this many meters of road
+    """
+    def __init__(self, road_graph, passage_points=[], width=90, reach=200, directions=8, spacing=50, segment_length=10, passage_weight=100):
+        self.road_graph = road_graph
+        self.passage_points = passage_points
+        self.width = width
+        self.reach = reach
+        self.directions = np.arange(directions) * 360 / directions
+        self.spacing = spacing
+        self.segment_length = segment_length
+        self.passage_weight = passage_weight
+        self.lines = self.unique_lines()
+        self.positions = self.candidate_positions()
+        self.targets, self.weights = self.coverage_targets()
+        self.matrix = None
+
+    def unique_lines(self):
+        """Returns the roads as lines in the local meters of the road graph, a two way road is in the graph once per direction and is kept once"""
+        lines = self.road_graph.edge_lines()
+        if len(lines) == 0:
+            return lines
+        _, first = np.unique(shapely.to_wkb(shapely.normalize(lines)), return_index=True)
+        return lines[np.sort(first)]
+
+    @staticmethod
+    def points_along(lines, step, offset):
+        """
+        Returns the x, y of points every step meters along the lines and the length of road every point stands for
+
+        Parameters:
+        lines: array, shapely lines
+        step: float, max distance between the points
+        offset: float, position of the first point as part of a step, 0.5 puts the points in the middle of their piece
+        """
+        lengths = shapely.length(lines)
+        counts = np.maximum(np.ceil(lengths / step), 1).astype(np.int64)
+        line_index = np.repeat(np.arange(len(lines)), counts)
+        piece = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        piece_lengths = lengths[line_index] / counts[line_index]
+        points = shapely.line_interpolate_point(lines[line_index], (piece + offset) * piece_lengths)
+        return shapely.get_coordinates(points), piece_lengths
+
+    def candidate_positions(self):
+        """Returns the x, y of the candidate positions: the crossings and, with a spacing, the points along the roads, positions closer than a meter are merged"""
+        positions = np.column_stack(self.road_graph.to_local(self.road_graph.latitudes, self.road_graph.longitudes))
+        if self.spacing is not None and len(self.lines) > 0:
+            along, _ = self.points_along(self.lines, self.spacing, 0)
+            positions = np.concatenate([positions, along])
+        _, first = np.unique(np.round(positions).astype(np.int64), axis=0, return_index=True)
+        return positions[np.sort(first)]
+
+    def coverage_targets(self):
+        """Returns the x, y of what should be seen (the middles of the road pieces and the passage points) and the weight of every target"""
+        targets, weights = np.zeros((0, 2)), np.zeros(0)
+        if len(self.lines) > 0:
+            targets, weights = self.points_along(self.lines, self.segment_length, 0.5)
+        if len(self.passage_points) > 0:
+            points = np.asarray(self.passage_points, dtype=float).reshape(-1, 2)
+            targets = np.concatenate([targets, np.column_stack(self.road_graph.to_local(points[:, 0], points[:, 1]))])
+            weights = np.concatenate([weights, np.full(len(points), float(self.passage_weight))])
+        return targets, weights
+
+    def coverage_matrix(self):
+        """
+        Returns the sparse matrix with a row per candidate (position x direction) and a column per target, True when the target is in the cone.
+        The targets within reach of every position come from a kd-tree, then all directions are tested against them at once
+        """
+        if self.matrix is None:
+            tree = cKDTree(self.targets)
+            near = tree.query_ball_point(self.positions, self.reach, return_sorted=False)
+            counts = np.array([len(targets) for targets in near], dtype=np.int64)
+            position_index = np.repeat(np.arange(len(self.positions)), counts)
+            target_index = np.concatenate([np.asarray(targets, dtype=np.int64) for targets in near]) if counts.sum() > 0 else np.zeros(0, dtype=np.int64)
+
+            offsets = self.targets[target_index] - self.positions[position_index]
+            bearings = np.degrees(np.arctan2(offsets[:, 0], offsets[:, 1])) # clockwise from north, like the direction of a camera
+            at_position = np.hypot(offsets[:, 0], offsets[:, 1]) < 1e-9
+            # angle between every pair and every direction, wrapped to -180..180
+            difference = (bearings[:, None] - self.directions[None, :] + 180) % 360 - 180
+            in_cone = (np.abs(difference) <= self.width / 2) | at_position[:, None]
+            pairs, direction_index = np.nonzero(in_cone)
+
+            rows = position_index[pairs] * len(self.directions) + direction_index
+            self.matrix = csr_matrix((np.ones(len(rows), dtype=bool), (rows, target_index[pairs])),
+                                     shape=(len(self.positions) * len(self.directions), len(self.targets)))
+        return self.matrix
+
+    def greedy(self, budget):
+        """
+        Returns the rows of the chosen candidates and the weight every one of them added, every step recomputes the gain of all candidates
+
+        Parameters:
+        budget: int, number of cameras to place
+        """
+        matrix = self.coverage_matrix()
+        remaining = self.weights.copy()
+        chosen, gains = [], []
+        for _ in range(min(budget, matrix.shape[0])):
+            candidate_gains = matrix @ remaining
+            best = int(np.argmax(candidate_gains))
+            if candidate_gains[best] <= 0:
+                break
+            chosen.append(best)
+            gains.append(float(candidate_gains[best]))
+            remaining[matrix.indices[matrix.indptr[best]:matrix.indptr[best + 1]]] = 0
+        return chosen, gains
+
+    def lazy_greedy(self, budget):
+        """
+        Returns the cameras greedy would choose, but only recomputes the gain of the candidate on top of a priority queue.
+        The gain of a candidate can only go down when other cameras are chosen, so when its new gain is still the largest it is the best.
+        This recomputes only a few candidates per step instead of all of them
+
+        Parameters:
+        budget: int, number of cameras to place
+        """
+        matrix = self.coverage_matrix()
+        remaining = self.weights.copy()
+        # the row number breaks ties, like argmax does in greedy
+        queue = [(-gain, row) for row, gain in enumerate(matrix @ remaining) if gain > 0]
+        heapq.heapify(queue)
+        chosen, gains = [], []
+        while queue and len(chosen) < budget:
+            _, row = heapq.heappop(queue)
+            targets = matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]]
+            gain = float(remaining[targets].sum())
+            if gain <= 0:
+                continue
+            if queue and (-gain, row) > queue[0]:
+                heapq.heappush(queue, (-gain, row)) # someone else might be better now
+                continue
+            chosen.append(row)
+            gains.append(gain)
+            remaining[targets] = 0
+        return chosen, gains
+
+    def solve(self, budget, method='lazy', name_prefix='camera', video_source=''):
+        """
+        Returns the chosen cameras as dicts in the format of the cameras of MapCreator (latitude, longitude, direction, width, reach, name and video_source),
+        the best camera first
+
+        Parameters:
+        budget: int, number of cameras to place
+        method: str, 'lazy' for lazy greedy or 'greedy' to recompute all gains every step, both give the same coverage (only ties can be broken differently)
+        name_prefix: str, the cameras are named name_prefix 1, name_prefix 2, ..
+        video_source: str, video source of the cameras
+        """
+        start = time.perf_counter()
+        chosen, gains = self.lazy_greedy(budget) if method == 'lazy' else self.greedy(budget)
+        chosen = np.asarray(chosen, dtype=np.int64)
+        positions = self.positions[chosen // len(self.directions)]
+        coordinates = self.road_graph.to_lonlat(positions) if len(positions) > 0 else np.zeros((0, 2))
+
+        cameras = []
+        for index, (row, (longitude, latitude)) in enumerate(zip(chosen, coordinates)):
+            cameras.append({
+                'latitude': round(float(latitude), 7),
+                'longitude': round(float(longitude), 7),
+                'direction': float(self.directions[row % len(self.directions)]),
+                'width': self.width,
+                'reach': self.reach,
+                'name': f'{name_prefix} {index + 1}',
+                'video_source': video_source
+            })
+        total = float(self.weights.sum())
+        self.report = {
+            'candidates': int(len(self.positions) * len(self.directions)),
+            'targets': int(len(self.targets)),
+            'gains': [round(gain, 1) for gain in gains],
+            'covered_ratio': round(sum(gains) / total, 4) if total > 0 else 0.0
+        }
+        print(f"Placed {len(cameras)} cameras out of {self.report['candidates']} candidates in {time.perf_counter() - start:.2f} seconds, "
+              f"they see {self.report['covered_ratio']:.1%} of the roads and passage points")
+        return cameras
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import osmium
+import pytest
+from osmium.osm import mutable
+
+# the small site of the tests, a grid of streets with houses along a river near 51.01, 5.01
+SITE = (51.01, 5.01)
+
+def site_elements():
+    """
+    Returns the OpenStreetMap elements of the test site as Overpass json elements, nodes first:
+    a grid of residential streets, a row of houses and a river
+    """
+    nodes, ways = [], []
+    def node(latitude, longitude):
+        # osm keeps 7 decimals, like the pbf and the answers of Overpass
+        nodes.append({'type': 'node', 'id': len(nodes) + 1, 'lat': round(latitude, 7), 'lon': round(longitude, 7)})
+        return len(nodes)
+    def way(refs, tags):
+        ways.append({'type': 'way', 'id': len(ways) + 1, 'nodes': refs, 'tags': tags})
+
+    latitude, longitude = SITE
+    steps = [-0.002, 0, 0.002]
+    grid = {(i, j): node(latitude + dy, longitude + dx) for i, dy in enumerate(steps) for j, dx in enumerate(steps)}
+    for i in range(3):
+        way([grid[(i, j)] for j in range(3)], {'highway': 'residential', 'name': f'Dwarsstraat {i}'})
+        way([grid[(j, i)] for j in range(3)], {'highway': 'residential', 'name': f'Langstraat {i}'})
+    for k in range(6):
+        south, west = latitude + 0.0003, longitude - 0.0025 + k * 0.001
+        corners = [node(south, west), node(south, west + 0.0002), node(south + 0.0002, west + 0.0002), node(south + 0.0002, west)]
+        way(corners + corners[:1], {'building': 'house', 'name': f'huis {k}'})
+    way([node(latitude - 0.001, longitude - 0.004), node(latitude - 0.0008, longitude + 0.004)], {'waterway': 'river', 'name': 'Maas'})
+    return nodes + ways
+
+def write_extract(path):
+    """Writes the elements of the test site as .osm.pbf extract and returns its path"""
+    writer = osmium.SimpleWriter(str(path))
+    try:
+        for element in site_elements():
+            if element['type'] == 'node':
+                writer.add_node(mutable.Node(id=element['id'], location=(element['lon'], element['lat']), tags={}, version=1))
+            else:
+                writer.add_way(mutable.Way(id=element['id'], nodes=element['nodes'], tags=element['tags'], version=1))
+    finally:
+        writer.close()
+    return str(path)
+
+@pytest.fixture(scope='session')
+def extract(tmp_path_factory):
+    """Path of the OpenStreetMap extract of the test site"""
+    return write_extract(tmp_path_factory.mktemp('extract') / 'site.osm.pbf')
+
+@pytest.fixture
+def srtm(tmp_path, monkeypatch):
+    """A synthetic SRTM tile under the site (a sloping saw tooth terrain), so no elevation data is downloaded"""
+    cache_dir = tmp_path / 'srtm'
+    cache_dir.mkdir()
+    side = 1201
+    heights = (np.add.outer(np.arange(side), np.arange(side)) % 100 + 20).astype('>i2')
+    heights.tofile(str(cache_dir / 'N51E005.hgt'))
+    monkeypatch.setenv('SRTM_CACHE_DIR', str(cache_dir))
+    return str(cache_dir)
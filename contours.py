@@ -0,0 +1,108 @@
+import numpy as np
+import geopandas as gpd
+import shapely
+
+# the edges of a cell of the marching squares, the corners are bottom left, bottom right, top right and top left
+BOTTOM, RIGHT, TOP, LEFT = 0, 1, 2, 3
+
+# segments per case (the case has a bit per corner above the level: 1 bottom left, 2 bottom right, 4 top right, 8 top left),
+# every segment connects two edges of the cell, -1 is no segment. The saddles (5 and 10) are for a centre below the level
+_SEGMENTS = np.full((16, 2, 2), -1, dtype=np.int64)
+for case, segments in {
+    1: [(LEFT, BOTTOM)], 2: [(BOTTOM, RIGHT)], 3: [(LEFT, RIGHT)], 4: [(RIGHT, TOP)],
+    5: [(LEFT, BOTTOM), (RIGHT, TOP)], 6: [(BOTTOM, TOP)], 7: [(LEFT, TOP)], 8: [(TOP, LEFT)],
+    9: [(BOTTOM, TOP)], 10: [(BOTTOM, RIGHT), (TOP, LEFT)], 11: [(RIGHT, TOP)], 12: [(LEFT, RIGHT)],
+    13: [(BOTTOM, RIGHT)], 14: [(LEFT, BOTTOM)]
+}.items():
+    for index, segment in enumerate(segments):
+        _SEGMENTS[case, index] = segment
+
+# a saddle with the centre above the level connects the other two corners
+_SADDLE_SEGMENTS = _SEGMENTS.copy()
+_SADDLE_SEGMENTS[5] = [(BOTTOM, RIGHT), (TOP, LEFT)]
+_SADDLE_SEGMENTS[10] = [(LEFT, BOTTOM), (RIGHT, TOP)]
+
+def contour_segments(elevations, level):
+    """
+    Returns the segments of the contour line of one level as an (n, 2, 2) array of x, y in grid units (x is the column, y the row),
+    with vectorized marching squares: the case of every cell is computed at once and only the cells the line passes through are worked out.
+    The crossing on an edge is computed the same way in both cells next to it, so the segments of neighbouring cells end in exactly
+    the same point and can be merged into lines. Cells with a missing (nan) corner get no segments
+
+    Parameters:
+    elevations: array, (rows x columns) elevations
+    level: float, elevation of the contour line
+    """
+    if elevations.shape[0] < 2 or elevations.shape[1] < 2:
+        return np.zeros((0, 2, 2))
+    above = elevations >= level
+    case = above[:-1, :-1] * np.uint8(1) + above[:-1, 1:] * np.uint8(2) + above[1:, 1:] * np.uint8(4) + above[1:, :-1] * np.uint8(8)
+    rows, columns = np.nonzero((case != 0) & (case != 15))
+    bottom_left, bottom_right = elevations[rows, columns], elevations[rows, columns + 1]
+    top_right, top_left = elevations[rows + 1, columns + 1], elevations[rows + 1, columns]
+    valid = np.isfinite(bottom_left) & np.isfinite(bottom_right) & np.isfinite(top_right) & np.isfinite(top_left)
+    rows, columns, case = rows[valid], columns[valid], case[rows[valid], columns[valid]].astype(np.int64)
+    bottom_left, bottom_right, top_right, top_left = bottom_left[valid], bottom_right[valid], top_right[valid], top_left[valid]
+    if len(rows) == 0:
+        return np.zeros((0, 2, 2))
+
+    def crossing(z0, z1):
+        # where the level lies between two neighbouring grid values, as part of the edge
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (level - z0) / (z1 - z0)
+        return np.clip(np.where(np.isfinite(t), t, 0.5), 0, 1)
+
+    x, y = columns.astype(float), rows.astype(float)
+    # per cell the crossing of each of its edges, in the order bottom, right, top, left
+    edges = np.stack([
+        np.column_stack([x + crossing(bottom_left, bottom_right), y]),
+        np.column_stack([x + 1, y + crossing(bottom_right, top_right)]),
+        np.column_stack([x + crossing(top_left, top_right), y + 1]),
+        np.column_stack([x, y + crossing(bottom_left, top_left)])
+    ], axis=1)
+
+    centre_above = (bottom_left + bottom_right + top_right + top_left) / 4 >= level
+    segments = np.where(centre_above[:, None, None], _SADDLE_SEGMENTS[case], _SEGMENTS[case])
+    cells, slots = np.nonzero(segments[:, :, 0] >= 0)
+    return np.stack([edges[cells, segments[cells, slots, 0]], edges[cells, segments[cells, slots, 1]]], axis=1)
+
+def contour_levels(elevations, interval):
+    """Returns the multiples of the interval between the lowest and the highest elevation"""
+    finite = elevations[np.isfinite(elevations)]
+    if len(finite) == 0:
+        return np.zeros(0)
+    return np.arange(np.ceil(finite.min() / interval), np.floor(finite.max() / interval) + 1) * interval
+
+def elevation_contours(latitudes, longitudes, elevations, interval=5, major_every=5, simplify_tolerance=0.25, precision=6):
+    """
+    Returns the contour lines of an elevation grid as a GeoDataFrame with one feature (a MultiLineString) per level,
+    with the columns elevation and major (every major_every-th level, for a thicker line)
+
+    Parameters:
+    latitudes: array, ascending latitudes of the rows of the grid, evenly spaced
+    longitudes: array, ascending longitudes of the columns of the grid, evenly spaced
+    elevations: array, (latitudes x longitudes) elevations in meters, nan where unknown
+    interval: float, meters between the contour lines
+    major_every: int, every this many levels is a major line
+    simplify_tolerance: float, the lines are simplified with this tolerance in grid cells, 0 does not simplify
+    precision: int, decimals of the coordinates, to keep the geojson small
+    """
+    elevations = np.asarray(elevations, dtype=float)
+    lat_step = (latitudes[-1] - latitudes[0]) / (len(latitudes) - 1) if len(latitudes) > 1 else 0
+    lon_step = (longitudes[-1] - longitudes[0]) / (len(longitudes) - 1) if len(longitudes) > 1 else 0
+    records, geometries = [], []
+    for level in contour_levels(elevations, interval):
+        # srtm elevations are whole meters, a level exactly on a grid value is moved up a millimeter so a line never runs through a grid point
+        segments = contour_segments(elevations, level + 1e-3)
+        if len(segments) == 0:
+            continue
+        lines = shapely.line_merge(shapely.multilinestrings(shapely.linestrings(segments)))
+        if simplify_tolerance > 0:
+            lines = shapely.simplify(lines, simplify_tolerance)
+        lines = shapely.transform(lines, lambda xy: np.round(np.column_stack([longitudes[0] + xy[:, 0] * lon_step, latitudes[0] + xy[:, 1] * lat_step]), precision))
+        lines = shapely.multilinestrings(shapely.get_parts(lines))
+        if lines.is_empty:
+            continue
+        records.append({'elevation': float(level), 'major': bool(round(level / interval) % major_every == 0)})
+        geometries.append(lines)
+    return gpd.GeoDataFrame(records, columns=['elevation', 'major'], geometry=geometries, crs='EPSG:4326')
@@ -0,0 +1,226 @@
+import glob
+import json
+import math
+import os
+import threading
+
+# the default heatmap_step of MapCreator, in degrees
+DEFAULT_HEATMAP_STEP = 0.00005
+
+# features (buildings, road edges and waterways) per km2 when there is no history yet, about a Dutch town
+DEFAULT_DENSITY = 1500
+
+# cost of a map per unit when there is no history yet, measured with benchmarks.py (render and save take about 9 ms per feature
+# because of the tooltip of every building) and the size of the generated maps. The history corrects these for the machine the app runs on
+DEFAULT_RATES = {
+    'seconds': {'base': 5, 'feature': 0.01, 'simplified_feature': 0.009, 'heatmap_cell': 1e-5, 'raster_cell': 1e-6},
+    'bytes': {'base': 3e5, 'feature': 1500, 'simplified_feature': 900, 'heatmap_cell': 45, 'raster_cell': 3}
+}
+
+# the steps to make a map lighter, tried in this order until the estimate fits the budget
+DEGRADATIONS = [
+    ('coarser heatmap', {'heatmap_step': DEFAULT_HEATMAP_STEP * 2}),
+    ('coarser heatmap', {'heatmap_step': DEFAULT_HEATMAP_STEP * 4}),
+    ('raster elevation instead of a heatmap', {'altitude_heatmap': False, 'altitude_raster': True}),
+    ('simplified geometries', {'simplify_tolerance': 2})
+]
+
+class OverBudgetError(ValueError):
+    """Raised by CostEstimator.plan when a map does not fit the budget, even made as light as possible"""
+    def __init__(self, message, estimate):
+        super().__init__(message)
+        self.estimate = estimate
+
+def distance_km(latitude_1, longitude_1, latitude_2, longitude_2):
+    """Returns the great circle distance between two points in km"""
+    lat_1, lat_2 = math.radians(latitude_1), math.radians(latitude_2)
+    a = math.sin((lat_2 - lat_1) / 2) ** 2 + math.cos(lat_1) * math.cos(lat_2) * math.sin(math.radians(longitude_2 - longitude_1) / 2) ** 2
+    return 2 * 6371 * math.asin(math.sqrt(min(a, 1)))
+
+def median(values):
+    """Returns the median of a list of numbers"""
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+def duration_text(seconds):
+    """Returns a duration as text in seconds, minutes or hours"""
+    if seconds < 120:
+        return f"{seconds:.0f} seconds"
+    if seconds < 7200:
+        return f"{seconds / 60:.0f} minutes"
+    return f"{seconds / 3600:.1f} hours"
+
+class CostEstimator:
+    """
+    Estimates what a map will cost before any work starts: the number of features, the heatmap cells, the runtime and the size of the map.
+    The number of features comes from the density (features per km2) of the earlier maps near the location, the heatmap cells follow
+    from the area and the heatmap step. The runtime and the size are the unit costs of DEFAULT_RATES times a correction that is learned
+    from the earlier maps (their metrics files, see Instrumentation.parameters), so the estimates follow the machine and the data.
+    plan makes a map lighter step by step (see DEGRADATIONS) until it fits the budget, or rejects it
+
+    Parameters:
+    history_dir: str, directory with the metrics_<name>_<job_id>.json files of the earlier maps
+    max_seconds: float, runtime budget of a map, None is no limit
+    max_bytes: float, size budget of a map, None is no limit
+    neighbourhood_km: float, earlier maps within this distance tell the density of a location
+    history_size: int, number of the latest earlier maps the corrections are learned from
+    """
+    def __init__(self, history_dir='geoJsonFiles', max_seconds=600, max_bytes=200e6, neighbourhood_km=25, history_size=50):
+        self.history_dir = history_dir
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.neighbourhood_km = neighbourhood_km
+        self.history_size = history_size
+        self.records = {} # path to the record of an earlier map, a metrics file is only read once
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def record_from_metrics(metrics):
+        """
+        Returns what an earlier map cost and what it was asked to make, None when it can not be learned from:
+        it failed, it has no parameters (made before they were recorded), its download or render came from the stage cache
+        or its download has no layers (made when the buildings were counted twice in the features)
+        """
+        parameters = metrics.get('parameters') or {}
+        spans = {span['name']: span for span in metrics.get('spans', []) if not span.get('nested')}
+        if metrics.get('status') != 'succeeded' or 'load_dist' not in parameters or 'download' not in spans or 'render' not in spans:
+            return None
+        if spans['download'].get('cached') or spans['render'].get('cached') or 'layers' not in spans['download']:
+            return None
+        return {
+            'latitude': parameters['latitude'],
+            'longitude': parameters['longitude'],
+            'load_dist': parameters['load_dist'],
+            'features': spans['download'].get('features', 0),
+            'heatmap_cells': parameters.get('heatmap_cells', 0),
+            'raster_cells': parameters.get('raster_cells', 0),
+            'simplified': parameters.get('simplify_tolerance') is not None,
+            'seconds': metrics['total_seconds'],
+            'bytes': spans['publish'].get('output_bytes', spans['publish'].get('bytes_written', 0)) if 'publish' in spans else metrics.get('bytes_written', 0),
+            'started': metrics.get('started', '')
+        }
+
+    def history(self):
+        """Returns the records of the earlier maps that can be learned from, the latest first"""
+        with self.lock:
+            for path in glob.glob(os.path.join(self.history_dir, 'metrics_*.json')):
+                if path not in self.records:
+                    try:
+                        with open(path, 'r', encoding='utf-8') as f:
+                            self.records[path] = self.record_from_metrics(json.load(f))
+                    except (OSError, ValueError, KeyError):
+                        self.records[path] = None
+            records = [record for record in self.records.values() if record is not None]
+        return sorted(records, key=lambda record: record['started'], reverse=True)
+
+    @staticmethod
+    def area_km2(load_dist):
+        """Returns the area that is downloaded for a load_dist, a square of twice the load_dist"""
+        return (2 * load_dist / 1000) ** 2
+
+    @staticmethod
+    def grid_cells(latitude, load_dist, step):
+        """Returns the number of points of a grid with a step in degrees over the area of a load_dist"""
+        meters_per_degree = 111320
+        rows = 2 * load_dist / (meters_per_degree * step)
+        columns = 2 * load_dist / (meters_per_degree * max(math.cos(math.radians(latitude)), 0.01) * step)
+        return int(math.ceil(rows) * math.ceil(columns))
+
+    def density(self, latitude, longitude, history):
+        """Returns the features per km2 at a location and where it comes from: the earlier maps nearby, all earlier maps or the default"""
+        densities = [(distance_km(latitude, longitude, record['latitude'], record['longitude']), record['features'] / self.area_km2(record['load_dist']))
+                     for record in history if record['load_dist'] > 0]
+        nearby = [density for distance, density in densities if distance <= self.neighbourhood_km]
+        if nearby:
+            return median(nearby), f'{len(nearby)} earlier maps nearby'
+        if densities:
+            return median([density for _, density in densities]), f'{len(densities)} earlier maps elsewhere'
+        return DEFAULT_DENSITY, 'default'
+
+    @staticmethod
+    def raw_cost(kind, features, heatmap_cells, raster_cells, simplified):
+        """Returns the seconds or bytes (kind) of a map from the default rates"""
+        rates = DEFAULT_RATES[kind]
+        return (rates['base'] + features * rates['simplified_feature' if simplified else 'feature']
+                + heatmap_cells * rates['heatmap_cell'] + raster_cells * rates['raster_cell'])
+
+    def corrections(self, history):
+        """Returns per kind (seconds and bytes) the median ratio between what the earlier maps cost and what the default rates say"""
+        corrections = {}
+        for kind in DEFAULT_RATES:
+            ratios = [record[kind] / self.raw_cost(kind, record['features'], record['heatmap_cells'], record['raster_cells'], record['simplified'])
+                      for record in history[:self.history_size] if record[kind] > 0]
+            # a few odd maps can not make the estimates wildly off
+            corrections[kind] = min(max(median(ratios), 0.2), 5) if ratios else 1
+        return corrections
+
+    def estimate(self, latitude, longitude, load_dist, options={}):
+        """
+        Returns the estimated features, heatmap cells, raster cells, seconds and bytes of a map
+
+        Parameters:
+        latitude, longitude: float, location of the map
+        load_dist: int, distance in meters the data is loaded for
+        options: dict, MapCreator options that change the cost: altitude_heatmap, heatmap_step, altitude_raster and simplify_tolerance
+        """
+        history = self.history()
+        density, density_source = self.density(latitude, longitude, history)
+        corrections = self.corrections(history)
+        features = int(density * self.area_km2(load_dist))
+        heatmap_cells = self.grid_cells(latitude, load_dist, options.get('heatmap_step', DEFAULT_HEATMAP_STEP)) if options.get('altitude_heatmap', True) else 0
+        # srtm3 has a point every 3 arc seconds
+        raster_cells = self.grid_cells(latitude, load_dist, 1 / 1200) if options.get('altitude_raster', False) else 0
+        simplified = options.get('simplify_tolerance') is not None
+        return {
+            'features': features,
+            'density_per_km2': round(density, 1),
+            'density_source': density_source,
+            'heatmap_cells': heatmap_cells,
+            'raster_cells': raster_cells,
+            'seconds': round(self.raw_cost('seconds', features, heatmap_cells, raster_cells, simplified) * corrections['seconds'], 1),
+            'bytes': int(self.raw_cost('bytes', features, heatmap_cells, raster_cells, simplified) * corrections['bytes']),
+            'history': len(history)
+        }
+
+    def fits(self, estimate):
+        """Returns True when an estimate is within the budget"""
+        return ((self.max_seconds is None or estimate['seconds'] <= self.max_seconds)
+                and (self.max_bytes is None or estimate['bytes'] <= self.max_bytes))
+
+    def plan(self, latitude, longitude, load_dist):
+        """
+        Returns the MapCreator options that make the map fit the budget, with the degradations they stand for and the estimate of the map with them.
+        Raises an OverBudgetError when the lightest map is still over the budget
+
+        Parameters:
+        latitude, longitude: float, location of the map
+        load_dist: int, distance in meters the data is loaded for
+        """
+        options = {}
+        degradations = []
+        estimate = self.estimate(latitude, longitude, load_dist, options)
+        full_estimate = estimate
+        for name, degradation in DEGRADATIONS:
+            if self.fits(estimate):
+                break
+            options.update(degradation)
+            if name not in degradations:
+                degradations.append(name)
+            estimate = self.estimate(latitude, longitude, load_dist, options)
+        if not self.fits(estimate):
+            raise OverBudgetError(f"An area of {load_dist} m is estimated at about {estimate['features']} features, {duration_text(estimate['seconds'])} and "
+                                  f"{estimate['bytes'] / 1e6:.0f} MB even when made as light as possible, the budget is {self.budget_text()}. Please choose a smaller area", estimate)
+        if degradations:
+            print(f"Map of {load_dist} m made lighter to fit the budget ({', '.join(degradations)}), estimated {full_estimate['seconds']:.0f} -> {estimate['seconds']:.0f} seconds "
+                  f"and {full_estimate['bytes'] / 1e6:.1f} -> {estimate['bytes'] / 1e6:.1f} MB")
+        return {'options': options, 'degradations': degradations, 'estimate': estimate, 'full_estimate': full_estimate}
+
+    def budget_text(self):
+        """Returns the budget as text"""
+        limits = []
+        if self.max_seconds is not None:
+            limits.append(duration_text(self.max_seconds))
+        if self.max_bytes is not None:
+            limits.append(f"{self.max_bytes / 1e6:.0f} MB")
+        return ' and '.join(limits) if limits else 'unlimited'
@@ -0,0 +1,454 @@
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+import threading
+from array import array
+from contextlib import contextmanager
+
+import numpy as np
+import osmnx as ox
+import shapely
+
+from downloadScheduler import DownloadScheduler
+
+# osmnx keeps its overpass functions module wide, so they are replaced once by dispatchers that call the functions of the source
+# that serves the current thread. Threads (like the requests of the Flask app) each use their own source at the same time,
+# a thread without a source gets the original osmnx function
+_OVERPASS_FUNCTIONS = ('_overpass_request', '_download_overpass_network', '_download_overpass_features')
+_serving = threading.local()
+_install_lock = threading.Lock()
+_original_functions = {}
+
+def _dispatcher(function_name):
+    """Returns the function that takes the place of an osmnx overpass function and calls the one of the source serving the thread"""
+    def dispatch(*args, **kwargs):
+        handlers = getattr(_serving, 'handlers', None) or {}
+        return handlers.get(function_name, _original_functions[function_name])(*args, **kwargs)
+    return dispatch
+
+def _install_dispatchers():
+    """Replaces the osmnx overpass functions by the dispatchers, only the first time it is called"""
+    with _install_lock:
+        if _original_functions:
+            return
+        for function_name in _OVERPASS_FUNCTIONS:
+            _original_functions[function_name] = getattr(ox._overpass, function_name)
+            setattr(ox._overpass, function_name, _dispatcher(function_name))
+
+@contextmanager
+def _serving_with(handlers):
+    """
+    Lets osmnx call the handlers instead of its overpass functions in this thread for the duration of the block
+
+    Parameters:
+    handlers: dict, name of an osmnx overpass function to the function that takes its place
+    """
+    _install_dispatchers()
+    previous = getattr(_serving, 'handlers', None)
+    _serving.handlers = {**(previous or {}), **handlers}
+    try:
+        yield
+    finally:
+        _serving.handlers = previous
+
+class OverpassSource:
+    """
+    Data source that downloads the OpenStreetMap data live from the Overpass API through osmnx, this is the default source.
+    Every data source answers the same (point, dist, tags) and bbox queries, so the MapCreator does not know where the data comes from.
+    The requests are sent by a DownloadScheduler (retries with backoff, timeouts and mirrors) instead of by osmnx itself
+
+    Parameters:
+    scheduler: DownloadScheduler, sends the requests, None uses a DownloadScheduler with the default settings
+    """
+    def __init__(self, scheduler=None):
+        self.scheduler = scheduler if scheduler is not None else DownloadScheduler()
+
+    @contextmanager
+    def serving(self):
+        """Lets osmnx send its Overpass requests through the scheduler for the duration of the block, in this thread only"""
+        with _serving_with({'_overpass_request': self.scheduler.request}):
+            yield
+
+    def cache_id(self):
+        """Returns a string that identifies the data of this source, used in the keys of the stage cache"""
+        return 'overpass'
+
+    def prepare(self):
+        """Makes sure the source can answer queries, nothing to do for Overpass"""
+        pass
+
+    def features_from_point(self, point, dist, tags):
+        """Returns the features with the tags within the bbox of dist meters around the point"""
+        with self.serving():
+            return ox.features_from_point(point, tags=tags, dist=dist)
+
+    def features_from_bbox(self, bbox, tags):
+        """Returns the features with the tags within the (north, south, east, west) bbox"""
+        with self.serving():
+            return ox.features_from_bbox(bbox=bbox, tags=tags)
+
+    def graph_from_point(self, point, dist, network_type='all'):
+        """Returns the road network graph within the bbox of dist meters around the point"""
+        with self.serving():
+            return ox.graph_from_point(point, dist=dist, network_type=network_type)
+
+    def graph_from_bbox(self, bbox, network_type='all', retain_all=False, truncate_by_edge=False):
+        """Returns the road network graph within the (north, south, east, west) bbox"""
+        with self.serving():
+            return ox.graph_from_bbox(bbox=bbox, network_type=network_type, retain_all=retain_all, truncate_by_edge=truncate_by_edge)
+
+# one condition of an Overpass way filter like ["highway"]["area"!~"yes"]
+_FILTER_CONDITION = re.compile(r'\[\s*"([^"]+)"\s*(?:(=|!=|~|!~)\s*"([^"]*)"\s*)?\]')
+
+def tags_match(element_tags, tags):
+    """
+    Returns True when the element has at least one of the requested tags, the same way osmnx asks Overpass for them
+
+    Parameters:
+    element_tags: dict, tags of the osm element
+    tags: dict, requested tags, a value is True (any value), a string or a list of strings
+    """
+    for key, value in tags.items():
+        if key not in element_tags:
+            continue
+        if value is True or (isinstance(value, str) and element_tags[key] == value) or (isinstance(value, list) and element_tags[key] in value):
+            return True
+    return False
+
+def filter_match(element_tags, osm_filter):
+    """
+    Returns True when the element passes every condition of an Overpass way filter, as used by osmnx for the network types
+
+    Parameters:
+    element_tags: dict, tags of the osm element
+    osm_filter: str, Overpass filter, for example ["highway"]["area"!~"yes"]
+    """
+    for key, operator, value in _FILTER_CONDITION.findall(osm_filter):
+        present = key in element_tags
+        if operator == '':
+            passed = present
+        elif operator == '=':
+            passed = present and element_tags[key] == value
+        elif operator == '!=':
+            passed = not present or element_tags[key] != value
+        elif operator == '~':
+            passed = present and re.search(value, element_tags[key]) is not None
+        else:
+            passed = not present or re.search(value, element_tags[key]) is None
+        if not passed:
+            return False
+    return True
+
+# bump this when the layout of the index of an extract changes, so old indexes are built again
+EXTRACT_INDEX_VERSION = 2
+
+# nodes are filtered in blocks of this many nodes while the extract is read, so only the needed ones are ever kept
+NODE_BLOCK_SIZE = 1000000
+
+def positions_of(ids, sorted_ids, order):
+    """
+    Returns the positions of the ids in an array of ids and whether they were found, with searchsorted instead of a dict of every id
+
+    Parameters:
+    ids: array, ids to look up
+    sorted_ids: array, the ids of the array sorted
+    order: array, positions in the array of the sorted ids (argsort of the array), None when the array itself is sorted
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(sorted_ids) == 0:
+        return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+    positions = np.clip(np.searchsorted(sorted_ids, ids), 0, len(sorted_ids) - 1)
+    found = sorted_ids[positions] == ids
+    return (positions if order is None else order[positions]), found
+
+class LocalExtractSource(OverpassSource):
+    """
+    Data source that reads a local .osm.pbf extract (for example the Netherlands or Limburg from Geofabrik), for air-gapped machines
+    and to not depend on the rate limits of Overpass.
+    The extract is read once into an index of the nodes, ways and relations with the keys (plus everything they refer to),
+    with a spatial index over the ways and relations and the tagged nodes sorted by longitude. The ids and coordinates are kept in numpy arrays. The index is saved in index_dir, so the pbf is only read again when it changes.
+    Queries are answered from the index with the same elements Overpass would return, and osmnx builds the GeoDataFrames
+    and graphs from them exactly like it does for Overpass, so switching sources does not change the results.
+    Reading the pbf needs the optional pyosmium package (pip install osmium)
+
+    Parameters:
+    pbf_path: str, path to the .osm.pbf extract
+    keys: tuple, osm keys of the features that can be queried, highway is needed for the road network
+    index_dir: str, directory where the index of the extract is stored
+    """
+    def __init__(self, pbf_path, keys=('building', 'waterway', 'highway'), index_dir='cache/extracts'):
+        self.pbf_path = pbf_path
+        self.keys = tuple(keys)
+        self.index_dir = index_dir
+        self.index = None
+
+    def __getstate__(self):
+        # the loaded index is not sent to worker processes, they load it from disk themselves
+        state = self.__dict__.copy()
+        state['index'] = None
+        return state
+
+    def cache_id(self):
+        """Returns a string that identifies the extract, it changes when the pbf file changes"""
+        stat = os.stat(self.pbf_path)
+        return f'extract:{os.path.abspath(self.pbf_path)}:{int(stat.st_mtime)}:{stat.st_size}:{",".join(self.keys)}'
+
+    def index_path(self):
+        """Returns the path of the index file of the extract"""
+        key = hashlib.sha256(f'{EXTRACT_INDEX_VERSION}:{self.cache_id()}'.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.index_dir, f'extract_{key}.pkl')
+
+    def prepare(self):
+        """Loads the index of the extract, builds and saves it first when the extract was not read before"""
+        if self.index is not None:
+            return
+        if os.path.exists(self.index_path()):
+            with open(self.index_path(), 'rb') as f:
+                self.index = pickle.load(f)
+        else:
+            self.index = self.build_index()
+            os.makedirs(self.index_dir, exist_ok=True)
+            # every process writes its own temporary file, several pools can read the same extract for the first time at once
+            fd, tmp_path = tempfile.mkstemp(dir=self.index_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(self.index, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, self.index_path())
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+        # the spatial indexes are rebuilt on load, they are fast to build and not stored
+        self.index['way_tree'] = shapely.STRtree(shapely.box(*self.index['way_bounds'].T))
+        self.index['relation_tree'] = shapely.STRtree(shapely.box(*self.index['relation_bounds'].T))
+
+    def build_index(self):
+        """Reads the extract in three passes (relations, ways, nodes) so only the elements that are needed are kept"""
+        try:
+            import osmium
+        except ImportError:
+            raise ImportError("Reading .osm.pbf extracts needs pyosmium, install it with: pip install osmium")
+
+        print(f"Reading relations from {self.pbf_path}..")
+        relations = []
+        member_ways = osmium.index.IdSet()
+        member_nodes = array('q')
+        for relation in osmium.FileProcessor(self.pbf_path, osmium.osm.RELATION).with_filter(osmium.filter.KeyFilter(*self.keys)):
+            members = [(member.type, member.ref, member.role) for member in relation.members]
+            relations.append((relation.id, dict(relation.tags), members))
+            for member_type, ref, _ in members:
+                if member_type == 'w':
+                    member_ways.set(ref)
+                elif member_type == 'n':
+                    member_nodes.append(ref)
+
+        print(f"Reading ways from {self.pbf_path}..")
+        way_ids, way_tags, way_refs, way_lengths = array('q'), [], array('q'), array('q')
+        for way in osmium.FileProcessor(self.pbf_path, osmium.osm.WAY):
+            if member_ways.get(way.id) or any(key in way.tags for key in self.keys):
+                refs = [node.ref for node in way.nodes]
+                way_ids.append(way.id)
+                way_tags.append(dict(way.tags))
+                way_refs.extend(refs)
+                way_lengths.append(len(refs))
+        way_refs = np.frombuffer(way_refs, dtype=np.int64) if len(way_refs) > 0 else np.zeros(0, dtype=np.int64)
+        member_nodes = np.frombuffer(member_nodes, dtype=np.int64) if len(member_nodes) > 0 else np.zeros(0, dtype=np.int64)
+        needed_nodes = np.unique(np.concatenate([way_refs, member_nodes]))
+
+        print(f"Reading nodes from {self.pbf_path}..")
+        node_ids, node_lats, node_lons, node_tags = [], [], [], {}
+        tagged_nodes = array('q')
+        block_ids, block_lats, block_lons, block_tagged, block_tags = array('q'), array('d'), array('d'), array('b'), {}
+
+        def keep_block():
+            # the needed nodes of the block are found at once, plus the ones with the keys
+            ids = np.frombuffer(block_ids, dtype=np.int64)
+            keep = np.isin(ids, needed_nodes) | np.frombuffer(block_tagged, dtype=np.int8).astype(bool)
+            for node_id in ids[keep].tolist():
+                if node_id in block_tags:
+                    node_tags[node_id] = block_tags[node_id]
+            node_ids.append(ids[keep].copy())
+            node_lats.append(np.frombuffer(block_lats, dtype=float)[keep].copy())
+            node_lons.append(np.frombuffer(block_lons, dtype=float)[keep].copy())
+
+        for node in osmium.FileProcessor(self.pbf_path, osmium.osm.NODE):
+            block_ids.append(node.id)
+            block_lats.append(node.location.lat)
+            block_lons.append(node.location.lon)
+            tagged = any(key in node.tags for key in self.keys)
+            block_tagged.append(tagged)
+            if tagged:
+                tagged_nodes.append(node.id)
+            if len(node.tags) > 0:
+                block_tags[node.id] = dict(node.tags)
+            if len(block_ids) >= NODE_BLOCK_SIZE:
+                keep_block()
+                block_ids, block_lats, block_lons, block_tagged, block_tags = array('q'), array('d'), array('d'), array('b'), {}
+        if len(block_ids) > 0:
+            keep_block()
+
+        # nodes sorted by id, so the nodes of a way are found with searchsorted
+        node_ids = np.concatenate(node_ids) if node_ids else np.zeros(0, dtype=np.int64)
+        order = np.argsort(node_ids)
+        node_ids = node_ids[order]
+        node_lats = (np.concatenate(node_lats) if node_lats else np.zeros(0))[order]
+        node_lons = (np.concatenate(node_lons) if node_lons else np.zeros(0))[order]
+
+        way_ids = np.frombuffer(way_ids, dtype=np.int64).copy() if len(way_ids) > 0 else np.zeros(0, dtype=np.int64)
+        way_offsets = np.concatenate([[0], np.cumsum(np.frombuffer(way_lengths, dtype=np.int64) if len(way_lengths) > 0 else [])]).astype(np.int64)
+        way_bounds = self.bounds_of_refs(way_refs, way_offsets, node_ids, node_lats, node_lons)
+        way_order = np.argsort(way_ids)
+        sorted_way_ids = way_ids[way_order]
+
+        # a relation covers the bounds of its member ways and nodes
+        relation_bounds = np.full((len(relations), 4), np.nan)
+        for position, (_, _, members) in enumerate(relations):
+            way_positions, found = positions_of([ref for member_type, ref, _ in members if member_type == 'w'], sorted_way_ids, way_order)
+            member_bounds = list(way_bounds[way_positions[found]])
+            node_refs = np.array([ref for member_type, ref, _ in members if member_type == 'n'], dtype=np.int64)
+            if len(node_refs) > 0:
+                member_bounds.append(self.bounds_of_refs(node_refs, np.array([0, len(node_refs)]), node_ids, node_lats, node_lons)[0])
+            if member_bounds:
+                member_bounds = np.array(member_bounds)
+                relation_bounds[position] = [np.nanmin(member_bounds[:, 0]), np.nanmin(member_bounds[:, 1]), np.nanmax(member_bounds[:, 2]), np.nanmax(member_bounds[:, 3])]
+
+        # the tagged nodes with their coordinates, sorted by longitude so a query only looks at the strip of its bounds
+        tagged_nodes = np.sort(np.frombuffer(tagged_nodes, dtype=np.int64)) if len(tagged_nodes) > 0 else np.zeros(0, dtype=np.int64)
+        tagged_positions, _ = positions_of(tagged_nodes, node_ids, None)
+        tagged_order = np.argsort(node_lons[tagged_positions], kind='stable')
+        tagged_nodes = tagged_nodes[tagged_order]
+        tagged_lons = node_lons[tagged_positions][tagged_order]
+        tagged_lats = node_lats[tagged_positions][tagged_order]
+
+        print(f"Extract indexed: {len(node_ids)} nodes, {len(way_ids)} ways, {len(relations)} relations")
+        return {
+            'node_ids': node_ids, 'node_lats': node_lats, 'node_lons': node_lons, 'node_tags': node_tags,
+            'tagged_nodes': tagged_nodes, 'tagged_lons': tagged_lons, 'tagged_lats': tagged_lats,
+            'way_ids': way_ids, 'way_order': way_order, 'sorted_way_ids': sorted_way_ids, 'way_tags': way_tags, 'way_refs': way_refs,
+            'way_offsets': way_offsets, 'way_bounds': way_bounds, 'relations': relations, 'relation_bounds': relation_bounds
+        }
+
+    @staticmethod
+    def bounds_of_refs(refs, offsets, node_ids, node_lats, node_lons):
+        """Returns (minx, miny, maxx, maxy) per group of node refs, groups without known nodes get nan bounds"""
+        bounds = np.full((len(offsets) - 1, 4), np.nan)
+        if len(node_ids) == 0 or len(refs) == 0:
+            return bounds
+        positions, found = positions_of(refs, node_ids, None)
+        lons = np.where(found, node_lons[positions], np.nan)
+        lats = np.where(found, node_lats[positions], np.nan)
+        non_empty = offsets[:-1] < offsets[1:]
+        starts = offsets[:-1][non_empty]
+        bounds[non_empty, 0] = np.fmin.reduceat(lons, starts)
+        bounds[non_empty, 1] = np.fmin.reduceat(lats, starts)
+        bounds[non_empty, 2] = np.fmax.reduceat(lons, starts)
+        bounds[non_empty, 3] = np.fmax.reduceat(lats, starts)
+        return bounds
+
+    def node_elements(self, ids):
+        """Returns the Overpass json elements of the nodes (ids as an array or a list), nodes that are not in the extract are left out"""
+        index = self.index
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        positions, found = positions_of(ids, index['node_ids'], None)
+        elements = []
+        for node_id, position in zip(ids[found].tolist(), positions[found].tolist()):
+            element = {'type': 'node', 'id': node_id, 'lat': float(index['node_lats'][position]), 'lon': float(index['node_lons'][position])}
+            if node_id in index['node_tags']:
+                element['tags'] = index['node_tags'][node_id]
+            elements.append(element)
+        return elements
+
+    def way_refs(self, position):
+        """Returns the node refs of the way at the position in the index"""
+        return self.index['way_refs'][self.index['way_offsets'][position]:self.index['way_offsets'][position + 1]]
+
+    def way_line(self, position):
+        """Returns the way as a line in lon/lat, nodes that are not in the extract are skipped"""
+        index = self.index
+        refs = self.way_refs(position)
+        positions, found = positions_of(refs, index['node_ids'], None)
+        positions = positions[found]
+        coordinates = np.column_stack([index['node_lons'][positions], index['node_lats'][positions]])
+        if len(coordinates) == 1:
+            return shapely.Point(coordinates[0])
+        return shapely.LineString(coordinates) if len(coordinates) > 1 else shapely.Point()
+
+    def ways_in_polygon(self, polygon, accept):
+        """Returns the index positions of the ways with at least one segment in the polygon (like Overpass) that pass accept(tags)"""
+        positions = []
+        for position in self.index['way_tree'].query(polygon).tolist():
+            if accept(self.index['way_tags'][position]) and self.way_line(position).intersects(polygon):
+                positions.append(position)
+        return positions
+
+    def tagged_nodes_in_polygon(self, polygon):
+        """Returns the ids of the tagged nodes in the polygon, only the nodes within the bounds of the polygon are tested"""
+        index = self.index
+        minx, miny, maxx, maxy = polygon.bounds
+        start, end = np.searchsorted(index['tagged_lons'], minx, side='left'), np.searchsorted(index['tagged_lons'], maxx, side='right')
+        lons, lats = index['tagged_lons'][start:end], index['tagged_lats'][start:end]
+        candidates = (lats >= miny) & (lats <= maxy)
+        inside = np.zeros(end - start, dtype=bool)
+        inside[candidates] = shapely.contains_xy(polygon, lons[candidates], lats[candidates])
+        return index['tagged_nodes'][start:end][inside]
+
+    def answer_features(self, polygon, tags):
+        """Yields the Overpass response for a features query, with the elements the osmnx query would select"""
+        self.prepare()
+        index = self.index
+        node_ids = []
+        way_positions = set()
+        relations = []
+
+        # tagged nodes inside the polygon
+        node_ids.append(np.array([node_id for node_id in self.tagged_nodes_in_polygon(polygon).tolist() if tags_match(index['node_tags'][node_id], tags)], dtype=np.int64))
+
+        # ways with the tags in the polygon, plus their nodes
+        way_positions.update(self.ways_in_polygon(polygon, lambda way_tags: tags_match(way_tags, tags)))
+
+        # relations with the tags that have a member in the polygon, plus their members and the nodes of the member ways
+        for position in index['relation_tree'].query(polygon).tolist():
+            relation_id, relation_tags, members = index['relations'][position]
+            if not tags_match(relation_tags, tags):
+                continue
+            member_way_positions, found = positions_of([ref for member_type, ref, _ in members if member_type == 'w'], index['sorted_way_ids'], index['way_order'])
+            member_way_positions = member_way_positions[found].tolist()
+            member_node_ids = np.array([ref for member_type, ref, _ in members if member_type == 'n'], dtype=np.int64)
+            member_nodes = self.node_elements(member_node_ids)
+            if any(self.way_line(way_position).intersects(polygon) for way_position in member_way_positions) or \
+               any(shapely.contains_xy(polygon, node['lon'], node['lat']) for node in member_nodes):
+                relations.append({'type': 'relation', 'id': relation_id, 'tags': relation_tags,
+                                  'members': [{'type': {'n': 'node', 'w': 'way', 'r': 'relation'}[member_type], 'ref': ref, 'role': role} for member_type, ref, role in members]})
+                way_positions.update(member_way_positions)
+                node_ids.append(member_node_ids)
+
+        ways = []
+        for position in sorted(way_positions):
+            refs = self.way_refs(position)
+            node_ids.append(refs)
+            ways.append({'type': 'way', 'id': int(index['way_ids'][position]), 'nodes': refs.tolist(), 'tags': index['way_tags'][position]})
+
+        yield {'elements': self.node_elements(np.concatenate(node_ids)) + ways + relations}
+
+    def answer_network(self, polygon, network_type, custom_filter):
+        """Yields the Overpass response for a network query, the ways passing the network filter in the polygon and their nodes"""
+        self.prepare()
+        osm_filter = custom_filter if custom_filter is not None else ox._overpass._get_osm_filter(network_type)
+        ways = []
+        node_ids = [np.zeros(0, dtype=np.int64)]
+        for position in self.ways_in_polygon(polygon, lambda way_tags: filter_match(way_tags, osm_filter)):
+            refs = self.way_refs(position)
+            node_ids.append(refs)
+            ways.append({'type': 'way', 'id': int(self.index['way_ids'][position]), 'nodes': refs.tolist(), 'tags': self.index['way_tags'][position]})
+
+        yield {'elements': self.node_elements(np.concatenate(node_ids)) + ways}
+
+    @contextmanager
+    def serving(self):
+        """Lets osmnx ask this extract instead of the Overpass API for the duration of the block, in this thread only"""
+        self.prepare()
+        with _serving_with({'_download_overpass_network': self.answer_network, '_download_overpass_features': self.answer_features}):
+            yield
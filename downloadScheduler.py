@@ -0,0 +1,185 @@
+import os
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import osmnx as ox
+import requests
+
+# public Overpass instances, the first one is the main endpoint and the others are only asked when it is slow or failing
+DEFAULT_OVERPASS_ENDPOINTS = [
+    'https://overpass-api.de/api',
+    'https://overpass.kumi.systems/api',
+    'https://overpass.private.coffee/api'
+]
+
+def default_endpoints():
+    """
+    Returns the Overpass endpoints to use when none are given. The OVERPASS_ENDPOINTS environment variable can hold a comma separated list
+    of urls to use instead of the public instances, for example a local Overpass server or the mock server of a load test
+    """
+    endpoints = os.environ.get('OVERPASS_ENDPOINTS', '')
+    return [endpoint.strip() for endpoint in endpoints.split(',') if endpoint.strip()] or list(DEFAULT_OVERPASS_ENDPOINTS)
+
+# status codes that mean the server is busy or broken right now, so asking again (or asking a mirror) can help
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+class TransientDownloadError(Exception):
+    """The download failed in a way that can succeed when it is tried again, like a timeout or a busy server"""
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class PermanentDownloadError(Exception):
+    """The download failed in a way that asking again will not fix, like a bad query, so it is not retried"""
+    pass
+
+class DownloadScheduler:
+    """
+    Sends the Overpass requests of osmnx with explicit timeouts, retries with jittered exponential backoff
+    and hedged requests to mirror endpoints.
+    Every attempt first asks the main endpoint, when it has not answered after hedge_delay seconds the next mirror is asked as well
+    (and so on), the first good answer is used. Errors are classified, a bad query is raised right away instead of retried.
+    The answers are stored in the osmnx cache under the url of the main endpoint, so the mirror that answered does not matter for the cache
+
+    Parameters:
+    endpoints: list, Overpass api urls, the first one is the main endpoint, the others are mirrors, None uses default_endpoints()
+    max_retries: int, max number of attempts
+    base_delay: float, delay in seconds before the second attempt, it doubles for every next attempt (with random jitter)
+    max_delay: float, max delay in seconds between two attempts
+    timeout: float, seconds an attempt may take in total, over all endpoints that are asked
+    hedge_delay: float, seconds to wait for an endpoint before also asking the next mirror, None never asks the mirrors
+    """
+    def __init__(self, endpoints=None, max_retries=5, base_delay=1, max_delay=30, timeout=180, hedge_delay=5):
+        self.endpoints = list(endpoints) if endpoints is not None else default_endpoints()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        self.stats = {'requests': 0, 'cache_hits': 0, 'attempts': 0, 'retries': 0, 'hedged': 0, 'answered_by': {}}
+        if len(self.endpoints) == 0:
+            raise ValueError("At least one Overpass endpoint is needed")
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """
+        Returns the seconds to wait before the next attempt, a random time up to base_delay * 2^attempt (full jitter)
+        so workers that failed at the same moment do not all come back at the same moment. A Retry-After of the server is respected
+
+        Parameters:
+        attempt: int, number of the attempt that failed, starting at 0
+        retry_after: float, seconds the server asked to wait, or None
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def post(self, endpoint, data):
+        """
+        Sends one request to one endpoint and returns the response json, errors are raised as Transient or PermanentDownloadError
+
+        Parameters:
+        endpoint: str, Overpass api url
+        data: dict, the form data of the request, with the query in 'data'
+        """
+        url = endpoint.rstrip('/') + '/interpreter'
+        try:
+            # the timeout and headers of the scheduler win over the ones in the requests_kwargs of osmnx, passing both raises a TypeError
+            response = requests.post(url, data=data, **{**ox.settings.requests_kwargs, 'timeout': self.timeout, 'headers': ox._downloader._get_http_headers()})
+        except (requests.Timeout, requests.ConnectionError) as e:
+            raise TransientDownloadError(f"{endpoint}: {type(e).__name__}")
+
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            retry_after = response.headers.get('Retry-After')
+            retry_after = float(retry_after) if retry_after is not None and retry_after.isdigit() else None
+            raise TransientDownloadError(f"{endpoint} responded {response.status_code} {response.reason}", retry_after)
+        if not response.ok:
+            # 400 is a bad query, other 4xx are a problem of the request too, asking again gives the same answer
+            raise PermanentDownloadError(f"{endpoint} responded {response.status_code} {response.reason}: {response.text[:500]}")
+
+        try:
+            response_json = response.json()
+        except ValueError:
+            raise TransientDownloadError(f"{endpoint} returned an answer that is not json")
+        # when the server runs out of time or memory it still answers 200, with the error in the remark and missing elements
+        if 'runtime error' in response_json.get('remark', ''):
+            raise TransientDownloadError(f"{endpoint} remarked: {response_json['remark']}")
+        return response_json
+
+    def hedged_post(self, data):
+        """
+        Asks the endpoints one after the other hedge_delay seconds apart until one of them answers, returns the first good answer.
+        Requests that lose are left to finish in the background, their answers are ignored
+
+        Parameters:
+        data: dict, the form data of the request, with the query in 'data'
+        """
+        executor = ThreadPoolExecutor(max_workers=len(self.endpoints))
+        deadline = time.monotonic() + self.timeout
+        pending = {}
+        errors = []
+        try:
+            pending[executor.submit(self.post, self.endpoints[0], data)] = self.endpoints[0]
+            next_endpoint = 1
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TransientDownloadError(f"No endpoint answered within {self.timeout} seconds")
+                can_hedge = next_endpoint < len(self.endpoints) and self.hedge_delay is not None
+                done, _ = wait(pending, timeout=min(self.hedge_delay, remaining) if can_hedge else remaining, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    endpoint = pending.pop(future)
+                    try:
+                        response_json = future.result()
+                    except TransientDownloadError as e:
+                        errors.append(e)
+                        continue
+                    self.stats['answered_by'][endpoint] = self.stats['answered_by'].get(endpoint, 0) + 1
+                    return response_json
+
+                if next_endpoint < len(self.endpoints) and (len(pending) == 0 or (len(done) == 0 and can_hedge)):
+                    # the endpoints that were asked failed or are slow, so the next mirror is asked as well
+                    if len(pending) > 0:
+                        self.stats['hedged'] += 1
+                        print(f"No answer after {self.hedge_delay} seconds, also asking {self.endpoints[next_endpoint]}..")
+                    pending[executor.submit(self.post, self.endpoints[next_endpoint], data)] = self.endpoints[next_endpoint]
+                    next_endpoint += 1
+                elif len(pending) == 0:
+                    # every endpoint failed, the longest Retry-After decides how long to wait before the next attempt
+                    retry_afters = [e.retry_after for e in errors if e.retry_after is not None]
+                    raise TransientDownloadError('; '.join(str(e) for e in errors), max(retry_afters) if retry_afters else None)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def request(self, data, pause=None, error_pause=None):
+        """
+        Returns the response json of an Overpass request, from the osmnx cache when it was asked before.
+        Has the same signature as the request function of osmnx so it can take its place, pause and error_pause are not used
+
+        Parameters:
+        data: dict, the form data of the request, with the query in 'data'
+        """
+        self.stats['requests'] += 1
+        url = self.endpoints[0].rstrip('/') + '/interpreter'
+        prepared_url = requests.Request('GET', url, params=data).prepare().url
+        cached_response_json = ox._downloader._retrieve_from_cache(prepared_url)
+        if cached_response_json is not None:
+            self.stats['cache_hits'] += 1
+            return cached_response_json
+
+        for attempt in range(self.max_retries):
+            self.stats['attempts'] += 1
+            try:
+                response_json = self.hedged_post(data)
+            except TransientDownloadError as e:
+                if attempt == self.max_retries - 1:
+                    raise TransientDownloadError(f"Failed to download after {self.max_retries} attempts: {e}")
+                delay = self.backoff_delay(attempt, e.retry_after)
+                self.stats['retries'] += 1
+                print(f"Attempt {attempt + 1} failed ({e}), retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
+                continue
+            ox._downloader._save_to_cache(prepared_url, response_json, True)
+            return response_json
@@ -0,0 +1,122 @@
+import numpy as np
+import shapely
+from pyproj import Transformer
+
+# exposure classes from high to low, a building is in the first class its score reaches
+EXPOSURE_CLASSES = [('high', 0.5), ('medium', 0.2), ('low', 0.0)]
+
+class FloodExposure:
+    """
+    Scores every building by how exposed it is to flooding from the waterways: the height of its ground (SRTM) above the water level
+    of the nearest waterway and its distance to that waterway. All buildings are scored at once, the nearest waterway of every building
+    comes from the spatial index of the waterways and the elevations are looked up as arrays, so this stays fast at city scale.
+
+    The score is (1 - height / max_height) * (1 - distance / max_distance), both parts clipped between 0 and 1, so a building at or
+    below the water level right next to the water scores 1 and a building max_height above the water or max_distance away scores 0.
+    The water level is the lowest elevation of the waterway within water_window meters of the point closest to the building,
+    an srtm point on a narrow waterway usually also covers some of its banks
+
+    Parameters:
+    buildings: GeoDataFrame, building layer
+    waterways: GeoDataFrame, waterway layer
+    epsg_code: int, epsg code of a projection in meters, like the UTM zone of the map
+    elevation_function: function, returns the elevations of arrays of latitudes and longitudes, like ElevationGrid.get_elevations
+    max_distance: float, meters from the water where the score reaches 0
+    max_height: float, meters above the water level where the score reaches 0
+    sample_spacing: float, meters between the points the elevation of the waterways is sampled at
+    water_window: float, meters along the waterway around the closest point the water level is taken from
+    """
+    def __init__(self, buildings, waterways, epsg_code, elevation_function, max_distance=500, max_height=5, sample_spacing=30, water_window=90):
+        self.buildings = buildings.reset_index(drop=True)
+        self.waterways = waterways.reset_index(drop=True)
+        self.epsg_code = epsg_code
+        self.elevation_function = elevation_function
+        self.max_distance = max_distance
+        self.max_height = max_height
+        self.sample_spacing = sample_spacing
+        self.water_window = water_window
+        self.to_latlon = Transformer.from_crs(epsg_code, 4326, always_xy=True)
+
+    def elevations(self, points):
+        """Returns the elevations of projected points"""
+        longitudes, latitudes = self.to_latlon.transform(shapely.get_x(points), shapely.get_y(points))
+        return np.asarray(self.elevation_function(latitudes, longitudes), dtype=float)
+
+    def water_levels(self, closest_points, waterways):
+        """
+        Returns the water level at the closest points on the waterways, the lowest elevation sampled along the waterways within water_window meters
+
+        Parameters:
+        closest_points: array, projected points on the waterways, one per building
+        waterways: array, projected geometries of the waterways the points are on
+        """
+        if len(closest_points) == 0:
+            return np.zeros(0)
+        samples = shapely.points(shapely.get_coordinates(shapely.segmentize(waterways, self.sample_spacing)))
+        # a waterway can run far outside the map, only the samples that can be in a window are looked up
+        min_x, min_y, max_x, max_y = shapely.total_bounds(closest_points)
+        samples = samples[shapely.intersects(shapely.box(min_x - self.water_window, min_y - self.water_window, max_x + self.water_window, max_y + self.water_window), samples)]
+        sample_elevations = self.elevations(samples)
+        # every closest point is matched with the samples near it at once, nan samples never become the lowest
+        point_index, sample_index = shapely.STRtree(samples).query(closest_points, predicate='dwithin', distance=self.water_window)
+        levels = np.full(len(closest_points), np.inf)
+        np.fmin.at(levels, point_index, np.where(np.isnan(sample_elevations[sample_index]), np.inf, sample_elevations[sample_index]))
+        levels[np.isinf(levels)] = np.nan
+        return levels
+
+    def analyze(self):
+        """
+        Returns the buildings with the columns ground_m, water_level_m, height_m (ground above the water level), water_m (distance to the nearest waterway),
+        waterway (name of the nearest waterway), score, exposure (high, medium, low, none or unknown without elevation) and rank (1 is the most exposed),
+        sorted by rank
+        """
+        result = self.buildings.copy()
+        count = len(result)
+        ground = np.full(count, np.nan)
+        water_level = np.full(count, np.nan)
+        distance = np.full(count, np.nan)
+        waterway = np.full(count, None, dtype=object)
+        if count > 0 and len(self.waterways) > 0:
+            buildings = self.buildings.geometry.to_crs(epsg=self.epsg_code).to_numpy()
+            waterways = self.waterways.geometry.to_crs(epsg=self.epsg_code).to_numpy()
+            ground = self.elevations(shapely.point_on_surface(buildings))
+            # the nearest waterway of every building within max_distance, the buildings further away are not exposed
+            (building_index, waterway_index), distances = shapely.STRtree(waterways).query_nearest(
+                buildings, max_distance=self.max_distance, return_distance=True, all_matches=False)
+            distance[building_index] = distances
+            # without buildings within max_distance of the water there is nothing to look up, no building is exposed
+            if len(building_index) > 0:
+                closest_points = shapely.get_point(shapely.shortest_line(buildings[building_index], waterways[waterway_index]), 1)
+                water_level[building_index] = self.water_levels(closest_points, waterways[np.unique(waterway_index)])
+                if 'name' in self.waterways.columns:
+                    waterway[building_index] = self.waterways['name'].astype(object).to_numpy()[waterway_index]
+
+        height = ground - water_level
+        near = ~np.isnan(distance)
+        score = np.zeros(count)
+        score[near] = np.clip(1 - height[near] / self.max_height, 0, 1) * np.clip(1 - distance[near] / self.max_distance, 0, 1)
+        score[near & np.isnan(height)] = np.nan # near the water without elevation, the exposure is unknown
+
+        exposure = np.full(count, 'none', dtype=object)
+        for name, threshold in reversed(EXPOSURE_CLASSES):
+            exposure[score > threshold if threshold == 0 else score >= threshold] = name
+        exposure[np.isnan(score)] = 'unknown'
+
+        result['ground_m'] = np.round(ground, 1)
+        result['water_level_m'] = np.round(water_level, 1)
+        result['height_m'] = np.round(height, 1)
+        result['water_m'] = np.round(distance, 1)
+        result['waterway'] = waterway
+        result['score'] = np.round(score, 3)
+        result['exposure'] = exposure
+        # the most exposed first, unknown scores last
+        order = np.lexsort((np.nan_to_num(distance, nan=np.inf), -np.nan_to_num(score, nan=-1)))
+        result = result.iloc[order].reset_index(drop=True)
+        result['rank'] = np.arange(1, count + 1)
+        return result
+
+    @staticmethod
+    def summary(exposure):
+        """Returns the number of buildings per exposure class"""
+        counts = exposure['exposure'].value_counts()
+        return {name: int(counts.get(name, 0)) for name in [name for name, _ in EXPOSURE_CLASSES] + ['none', 'unknown']}
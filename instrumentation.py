@@ -0,0 +1,256 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource # not available on windows, the rss is then left out
+except ImportError:
+    resource = None
+
+def peak_rss_bytes():
+    """Returns the highest resident memory of the process so far in bytes, None when the platform does not tell"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # linux gives kilobytes, macos gives bytes
+
+def current_rss_bytes():
+    """Returns the resident memory of the process right now in bytes, None when the platform does not tell"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def process_uptime_seconds():
+    """Returns the seconds since the process started (including starting python and the imports), None when /proc is not there (only linux has it)"""
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            # the name of the process is between brackets and can hold spaces, the start time is the 22nd field
+            started_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - started_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def escape_label(value):
+    """Returns a label value escaped for the Prometheus text format"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# the jobs with an open span in this process, tracemalloc and the rss are process-wide,
+# so they are only measured for a job while no other job is running at the same time
+_active_lock = threading.Lock()
+_active_jobs = {} # job id -> number of open spans
+_overlaps = [0] # number of times a job started while another job was running
+
+def enter_job(job_id):
+    """Marks the job as running, returns whether it is the only running job and the overlap count to compare with when the span ends"""
+    with _active_lock:
+        if job_id not in _active_jobs and _active_jobs:
+            _overlaps[0] += 1
+        _active_jobs[job_id] = _active_jobs.get(job_id, 0) + 1
+        return len(_active_jobs) == 1, _overlaps[0]
+
+def leave_job(job_id, overlaps_before):
+    """Marks the end of a span of the job, returns whether another job ran at some time during the span"""
+    with _active_lock:
+        shared = len(_active_jobs) > 1 or _overlaps[0] != overlaps_before
+        _active_jobs[job_id] -= 1
+        if _active_jobs[job_id] == 0:
+            del _active_jobs[job_id]
+        return shared
+
+class Instrumentation:
+    """
+    Records a span for every stage of a job: the wall time, the memory, and the counts the stage adds itself
+    (like the number of features, the bytes written and the download retries).
+    The rss is always measured, tracemalloc is optional because it makes python allocations a lot slower.
+    Both are process-wide: while other jobs run in the same process (like the threads of the Flask app) tracemalloc is skipped,
+    the rss is that of the whole process and the span is marked with shared_process=True
+    With a profile_dir the whole job can be run under cProfile, the profile is dumped as <profile_dir>/<job_id>.prof
+
+    Parameters:
+    job_id: str, id of the job the spans belong to
+    trace_memory: bool, if True the peak of the python allocations of every span is measured with tracemalloc
+    profile_dir: str, directory to dump a cProfile of the job in, None does not profile
+    """
+    def __init__(self, job_id, trace_memory=False, profile_dir=None):
+        self.job_id = job_id
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.spans = []
+        self.started = time.time()
+        self.status = 'running'
+        self.profile_path = None
+        self.peaks = [] # tracemalloc peak of every open span, the peak is reset for a nested span so the outer span keeps its own
+        self.parameters = {} # what the job was asked to make (location, area, heatmap cells), the CostEstimator learns from these
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Measures the code in the with block as a span, the yielded dict can be filled with counts by the code in the block.
+        The span is recorded also when the block raises, with the error in it
+
+        Parameters:
+        name: str, name of the span, like the name of the stage
+        attributes: extra values to record with the span
+        """
+        span = {'name': name, **attributes}
+        rss_before = peak_rss_bytes()
+        alone, overlaps_before = enter_job(self.job_id)
+        # another job would reset the peak of this one and count its allocations in it
+        trace = self.trace_memory and alone
+        started_tracing = trace and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if trace:
+            if self.peaks:
+                self.peaks[-1] = max(self.peaks[-1], tracemalloc.get_traced_memory()[1])
+            self.peaks.append(0)
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span['seconds'] = round(time.perf_counter() - start, 4)
+            shared = leave_job(self.job_id, overlaps_before)
+            if shared:
+                span['shared_process'] = True
+            if trace:
+                peak = max(self.peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if self.peaks:
+                    self.peaks[-1] = max(self.peaks[-1], peak)
+                if not shared:
+                    span['tracemalloc_peak_bytes'] = peak
+                if started_tracing:
+                    tracemalloc.stop()
+            rss_after = peak_rss_bytes()
+            if rss_after is not None:
+                span['peak_rss_bytes'] = rss_after
+                if not shared:
+                    span['peak_rss_growth_bytes'] = rss_after - rss_before
+            rss = current_rss_bytes()
+            if rss is not None:
+                span['rss_bytes'] = rss
+            self.spans.append(span)
+
+    @contextmanager
+    def profiling(self):
+        """Runs the with block under cProfile when there is a profile_dir and dumps the profile when it ends"""
+        if self.profile_dir is None:
+            yield None
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            self.profile_path = os.path.join(self.profile_dir, f'{self.job_id}.prof')
+            profiler.dump_stats(self.profile_path)
+            print(f"Profile of job {self.job_id} saved as {self.profile_path}, view it with python -m pstats {self.profile_path}")
+
+    def to_dict(self):
+        """Returns the spans of the job with the totals, as a json serializable dict"""
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'total_seconds': round(sum(span['seconds'] for span in self.spans if not span.get('nested')), 4),
+            'peak_rss_bytes': peak_rss_bytes(),
+            'bytes_written': sum(span.get('bytes_written', 0) for span in self.spans),
+            'output_bytes': sum(span.get('output_bytes', 0) for span in self.spans),
+            'retries': sum(span.get('retries', 0) for span in self.spans),
+            'profile': self.profile_path,
+            'parameters': self.parameters,
+            'spans': self.spans
+        }
+
+    def save(self, path):
+        """Saves the spans as json"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=4, default=str)
+
+class MetricsRegistry:
+    """
+    Adds up the spans of all jobs of the process into metrics and renders them in the Prometheus text format,
+    the Flask app serves them on /metrics. Only the totals are kept, so the memory does not grow with the number of jobs
+    """
+    def __init__(self):
+        self.lock = threading.RLock() # observe_job holds it while it calls increment and set
+        self.counters = {}
+        self.gauges = {}
+        self.help = {
+            'mapgen_jobs_total': ('counter', 'Number of finished map generation jobs'),
+            'mapgen_stage_runs_total': ('counter', 'Number of times a stage ran or came from the cache'),
+            'mapgen_stage_seconds_total': ('counter', 'Wall time spent in a stage'),
+            'mapgen_stage_features_total': ('counter', 'Number of features a stage produced'),
+            'mapgen_bytes_written_total': ('counter', 'Bytes of the files a stage wrote'),
+            'mapgen_download_retries_total': ('counter', 'Overpass requests that were retried'),
+            'mapgen_stage_last_seconds': ('gauge', 'Wall time of the last run of a stage'),
+            'mapgen_stage_peak_rss_bytes': ('gauge', 'Peak resident memory of the whole process (all jobs) at the end of the last run of a stage'),
+            'mapgen_job_last_seconds': ('gauge', 'Wall time of the last job'),
+            'mapgen_result_cache_requests_total': ('counter', 'Map requests answered from the result cache (hit) or by generating the map (miss)'),
+            'mapgen_budget_requests_total': ('counter', 'New map requests that fit the budget (accepted), were made lighter (degraded) or were rejected'),
+            'tile_proxy_requests_total': ('counter', 'Basemap tiles served by the tile proxy from the cache (hit), fetched from upstream (miss) or failed (error)'),
+            'app_first_response_seconds': ('gauge', 'Seconds from the start of the process until the app served its first response'),
+            'app_warm_up_seconds': ('gauge', 'Seconds the warm up of the app took before serving')
+        }
+
+    def increment(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, labels, value):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe_job(self, instrumentation):
+        """Adds the spans of a finished job to the metrics"""
+        report = instrumentation.to_dict()
+        with self.lock:
+            self.increment('mapgen_jobs_total', {'status': report['status']})
+            self.set('mapgen_job_last_seconds', {}, report['total_seconds'])
+            for span in report['spans']:
+                labels = {'stage': span['name']}
+                self.increment('mapgen_stage_runs_total', {**labels, 'cached': str(bool(span.get('cached', False))).lower()})
+                self.increment('mapgen_stage_seconds_total', labels, span['seconds'])
+                self.set('mapgen_stage_last_seconds', labels, span['seconds'])
+                if 'features' in span:
+                    self.increment('mapgen_stage_features_total', labels, span['features'])
+                if 'bytes_written' in span:
+                    self.increment('mapgen_bytes_written_total', labels, span['bytes_written'])
+                if 'retries' in span:
+                    self.increment('mapgen_download_retries_total', labels, span['retries'])
+                if 'peak_rss_bytes' in span:
+                    self.set('mapgen_stage_peak_rss_bytes', labels, span['peak_rss_bytes'])
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        with self.lock:
+            values = {**self.counters, **self.gauges}
+        lines = []
+        for name, (metric_type, description) in self.help.items():
+            samples = sorted((labels, value) for (metric_name, labels), value in values.items() if metric_name == name)
+            if not samples:
+                continue
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{escape_label(label)}"' for key, label in labels)
+                lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+# metrics of all jobs that ran in this process
+METRICS = MetricsRegistry()
@@ -0,0 +1,446 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks import meters_to_degrees, write_fake_hgt
+from downloadScheduler import DownloadScheduler
+from mockOverpassServer import MockOverpassServer
+
+LOAD_TEST_LATITUDE = 51.1797305 # Boschmolenplas
+LOAD_TEST_LONGITUDE = 5.8812762
+FIXTURES_DIR = 'loadTestFixtures'
+RESULTS_DIR = 'loadTestResults'
+REPOSITORY_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# the requests of a load test, every request picks a kind by weight. jitter moves the location randomly up to that many meters,
+# so the stage cache can not answer it and the whole map is generated, without jitter the same map is asked again
+DEFAULT_REQUEST_MIX = [
+    {'name': 'repeat', 'weight': 3, 'area': 300, 'jitter': 0},
+    {'name': 'fresh', 'weight': 1, 'area': 300, 'jitter': 400}
+]
+
+# first key of a query like way["highway"] or way['building'], the mock answers the features with that key
+_QUERY_KEY = re.compile(r'\[\s*["\']([^"\']+)["\']')
+
+def query_hash(query):
+    """Returns the name a recorded response of an Overpass query is stored under"""
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()[:24]
+
+def synthetic_elements(latitude=LOAD_TEST_LATITUDE, longitude=LOAD_TEST_LONGITUDE, radius=1000, road_spacing=80, buildings=2000, seed=0):
+    """
+    Returns Overpass json elements of a synthetic site: a grid of roads (ways that share the nodes where they cross, so they form a network),
+    buildings as closed ways and a waterway
+
+    Parameters:
+    latitude: float, latitude of the middle of the site
+    longitude: float, longitude of the middle of the site
+    radius: float, half the width of the site in meters
+    road_spacing: float, meters between the roads of the grid
+    buildings: int, number of buildings
+    seed: int, seed of the random generator
+    """
+    rng = random.Random(seed)
+    elements = []
+    next_id = [1]
+
+    def node(x, y, tags=None):
+        lon_offset, lat_offset = meters_to_degrees(latitude, x, y)
+        element = {'type': 'node', 'id': next_id[0], 'lat': round(latitude + lat_offset, 7), 'lon': round(longitude + lon_offset, 7)}
+        if tags:
+            element['tags'] = tags
+        elements.append(element)
+        next_id[0] += 1
+        return element['id']
+
+    def way(nodes, tags):
+        elements.append({'type': 'way', 'id': next_id[0], 'nodes': nodes, 'tags': tags})
+        next_id[0] += 1
+
+    steps = [-radius + index * road_spacing for index in range(int(2 * radius // road_spacing) + 1)]
+    crossings = {(column, row): node(x, y) for column, x in enumerate(steps) for row, y in enumerate(steps)}
+    for index in range(len(steps)):
+        highway = 'primary' if index == len(steps) // 2 else 'residential'
+        way([crossings[(column, index)] for column in range(len(steps))], {'highway': highway, 'name': f'Street {index}'})
+        way([crossings[(index, row)] for row in range(len(steps))], {'highway': highway, 'name': f'Avenue {index}'})
+
+    for index in range(buildings):
+        x, y = rng.uniform(-radius, radius), rng.uniform(-radius, radius)
+        width, height = rng.uniform(6, 25) / 2, rng.uniform(6, 25) / 2
+        corners = [node(x - width, y - height), node(x + width, y - height), node(x + width, y + height), node(x - width, y + height)]
+        tags = {'building': rng.choice(['yes', 'house', 'apartments'])}
+        if index % 4 == 0:
+            tags['building:levels'] = str(rng.randint(1, 6))
+        way(corners + corners[:1], tags)
+
+    way([node(x, 60 * math.sin(x / 90)) for x in range(-radius, radius + 1, 40)], {'waterway': 'stream', 'name': 'Load test stream'})
+    return elements
+
+class FixtureOverpassServer(MockOverpassServer):
+    """
+    Mock Overpass api for load tests. A query is answered with its recorded response from fixture_dir when there is one
+    (see RecordingScheduler), otherwise with the synthetic elements that have the key of the query and the nodes they use
+
+    Parameters:
+    fixture_dir: str, directory with recorded responses as <query_hash>.json, None only answers synthetic elements
+    elements: list, synthetic Overpass elements, synthetic_elements() when None
+    delay: float, seconds every answer takes, to act like the latency of the real Overpass api
+    """
+    def __init__(self, fixture_dir=None, elements=None, delay=0, **kwargs):
+        super().__init__(elements=elements if elements is not None else synthetic_elements(), default={'delay': delay}, **kwargs)
+        self.fixture_dir = fixture_dir
+        self.nodes = {element['id']: element for element in self.elements if element['type'] == 'node'}
+        self.answers = {}
+
+    def answer(self, query):
+        if self.fixture_dir is not None:
+            path = os.path.join(self.fixture_dir, f'{query_hash(query)}.json')
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        match = _QUERY_KEY.search(query)
+        key = match.group(1) if match else None
+        if key not in self.answers:
+            ways = [element for element in self.elements if element['type'] == 'way' and key in element.get('tags', {})]
+            node_ids = sorted(set(node_id for way in ways for node_id in way['nodes']))
+            self.answers[key] = {'version': 0.6, 'generator': 'FixtureOverpassServer', 'elements': [self.nodes[node_id] for node_id in node_ids] + ways}
+        return self.answers[key]
+
+class RecordingScheduler(DownloadScheduler):
+    """
+    DownloadScheduler that also stores every response as a fixture, to replay real Overpass data in load tests without asking Overpass again
+
+    Parameters:
+    fixture_dir: str, directory to store the responses in as <query_hash>.json
+    kwargs: the parameters of DownloadScheduler
+    """
+    def __init__(self, fixture_dir=FIXTURES_DIR, **kwargs):
+        super().__init__(**kwargs)
+        self.fixture_dir = fixture_dir
+        os.makedirs(self.fixture_dir, exist_ok=True)
+
+    def request(self, data, pause=None, error_pause=None):
+        response_json = super().request(data, pause, error_pause)
+        with open(os.path.join(self.fixture_dir, f"{query_hash(data['data'])}.json"), 'w', encoding='utf-8') as f:
+            json.dump(response_json, f)
+        return response_json
+
+def record_fixtures(sites, fixture_dir=FIXTURES_DIR):
+    """
+    Generates the maps of the sites with the real Overpass api and stores every response as a fixture
+
+    Parameters:
+    sites: list, dicts with latitude, longitude, name and area like the form of the app
+    fixture_dir: str, directory to store the responses in
+    """
+    from dataSources import OverpassSource
+    from mapGenerator import MapCreator
+    for site in sites:
+        source = OverpassSource(RecordingScheduler(fixture_dir))
+        MapCreator(site['latitude'], site['longitude'], site['name'], site['area'], 150, 20, use_cache=False, data_source=source).create_detailed_map()
+    print(f"Recorded {len(os.listdir(fixture_dir))} responses in {fixture_dir}")
+
+def free_port():
+    """Returns a free local port"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def process_tree_rss(pid):
+    """Returns the total resident memory in bytes of a process and all its children, None when /proc is not there (only linux has it)"""
+    total, pending = 0, [pid]
+    try:
+        page_size = os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError):
+        return None
+    if not os.path.exists(f'/proc/{pid}'):
+        return None
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/statm', 'r') as f:
+                total += int(f.read().split()[1]) * page_size
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children', 'r') as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            continue # the process ended in between
+    return total
+
+class AppServer:
+    """
+    Runs app.py in a separate process with the werkzeug server, in a temporary working directory so the generated files
+    and caches of the load test do not mix with the real ones. Overpass and SRTM point at the stand-ins through the environment
+
+    Parameters:
+    workers: str, 'threads' for one threaded process or 'processes:<n>' for up to n forked processes at once (not on windows)
+    overpass_url: str, url of the mock Overpass api
+    srtm_dir: str, directory with the hgt files
+    port: int, port to listen on, None picks a free port
+    preload: bool, if True the app warms up before serving (APP_PRELOAD=1), so the forked workers start warm
+    """
+    def __init__(self, workers, overpass_url, srtm_dir, port=None, preload=False):
+        self.workers = workers
+        self.overpass_url = overpass_url
+        self.srtm_dir = srtm_dir
+        self.preload = preload
+        self.port = port or free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.process = None
+        self.work_dir = None
+        self.startup_seconds = None
+
+    def run_arguments(self):
+        """Returns the arguments of app.run for the worker configuration"""
+        if self.workers == 'threads':
+            return 'threaded=True'
+        if self.workers.startswith('processes:'):
+            return f"threaded=False, processes={int(self.workers.split(':')[1])}"
+        raise ValueError(f"Unknown worker configuration {self.workers}, use 'threads' or 'processes:<n>'")
+
+    def start(self, timeout=120):
+        """Starts the app and waits until it serves the index page, the time that took is kept in startup_seconds"""
+        self.work_dir = tempfile.mkdtemp(prefix='loadtest_app_')
+        environment = dict(os.environ, OVERPASS_ENDPOINTS=self.overpass_url, SRTM_CACHE_DIR=self.srtm_dir, PYTHONPATH=REPOSITORY_DIR, APP_PRELOAD='1' if self.preload else '0')
+        code = f"import app; app.app.run(host='127.0.0.1', port={self.port}, {self.run_arguments()})"
+        start = time.perf_counter()
+        self.process = subprocess.Popen([sys.executable, '-c', code], cwd=self.work_dir, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        while time.perf_counter() - start < timeout:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"The app stopped with exit code {self.process.returncode} while starting")
+            try:
+                if requests.get(self.url + '/', timeout=1).ok:
+                    self.startup_seconds = time.perf_counter() - start
+                    return self
+            except requests.RequestException:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError(f"The app did not start within {timeout} seconds")
+
+    def stop(self):
+        """Stops the app and removes its working directory"""
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self.work_dir is not None:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+class MemorySampler:
+    """Samples the rss of a process tree in a background thread and keeps the peak"""
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stopped.is_set():
+            rss = process_tree_rss(self.pid)
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+def percentile(values, fraction):
+    """Returns the percentile of the values with linear interpolation, None for no values"""
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * fraction
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def make_requests(count, mix, seed=0):
+    """Returns the form data of count requests, the kinds are drawn from the mix by weight"""
+    rng = random.Random(seed)
+    kinds = rng.choices(mix, weights=[kind['weight'] for kind in mix], k=count)
+    form_data = []
+    for index, kind in enumerate(kinds):
+        angle, distance = rng.uniform(0, 2 * math.pi), rng.uniform(0, kind['jitter'])
+        lon_offset, lat_offset = meters_to_degrees(LOAD_TEST_LATITUDE, distance * math.sin(angle), distance * math.cos(angle))
+        form_data.append((kind['name'], {
+            'latitude': f'{LOAD_TEST_LATITUDE + lat_offset:.7f}',
+            'longitude': f'{LOAD_TEST_LONGITUDE + lon_offset:.7f}',
+            'name': f"loadtest_{kind['name']}" if kind['jitter'] == 0 else f"loadtest_{kind['name']}_{index}",
+            'area': str(kind['area'])
+        }))
+    return form_data
+
+def drive(url, form_data, concurrency, timeout=600):
+    """
+    Sends the requests to /generate_map with concurrency clients at once and returns per request the kind, the latency, the status and the error
+
+    Parameters:
+    url: str, url of the app
+    form_data: list, (kind, form) of every request, from make_requests
+    concurrency: int, number of requests that are sent at the same time
+    timeout: float, seconds a request may take
+    """
+    def send(request):
+        kind, form = request
+        start = time.perf_counter()
+        try:
+            response = requests.post(url + '/generate_map', data=form, timeout=timeout)
+            status, error = response.status_code, None if response.ok else response.text[:200]
+        except requests.RequestException as e:
+            status, error = None, f"{type(e).__name__}: {e}"
+        return {'kind': kind, 'seconds': time.perf_counter() - start, 'status': status, 'error': error}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(send, form_data))
+
+def summarize(results, duration):
+    """Returns the throughput, the latency percentiles, the error rate and the errors of a run"""
+    latencies = [result['seconds'] for result in results]
+    errors = [result for result in results if result['error'] is not None]
+    error_counts = {}
+    for result in errors:
+        error_counts[str(result['status'])] = error_counts.get(str(result['status']), 0) + 1
+
+    def latency_summary(values):
+        return {
+            'p50_seconds': round(percentile(values, 0.50), 3) if values else None,
+            'p95_seconds': round(percentile(values, 0.95), 3) if values else None,
+            'p99_seconds': round(percentile(values, 0.99), 3) if values else None,
+            'mean_seconds': round(statistics.mean(values), 3) if values else None,
+            'max_seconds': round(max(values), 3) if values else None
+        }
+    return {
+        'requests': len(results),
+        'duration_seconds': round(duration, 3),
+        'throughput_per_second': round(len(results) / duration, 3) if duration > 0 else None,
+        'error_rate': round(len(errors) / len(results), 4) if results else 0.0,
+        'errors': error_counts,
+        'latency': latency_summary(latencies),
+        'latency_per_kind': {kind: latency_summary([result['seconds'] for result in results if result['kind'] == kind]) for kind in sorted(set(result['kind'] for result in results))}
+    }
+
+class LoadTest:
+    """
+    Load test of the Flask app without internet: a mock Overpass api answers recorded fixtures (or synthetic data) and the SRTM data is a synthetic hgt file.
+    For every worker configuration the app is started fresh, the requests are sent with the given concurrency and the throughput,
+    the p50/p95/p99 latency, the error rate and the peak memory of the app are reported
+
+    Parameters:
+    worker_configs: list, worker configurations of AppServer, like ['threads', 'processes:4']
+    concurrency: int, number of requests that are sent at the same time
+    requests_per_config: int, number of requests per worker configuration
+    mix: list, kinds of requests with name, weight, area and jitter, see DEFAULT_REQUEST_MIX
+    fixture_dir: str, directory with recorded Overpass responses, None only uses synthetic data
+    overpass_delay: float, seconds every Overpass answer takes
+    warmup_requests: int, requests sent before measuring, so the first imports and caches are not measured
+    preload: bool, if True the app warms up before serving, see AppServer
+    """
+    def __init__(self, worker_configs=('threads',), concurrency=4, requests_per_config=20, mix=DEFAULT_REQUEST_MIX, fixture_dir=None, overpass_delay=0, warmup_requests=1, preload=False):
+        self.worker_configs = list(worker_configs)
+        self.concurrency = concurrency
+        self.requests_per_config = requests_per_config
+        self.mix = mix
+        self.fixture_dir = fixture_dir
+        self.overpass_delay = overpass_delay
+        self.warmup_requests = warmup_requests
+        self.preload = preload
+
+    def run(self):
+        """Runs every worker configuration and returns the report"""
+        srtm_dir = tempfile.mkdtemp(prefix='loadtest_srtm_')
+        write_fake_hgt(srtm_dir, LOAD_TEST_LATITUDE, LOAD_TEST_LONGITUDE)
+        # the synthetic site has to cover the largest area plus the largest jitter
+        radius = max(kind['area'] + kind['jitter'] for kind in self.mix) + 100
+        report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'concurrency': self.concurrency, 'requests_per_config': self.requests_per_config,
+                  'mix': self.mix, 'fixtures': self.fixture_dir, 'overpass_delay': self.overpass_delay, 'preload': self.preload, 'configs': []}
+        try:
+            with FixtureOverpassServer(self.fixture_dir, synthetic_elements(radius=radius), delay=self.overpass_delay) as overpass:
+                for workers in self.worker_configs:
+                    print(f"Load testing with workers {workers} and {self.concurrency} concurrent requests..")
+                    with AppServer(workers, overpass.url, srtm_dir, preload=self.preload) as app_server:
+                        warmup = drive(app_server.url, make_requests(self.warmup_requests, self.mix, seed=-1), 1)
+                        form_data = make_requests(self.requests_per_config, self.mix)
+                        with MemorySampler(app_server.process.pid) as memory:
+                            start = time.perf_counter()
+                            results = drive(app_server.url, form_data, self.concurrency)
+                            duration = time.perf_counter() - start
+                        summary = summarize(results, duration)
+                        summary['workers'] = workers
+                        summary['startup_seconds'] = round(app_server.startup_seconds, 3)
+                        summary['first_map_seconds'] = round(warmup[0]['seconds'], 3) if warmup else None
+                        summary['peak_rss_bytes'] = memory.peak
+                        report['configs'].append(summary)
+                        print_summary(summary)
+                report['overpass_requests'] = len(overpass.requests)
+        finally:
+            shutil.rmtree(srtm_dir, ignore_errors=True)
+        return report
+
+    @staticmethod
+    def save(report, results_dir=RESULTS_DIR):
+        """Stores the report as loadtest_<time>.json in the results directory and returns the path"""
+        os.makedirs(results_dir, exist_ok=True)
+        path = os.path.join(results_dir, f"loadtest_{time.strftime('%Y%m%d%H%M%S')}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+        return path
+
+def print_summary(summary):
+    latency = summary['latency']
+    peak = f"{summary['peak_rss_bytes'] / 1e6:.0f} MB" if summary['peak_rss_bytes'] is not None else 'unknown'
+    print(f"  {summary['workers']}: {summary['throughput_per_second']} requests/s, p50 {latency['p50_seconds']}s, p95 {latency['p95_seconds']}s, "
+          f"p99 {latency['p99_seconds']}s, errors {summary['error_rate']:.1%}, peak memory {peak}, startup {summary['startup_seconds']}s, first map {summary['first_map_seconds']}s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load tests the Flask app against a local Overpass stand-in and synthetic SRTM data')
+    parser.add_argument('--workers', nargs='+', default=['threads'], help="worker configurations, 'threads' or 'processes:<n>'")
+    parser.add_argument('--concurrency', type=int, default=4, help='number of requests sent at the same time')
+    parser.add_argument('--requests', type=int, default=20, help='number of requests per worker configuration')
+    parser.add_argument('--mix', default=None, help='json file with the kinds of requests (name, weight, area, jitter), see DEFAULT_REQUEST_MIX')
+    parser.add_argument('--fixtures', default=None, help='directory with recorded Overpass responses, by default the answers are synthetic')
+    parser.add_argument('--overpass-delay', type=float, default=0, help='seconds every Overpass answer takes')
+    parser.add_argument('--record', default=None, help='json file with sites (latitude, longitude, name, area) to record fixtures for from the real Overpass api, then stop')
+    parser.add_argument('--preload', action='store_true', help='let the app warm up before serving (APP_PRELOAD=1)')
+    parser.add_argument('--results-dir', default=RESULTS_DIR, help='directory where the report is stored')
+    args = parser.parse_args()
+
+    if args.record is not None:
+        with open(args.record, 'r', encoding='utf-8') as f:
+            record_fixtures(json.load(f), args.fixtures or FIXTURES_DIR)
+        raise SystemExit(0)
+
+    mix = DEFAULT_REQUEST_MIX
+    if args.mix is not None:
+        with open(args.mix, 'r', encoding='utf-8') as f:
+            mix = json.load(f)
+    loadTest = LoadTest(args.workers, args.concurrency, args.requests, mix, args.fixtures, args.overpass_delay, preload=args.preload)
+    report = loadTest.run()
+    print(f"Report saved as {LoadTest.save(report, args.results_dir)}")
@@ -4,20 +4,162 @@ import folium
 import time
 import srtm
 from folium.plugins import HeatMap
+from pyproj import Transformer
 import os 
+import shutil
+import tempfile
+import uuid
 import numpy as np
+import pandas as pd
+import shapely
+import json
+import math
+import re
+from contextlib import contextmanager, nullcontext
+from stageCache import StageCache
+from dataSources import OverpassSource
+from downloadScheduler import DownloadScheduler
+from roadGraph import RoadGraph
+from cameraCoverage import CameraCoverage
+from cameraPlacement import CameraPlacement
+from viewshed import camera_viewsheds, polygon_to_latlngs
+from contours import elevation_contours
+from floodExposure import FloodExposure
+from instrumentation import Instrumentation, METRICS
+
+# the shared folders the generations publish to, made by init_directories when the first MapCreator is made (not when this module is imported)
+OUTPUT_DIRECTORIES = ['shpFiles', 'geoJsonFiles', 'static/maps', 'workspaces']
+
+# the job ids MapCreator makes, <time>_<random hex>, the published versions of a map end with one
+JOB_ID_PATTERN = r'\d{14}_[0-9a-f]{8}'
+
+# the published files that are not written when they would be empty (no contour lines, exposed buildings, blind spots or cameras),
+# the unversioned file of an earlier generation is removed then, so it does not look like the current one
+OPTIONAL_OUTPUTS = [('contours', 'geojson'), ('floodExposure', 'geojson'), ('blindSpots', 'geojson'), ('coverage', 'json')]
+
+def init_directories():
+    """Makes the shared output folders in the working directory when they do not exist yet"""
+    for directory in OUTPUT_DIRECTORIES:
+        os.makedirs(directory, exist_ok=True)
+
+def warm_up():
+    """
+    Loads what the first generation would otherwise load itself: the output folders, the srtm file list, the proj database,
+    the folium templates and the geopandas/shapely machinery. Meant for the parent process of a server before it forks its workers,
+    so every worker starts with it already in memory. Returns the seconds every step took
+    """
+    timings = {}
+    def step(name, function):
+        start = time.perf_counter()
+        function()
+        timings[name] = round(time.perf_counter() - start, 4)
+    step('directories', init_directories)
+    step('srtm', get_elevation_data)
+    step('proj', lambda: Transformer.from_crs(4326, 32631, always_xy=True).transform(5.88, 51.18))
+    step('geopandas', lambda: gpd.GeoDataFrame(geometry=[shapely.Point(5.88, 51.18)], crs=4326).to_crs(epsg=32631).buffer(10).to_crs(epsg=4326).to_json())
+    step('folium', lambda: folium.Map(location=[51.18, 5.88], zoom_start=8).get_root().render())
+    return timings
+
+def get_elevation_data():
+    """
+    Returns the srtm elevation data object. The SRTM_CACHE_DIR environment variable can point at a directory with hgt files
+    that is shared between processes (or filled beforehand for offline use), otherwise srtm's default cache in the home directory is used
+    """
+    return srtm.get_data(local_cache_dir=os.environ.get('SRTM_CACHE_DIR', ''))
+
+# Attribute schema per layer, applied right after downloading. Only the 'keep' columns are kept, 'rename' gives the osm tags
+# names that fit in a shapefile (max 10 characters) and the 'categorical' columns (after renaming) are stored as pandas categories
+# because they only hold a few repeated values. Set a layer to None to keep every column Overpass returns
+ATTRIBUTE_SCHEMAS = {
+    'buildings': {
+        'keep': ['element_type', 'osmid', 'building', 'name', 'amenity', 'shop', 'building:levels', 'height',
+                 'addr:street', 'addr:housenumber', 'addr:postcode', 'addr:city'],
+        'rename': {'element_type': 'osm_type', 'building:levels': 'levels', 'addr:street': 'street',
+                   'addr:housenumber': 'housenr', 'addr:postcode': 'postcode', 'addr:city': 'city'},
+        'categorical': ['osm_type', 'building', 'amenity', 'shop', 'city']
+    },
+    'roads': {
+        'keep': ['u', 'v', 'key', 'osmid', 'highway', 'name', 'oneway', 'maxspeed', 'lanes', 'length'],
+        'rename': {},
+        'categorical': ['highway', 'maxspeed', 'lanes']
+    },
+    'waterways': {
+        'keep': ['element_type', 'osmid', 'waterway', 'name', 'width'],
+        'rename': {'element_type': 'osm_type'},
+        'categorical': ['osm_type', 'waterway']
+    }
+}
+
+def is_missing(value):
+    """Returns True for None and nan values, these are left out of tooltips"""
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+def tooltip_content(properties, extra_data=None):
+    """Returns the tooltip of a feature, every property (and extra data) that is not null or nan on its own line"""
+    content = "<br>".join([f"{key}: {value}" for key, value in properties.items() if not is_missing(value)]) #lists all data not None in popup/tooltip
+    if extra_data is not None:
+        content += "<br>" + "<br>".join([f"{key}: {value}" for key, value in extra_data.items() if not is_missing(value)])
+    return content
 
-if not os.path.exists('shpFiles'):
-    os.makedirs('shpFiles')
+class AttributeProjector:
+    """
+    Applies the attribute schema of a layer right after downloading, this drops the hundreds of sparse osm tag columns
+    Overpass can return and stores repeated values as categories. The memory before and after is kept per layer in reports
 
-if not os.path.exists('geoJsonFiles'):
-    os.makedirs('geoJsonFiles')
+    Parameters:
+    schemas: dict, attribute schema per layer, see ATTRIBUTE_SCHEMAS
+    """
+    def __init__(self, schemas=ATTRIBUTE_SCHEMAS):
+        self.schemas = schemas if schemas is not None else {}
+        self.reports = {}
 
-if not os.path.exists('static'):
-    os.makedirs('static')
+    def apply(self, layer_name, gdf):
+        """
+        Returns the GeoDataFrame with only the columns of the schema of the layer, layers without a schema are returned as they are
 
-if not os.path.exists('static/maps'):
-    os.makedirs('static/maps')
+        Parameters:
+        layer_name: str, name of the layer, for example buildings
+        gdf: GeoDataFrame, the downloaded layer
+        """
+        schema = self.schemas.get(layer_name)
+        if schema is None:
+            return gdf
+
+        bytes_before = int(gdf.memory_usage(deep=True).sum())
+        columns_before = len(gdf.columns)
+
+        # the osm ids are in the index after downloading, they are kept as normal columns like a shapefile would
+        if any(name is not None for name in gdf.index.names):
+            gdf = gdf.reset_index()
+        keep = [column for column in schema['keep'] if column in gdf.columns]
+        gdf = gdf[keep + [gdf.geometry.name]].copy()
+
+        for column in keep:
+            # simplified roads can have lists of values, these can not be stored as categories or in a shapefile
+            if gdf[column].dtype == object:
+                gdf[column] = gdf[column].map(lambda value: ';'.join(str(item) for item in value) if isinstance(value, list) else value)
+        gdf = gdf.rename(columns=schema['rename'])
+        for column in schema['categorical']:
+            if column in gdf.columns:
+                gdf[column] = gdf[column].astype('category')
+
+        self.reports[layer_name] = {
+            'features': len(gdf),
+            'columns_before': columns_before,
+            'columns_after': len(gdf.columns),
+            'bytes_before': bytes_before,
+            'bytes_after': int(gdf.memory_usage(deep=True).sum())
+        }
+        print(f"{layer_name}: {columns_before} -> {len(gdf.columns)} columns, {bytes_before / 1e6:.2f} -> {self.reports[layer_name]['bytes_after'] / 1e6:.2f} MB")
+        return gdf
+
+    @staticmethod
+    def for_file(gdf):
+        """Returns a copy that can be written with to_file, the file drivers do not know about categories"""
+        categorical = [column for column in gdf.columns if isinstance(gdf[column].dtype, pd.CategoricalDtype)]
+        if not categorical:
+            return gdf
+        return gdf.astype({column: object for column in categorical})
 
 class MapStyler:
     """
@@ -51,6 +193,20 @@ class MapStyler:
     def style_buffer_area_road(x):
         return {'fillColor': 'red','color': 'purple','weight': 1,'fillOpacity': 0.2}
 
+    @staticmethod
+    def style_contours(x):
+        return {'color': 'saddlebrown', 'weight': 2 if x['properties']['major'] else 1, 'opacity': 0.8}
+
+    @staticmethod
+    def style_flood_exposure(x):
+        colors = {'high': '#d7191c', 'medium': '#fdae61', 'low': '#ffffbf', 'unknown': 'gray'}
+        color = colors.get(x['properties']['exposure'], 'gray')
+        return {'fillColor': color, 'color': color, 'weight': 1, 'fillOpacity': 0.7}
+
+    @staticmethod
+    def style_site_area(x):
+        return {'color': 'black', 'weight': 2, 'dashArray': '6 6', 'fill': False}
+
 class DataDownloader:
     """
     Downloads data from OpenStreetMap
@@ -59,30 +215,160 @@ class DataDownloader:
     latitude: float, latitude of the location
     longitude: float, longitude of the location
     dist: int, distance in meters to load the infrastructure data
-    max_retries: int, max number of retries to download the data
-    sleep_time: int, time in seconds to sleep between retries
+    max_retries: int, max number of attempts for a request, used when no source is given
+    sleep_time: float, delay in seconds before the second attempt, it doubles for every next attempt (with jitter), used when no source is given
+    source: OverpassSource or LocalExtractSource, where the data comes from, None downloads it from Overpass
+    instrumentation: Instrumentation, records a span for every download when given
     """
-    def __init__(self, latitude, longitude, dist=1000, max_retries=5, sleep_time=5):
+    def __init__(self, latitude, longitude, dist=1000, max_retries=5, sleep_time=1, source=None, instrumentation=None):
         
         self.point = (latitude, longitude)
         self.dist = dist
         self.max_retries = max_retries
         self.sleep_time = sleep_time
+        self.source = source if source is not None else OverpassSource(DownloadScheduler(max_retries=max_retries, base_delay=sleep_time))
+        self.instrumentation = instrumentation
+
+    def scheduler_stats(self):
+        """Returns a copy of the counters of the download scheduler of the source, empty for sources without one (like a local extract)"""
+        scheduler = getattr(self.source, 'scheduler', None)
+        return dict(scheduler.stats) if scheduler is not None else {}
+
+    def span(self, name, **attributes):
+        """Returns a span of the instrumentation for a download, the span is inside the span of the stage so it is marked as nested"""
+        if self.instrumentation is None:
+            return nullcontext({})
+        return self.instrumentation.span(name, nested=True, **attributes)
+
+    def measured_download(self, name, tags, download):
+        """Runs a download in a span with the number of features, the requests, the cache hits and the retries it took"""
+        with self.span(name, tags=json.dumps(tags, default=str)) as span:
+            before = self.scheduler_stats()
+            features = download()
+            after = self.scheduler_stats()
+            span['features'] = len(features)
+            for counter in ('requests', 'cache_hits', 'retries', 'hedged'):
+                if counter in after:
+                    span[counter] = after[counter] - before[counter]
+        return features
     
     def download_with_retry(self, tags):
         """
-        reattemps, because sometimes server fails, the point, dist and other settings are made when making the object
+        Downloads the features with the tags around the point, the point, dist and other settings are made when making the object.
+        The retries are done per request by the DownloadScheduler of the source, with backoff and mirrors,
+        errors that retrying does not fix (like a bad query) are raised right away
 
         Parameters:
         tags: dict, tags to filter the data
         """
-        for attempt in range(self.max_retries):
-            try:
-                return ox.features_from_point(self.point, tags=tags, dist=self.dist)
-            except:
-                print(f"Timeout on attempt {attempt + 1}. retrying in {self.sleep_time} seconds...")
-                time.sleep(self.sleep_time)  # retry after a while again
-        raise Exception("Failed to download")
+        return self.measured_download('download_features', tags, lambda: self.source.features_from_point(self.point, self.dist, tags))
+
+    def download_bbox_with_retry(self, bbox, tags):
+        """
+        Same as download_with_retry but for a bounding box instead of the point and dist of the object, used for the tiles of large areas.
+        An area without any matching features is not an error here, an empty GeoDataFrame is returned for it
+
+        Parameters:
+        bbox: tuple, (north, south, east, west) of the area
+        tags: dict, tags to filter the data
+        """
+        try:
+            return self.measured_download('download_features_bbox', tags, lambda: self.source.features_from_bbox(bbox, tags))
+        except ox._errors.InsufficientResponseError:
+            return gpd.GeoDataFrame(geometry=[], crs='EPSG:4326')
+
+def grid_range(origin, lower, upper, step):
+    """Returns the points of the global grid (origin + k * step) that fall within [lower, upper), so neighbouring tiles or sites never sample the same point"""
+    first = math.ceil(round((lower - origin) / step, 9))
+    last = math.ceil(round((upper - origin) / step, 9))
+    return origin + step * np.arange(first, last)
+
+class ElevationGrid:
+    """
+    Array backed SRTM elevation lookups. The hgt files are read once into numpy arrays,
+    so the elevation of a whole grid of points can be looked up at once instead of point by point.
+    The values are the same as srtm's get_elevation without approximation, missing values are nan
+
+    Parameters:
+    elevation_data: GeoElevationData, srtm data object, get_elevation_data() is used when None
+    """
+    def __init__(self, elevation_data=None):
+        self.elevation_data = elevation_data if elevation_data is not None else get_elevation_data()
+        self.tiles = {}
+
+    def get_tile(self, lat_floor, lon_floor):
+        """Returns the srtm file and its elevations as an array for the 1x1 degree square starting at lat_floor, lon_floor"""
+        if (lat_floor, lon_floor) not in self.tiles:
+            geo_elevation_file = self.elevation_data.get_file(lat_floor + 0.5, lon_floor + 0.5)
+            if geo_elevation_file is None:
+                self.tiles[(lat_floor, lon_floor)] = None
+            else:
+                side = geo_elevation_file.square_side
+                elevations = np.frombuffer(geo_elevation_file.data, dtype='>i2').reshape(side, side).astype(np.float32)
+                elevations[(elevations > 10000) | (elevations < -1000)] = np.nan # same limits as srtm uses for missing data
+                self.tiles[(lat_floor, lon_floor)] = (geo_elevation_file, elevations)
+        return self.tiles[(lat_floor, lon_floor)]
+
+    def get_elevations(self, latitudes, longitudes):
+        """
+        Returns the elevations of the points as a float array with the shape of the (broadcasted) inputs
+
+        Parameters:
+        latitudes: array, latitudes of the points
+        longitudes: array, longitudes of the points
+        """
+        latitudes, longitudes = np.broadcast_arrays(np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float))
+        result = np.full(latitudes.shape, np.nan, dtype=np.float32)
+        lat_floors = np.floor(latitudes)
+        lon_floors = np.floor(longitudes)
+        # one lookup per srtm file the points fall in, usually only one for a site
+        for lat_floor, lon_floor in set(zip(lat_floors.ravel().tolist(), lon_floors.ravel().tolist())):
+            tile = self.get_tile(lat_floor, lon_floor)
+            if tile is None:
+                continue
+            geo_elevation_file, elevations = tile
+            mask = (lat_floors == lat_floor) & (lon_floors == lon_floor)
+            rows = np.floor((geo_elevation_file.latitude + 1 - latitudes[mask]) * (geo_elevation_file.square_side - 1)).astype(int)
+            columns = np.floor((longitudes[mask] - geo_elevation_file.longitude) * (geo_elevation_file.square_side - 1)).astype(int)
+            result[mask] = elevations[rows, columns]
+        return result
+
+    def sample_grid(self, lat_min, lat_max, lon_min, lon_max, step=0.00005, origin=None):
+        """
+        Samples the elevation on a regular grid, returns the latitudes, the longitudes and a (latitudes x longitudes) array of elevations
+
+        Parameters:
+        lat_min, lat_max, lon_min, lon_max: float, bounds of the grid, the max bounds are not included
+        step: float, distance between the grid points in degrees
+        origin: tuple, (lat, lon) of a grid shared with other areas (see grid_range), None starts the grid at lat_min, lon_min
+        """
+        if origin is None:
+            latitudes = np.arange(lat_min, lat_max, step)
+            longitudes = np.arange(lon_min, lon_max, step)
+        else:
+            latitudes = grid_range(origin[0], lat_min, lat_max, step)
+            longitudes = grid_range(origin[1], lon_min, lon_max, step)
+        return latitudes, longitudes, self.get_elevations(latitudes[:, None], longitudes[None, :])
+
+    def resolution(self, latitude, longitude):
+        """Returns the distance in degrees between the points of the srtm file at the location (1/1200 for SRTM3, 1/3600 for SRTM1), None when there is no file"""
+        tile = self.get_tile(float(np.floor(latitude)), float(np.floor(longitude)))
+        return None if tile is None else 1 / (tile[0].square_side - 1)
+
+    def sample_native(self, lat_min, lat_max, lon_min, lon_max):
+        """
+        Samples the elevation once per srtm point within the bounds (in the middle of the square the point covers), so no point is repeated or skipped.
+        Returns the latitudes, the longitudes and the elevations like sample_grid, None when there is no srtm file
+
+        Parameters:
+        lat_min, lat_max, lon_min, lon_max: float, bounds of the grid
+        """
+        step = self.resolution((lat_min + lat_max) / 2, (lon_min + lon_max) / 2)
+        if step is None:
+            return None
+        latitudes = (np.arange(np.floor(lat_min / step), np.ceil(lat_max / step)) + 0.5) * step
+        longitudes = (np.arange(np.floor(lon_min / step), np.ceil(lon_max / step)) + 0.5) * step
+        return latitudes, longitudes, self.get_elevations(latitudes[:, None], longitudes[None, :])
     
 class JavaScriptInjector:
     """
@@ -127,10 +413,11 @@ class JavaScriptInjector:
         
         print(f"interactive marker js injected and map saved back as {map_file}")
 
-    def inject_camera_simulation_script(self, map_file, camera_latitude, camera_longitude, direction, width, reach, camera_name, video_source, cone_outline_color = 'red', cone_fill_color = 'orange', camera_outline_color = 'blue', camera_fill_color = 'lightblue'):
+    def inject_camera_simulation_script(self, map_file, camera_latitude, camera_longitude, direction, width, reach, camera_name, video_source, cone_outline_color = 'red', cone_fill_color = 'orange', camera_outline_color = 'blue', camera_fill_color = 'lightblue', cone_latlngs=None):
         """
         Inject script to show camera 'simulation', If pointing upwards angle1 would be the left bound and angle2 the right side.
         The cone shape is made by creating a polygon with a lot of points, the more points the smoother the shape.
+        When cone_latlngs is given (the viewshed of the camera) that shape is drawn instead of the plain cone.
 
         Parameters:
         map_file: str, path to the map file
@@ -145,6 +432,7 @@ class JavaScriptInjector:
         cone_fill_color: str, color of the fill of the cone
         camera_outline_color: str, color of the outline of the camera
         camera_fill_color: str, color of the fill of the camera
+        cone_latlngs: list, [lat, lng] rings of the part of the cone the camera can see (see polygon_to_latlngs), None draws the plain cone
         """
         
         with open(map_file, 'r', encoding='utf-8') as f:
@@ -191,6 +479,12 @@ class JavaScriptInjector:
     }
     latlongpairs.push([lat, lon]); // Close the polygon
 
+    // the part of the cone that is not hidden behind buildings and terrain, when it was computed
+    var viewshedLatLngs = {{ cone_latlngs }};
+    if (viewshedLatLngs !== null) {
+        latlongpairs = viewshedLatLngs;
+    }
+
     // make cone shape
     var cone_{{ camera_name }} = L.polygon(latlongpairs, {
         color: '{{ cone_outline_color }}',
@@ -248,6 +542,7 @@ class JavaScriptInjector:
         self.camera_simulation_script = self.camera_simulation_script.replace("{{ cone_fill_color }}", str(cone_fill_color))
         self.camera_simulation_script = self.camera_simulation_script.replace("{{ camera_name }}", str(camera_name))
         self.camera_simulation_script = self.camera_simulation_script.replace("{{ video_source }}", str(video_source))
+        self.camera_simulation_script = self.camera_simulation_script.replace("{{ cone_latlngs }}", json.dumps(cone_latlngs))
         self.modified_html_camera = html_content.replace("</html>", self.camera_simulation_script + "\n</html>")
 
         # save modified html back
@@ -560,6 +855,57 @@ class JavaScriptInjector:
 
         print(f"Passage simulation js injected and map saved back as {map_file}")
     
+    def inject_geojson_layer(self, map_file, geojson, layer_name):
+        """
+        Injects a geojson layer that is computed after the static map was rendered, like the isochrones.
+        The layer is added to the layer control of the map so it can be switched on and off like the other layers.
+        A feature can have a 'style' (leaflet path options) and a 'tooltip' in its properties
+
+        Parameters:
+        map_file: str, path to the map file
+        geojson: dict, geojson FeatureCollection
+        layer_name: str, name of the layer in the layer control
+        """
+        with open(map_file, 'r', encoding='utf-8') as f:
+            html_content = f.read()
+
+        self.geojson_layer_script = """
+<script>
+    var mapDiv = document.querySelector('.folium-map');
+    var mapDivId = mapDiv.id;
+    var mapObject = window[mapDivId];
+
+    (function() {
+        var layer = L.geoJSON({{ geojson }}, {
+            style: function(feature) {
+                return feature.properties.style || {};
+            },
+            onEachFeature: function(feature, featureLayer) {
+                if (feature.properties.tooltip) {
+                    featureLayer.bindTooltip(feature.properties.tooltip, {sticky: true});
+                }
+            }
+        }).addTo(mapObject);
+
+        // the layer control of folium is a global let, so it is only reachable by its name
+        {{ add_to_layer_control }}
+    })();
+</script>
+        """
+        # find the layer control folium made, without one the layer is only added to the map
+        layer_control = re.search(r'let (layer_control_[0-9a-f]+) = L\.control\.layers', html_content)
+        add_to_layer_control = f"{layer_control.group(1)}.addOverlay(layer, {json.dumps(layer_name)});" if layer_control else ""
+        self.geojson_layer_script = self.geojson_layer_script.replace("{{ geojson }}", json.dumps(geojson))
+        self.geojson_layer_script = self.geojson_layer_script.replace("{{ add_to_layer_control }}", add_to_layer_control)
+
+        self.modified_html_geojson_layer = html_content.replace("</html>", self.geojson_layer_script + "\n</html>") #modify the html by
+
+        # save modified html back
+        with open(map_file, 'w', encoding='utf-8') as f:
+            f.write(self.modified_html_geojson_layer)
+
+        print(f"{layer_name} layer js injected and map saved back as {map_file}")
+
 class MapCreator:
     """This class combines all elements into one so a map can be generated by using the create_detailed_map function
     Parameters:
@@ -569,8 +915,34 @@ class MapCreator:
     load_dist: int, distance in meters to load the infrastructure data
     water_buffer_size: int, size of the buffer around waterways
     road_buffer_size: int, size of the buffer around roads
+    cameras: list, dicts with the properties of the to be simulated cameras
+    passage_points: list, tuples with lat, lon of the to be simulated passage sensors
+    use_cache: bool, if True the results of every stage are cached on disk and reused when the inputs did not change
+    tile_size: int, when set and the area is larger than one tile, the area is processed in tiles of this size in meters (large area mode)
+    max_workers: int, number of processes used for the tiles, None uses the number of cores
+    job_id: str, id of this generation, used for the workspace and the published file names, a new unique id is made when None
+    keep_workspace: bool, if True the workspace of the job is not removed when the generation is finished (or failed)
+    versions_kept: int, number of versioned maps (with their layer files) of this name that are kept after publishing, the older ones are removed. None uses the MAP_VERSIONS_KEPT environment variable (default 10), 0 keeps all of them
+    attribute_schemas: dict, attribute schema per layer that is applied right after downloading, see ATTRIBUTE_SCHEMAS, None keeps every column
+    data_source: OverpassSource or LocalExtractSource (see dataSources.py), where the OpenStreetMap data comes from, None downloads it from Overpass
+    isochrone_minutes: list, travel times in minutes to show the reachable area for, an empty list shows no isochrones
+    isochrone_sources: str, where the isochrones start, 'passage_points', 'cameras' or 'both'
+    isochrone_speed_kph: float, one speed for all roads (like 5 for walking), None uses the speed of every road
+    use_viewsheds: bool, if True the cones of the cameras are cut to what they can see past the buildings and the terrain, in the map and in the coverage
+    camera_budget: int, when set this many cameras are placed automatically with CameraPlacement, on top of the cameras that are given
+    placement_options: dict, keyword arguments for CameraPlacement, like width, reach, directions and spacing
+    trace_memory: bool, if True the peak python allocations of every stage are measured with tracemalloc (slower)
+    profile_dir: str, directory to dump a cProfile of the whole generation in as <job_id>.prof, None does not profile
+    contour_interval: float, meters between the elevation contour lines, None shows no contour lines
+    altitude_heatmap: bool, if True the elevation is also shown as a heatmap, the contour lines are much smaller to ship and render
+    flood_exposure: bool, if True the buildings near the waterways are scored by their flood exposure with FloodExposure
+    flood_options: dict, keyword arguments for FloodExposure, like max_distance and max_height
+    heatmap_step: float, distance between the points of the elevation heatmap in degrees, a larger step is a smaller map
+    altitude_raster: bool, if True the elevation is shown as one image with a pixel per srtm point, much smaller than the heatmap for large areas
+    simplify_tolerance: float, when set the drawn roads, waterways, buildings and buffers are simplified with this tolerance in meters (the analyses use the full geometries)
+    tile_url: str, base url of a tile proxy (see tileProxy.py) to load the PDOK and CartoDB basemaps through, like /tiles, None loads them from the public servers
     """
-    def __init__(self, latitude, longitude, name, load_dist=2000, water_buffer_size = 150, road_buffer_size=20, cameras=[], passage_points=[]):
+    def __init__(self, latitude, longitude, name, load_dist=2000, water_buffer_size = 150, road_buffer_size=20, cameras=[], passage_points=[], use_cache=True, tile_size=None, max_workers=None, job_id=None, keep_workspace=False, attribute_schemas=ATTRIBUTE_SCHEMAS, data_source=None, isochrone_minutes=[2, 5, 10], isochrone_sources='passage_points', isochrone_speed_kph=None, use_viewsheds=True, camera_budget=None, placement_options=None, trace_memory=False, profile_dir=None, contour_interval=5, altitude_heatmap=True, flood_exposure=True, flood_options=None, heatmap_step=0.00005, altitude_raster=False, simplify_tolerance=None, tile_url=None, versions_kept=None):
         self.latitude = latitude
         self.longitude = longitude
         self.point = (latitude, longitude)
@@ -578,19 +950,61 @@ class MapCreator:
         self.load_dist = load_dist
         self.water_buffer_size = water_buffer_size
         self.road_buffer_size = road_buffer_size
-        self.dataDownloader = DataDownloader(self.latitude, self.longitude, dist=self.load_dist)
+        # every generation works in its own workspace, only finished files are published to the shared folders
+        self.job_id = job_id if job_id is not None else f"{time.strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        self.instrumentation = Instrumentation(self.job_id, trace_memory=trace_memory, profile_dir=profile_dir)
+        self.metrics = None # the spans of the generation, set when it is finished
+        self.data_source = data_source if data_source is not None else OverpassSource()
+        self.dataDownloader = DataDownloader(self.latitude, self.longitude, dist=self.load_dist, source=self.data_source, instrumentation=self.instrumentation)
         self.mapStyler = MapStyler()
         self.m = folium.Map(location=[self.latitude, self.longitude], zoom_start=8)
         self.javaScriptInjector = JavaScriptInjector()
-        self.map_name = f'static/maps/map_{self.name}.html'
+        self.keep_workspace = keep_workspace
+        self.versions_kept = versions_kept if versions_kept is not None else int(os.environ.get('MAP_VERSIONS_KEPT', 10))
+        self.workspace = os.path.join('workspaces', self.job_id)
+        init_directories()
+        os.makedirs(os.path.join(self.workspace, 'shpFiles'), exist_ok=True)
+        os.makedirs(os.path.join(self.workspace, 'geoJsonFiles'), exist_ok=True)
+        self.map_name = os.path.join(self.workspace, f'map_{self.name}.html') # the map is made here and published when finished
+        self.workspace_size = 0 # bytes in the workspace at the end of the last writing_span
+        self.published_files = []
         self.cameras = cameras
+        self.given_cameras = cameras # the cameras that were given, without the placed ones
         self.passage_points = passage_points
+        self.stageCache = StageCache(enabled=use_cache)
+        self.tile_size = tile_size
+        self.attribute_schemas = attribute_schemas
+        self.attributeProjector = AttributeProjector(attribute_schemas)
+        self.max_workers = max_workers
+        self.isochrone_minutes = isochrone_minutes
+        self.isochrone_sources = isochrone_sources
+        self.isochrone_speed_kph = isochrone_speed_kph
+        self.isochrone_areas = None # made by compute_isochrones, the tiled mode has no road graph so it shows no isochrones
+        self.use_viewsheds = use_viewsheds
+        self.camera_budget = camera_budget
+        self.placement_options = placement_options if placement_options is not None else {}
+        self.contour_interval = contour_interval
+        self.altitude_heatmap = altitude_heatmap
+        self.contours = None # made by compute_contours, the tiled mode shows no contour lines
+        self.elevation_grid = None # made by get_elevation_grid, shared by the heatmap, the viewsheds, the contour lines and the flood exposure
+        self.flood_exposure = flood_exposure
+        self.flood_options = flood_options if flood_options is not None else {}
+        self.flood_exposure_buildings = None # made by compute_flood_exposure, not in the tiled mode
+        self.heatmap_step = heatmap_step
+        self.altitude_raster = altitude_raster
+        self.simplify_tolerance = simplify_tolerance
+        self.tile_url = tile_url
+        self.instrumentation.parameters.update({'latitude': latitude, 'longitude': longitude, 'load_dist': load_dist, 'altitude_heatmap': altitude_heatmap,
+                                                'heatmap_step': heatmap_step, 'altitude_raster': altitude_raster, 'simplify_tolerance': simplify_tolerance})
+        self.placed_cameras = [] # made by place_cameras, not in the tiled mode
+        self.camera_viewsheds = None # made by compute_camera_viewsheds, not in the tiled mode
+        self.camera_coverage = None # made by compute_camera_coverage, not in the tiled mode
 
         # Base map is added automatically
 
         # Netherlands specific maps
         folium.TileLayer(
-            tiles='https://service.pdok.nl/brt/achtergrondkaart/wmts/v2_0/grijs/EPSG:3857/{z}/{x}/{y}.png',
+            tiles=self.basemap_url('pdok_grijs', 'https://service.pdok.nl/brt/achtergrondkaart/wmts/v2_0/grijs/EPSG:3857/{z}/{x}/{y}.png'),
             attr='PDOK',
             name='Nederland Grijs',
             overlay=False,
@@ -598,7 +1012,7 @@ class MapCreator:
         ).add_to(self.m)
 
         folium.TileLayer(
-            tiles='https://service.pdok.nl/brt/achtergrondkaart/wmts/v2_0/pastel/EPSG:3857/{z}/{x}/{y}.png',
+            tiles=self.basemap_url('pdok_pastel', 'https://service.pdok.nl/brt/achtergrondkaart/wmts/v2_0/pastel/EPSG:3857/{z}/{x}/{y}.png'),
             attr='PDOK',
             name='Nederland Pastel',
             overlay=False,
@@ -607,7 +1021,7 @@ class MapCreator:
 
         # Base map (English names)
         folium.TileLayer(
-            tiles='https://{s}.basemaps.cartocdn.com/rastertiles/voyager/{z}/{x}/{y}{r}.png',
+            tiles=self.basemap_url('carto_voyager', 'https://{s}.basemaps.cartocdn.com/rastertiles/voyager/{z}/{x}/{y}{r}.png'),
             attr='&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors & CartoDB',
             name='CartoDB Voyager',
             overlay=False
@@ -615,47 +1029,69 @@ class MapCreator:
 
         # Dark map
         folium.TileLayer(
-            tiles='cartodbdark_matter',
+            tiles=self.basemap_url('carto_dark_matter', 'cartodbdark_matter'),
             name='CartoDB Dark Matter',
             attr='&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors & CartoDB',
             overlay=False,
             control=True           
         ).add_to(self.m)
         
-    def download_road_network_data(self):
+    def basemap_url(self, source, public_tiles):
+        """Returns the tiles of a basemap for folium, through the tile proxy when there is a tile_url, otherwise the public tiles"""
+        if self.tile_url is None:
+            return public_tiles
+        return f"{self.tile_url.rstrip('/')}/{source}/{{z}}/{{x}}/{{y}}.png"
+
+    def download_road_network_data(self, bbox=None):
         """
-        Downloads road network data and saves it as shapefiles and geojson
+        Downloads the road network data around the point, or within the bbox (north, south, east, west) when given.
+        Within a bbox every part of the network is kept and an area without roads gives no roads instead of an error, like the other bbox downloads
         """
         print("Downloading road network..")
-        G = ox.graph_from_point(self.point, dist=self.load_dist, network_type='all')
+        with self.dataDownloader.span('download_road_network') as span:
+            if bbox is None:
+                G = self.data_source.graph_from_point(self.point, self.load_dist, network_type='all')
+            else:
+                try:
+                    G = self.data_source.graph_from_bbox(bbox, network_type='all', retain_all=True, truncate_by_edge=True)
+                except (ox._errors.InsufficientResponseError, ValueError):
+                    G = None
+            span['features'] = G.number_of_edges() if G is not None else 0
+        if G is None:
+            self.road_graph = None
+            self.gdf_roads = self.attributeProjector.apply('roads', gpd.GeoDataFrame(geometry=[], crs='EPSG:4326'))
+            return
+        self.road_graph = RoadGraph.from_graph(G) # compact form of the graph that is kept for the isochrones
 
         print("Converting road network to GeoDataFrame, getting the roads all prepared")
         self.gdf_roads = ox.graph_to_gdfs(G, nodes=False)
         if 'nodes' in self.gdf_roads.columns:
             self.gdf_roads = self.gdf_roads.drop(columns=['nodes'])
-        print("Saving shapefiles...")
-        self.gdf_roads.to_file(f'shpFiles/roads_{self.name}.shp', driver='ESRI Shapefile')
-        self.gdf_roads.to_file(f'geoJsonFiles/roads_{self.name}.geojson', driver='GeoJSON')
+        self.gdf_roads = self.attributeProjector.apply('roads', self.gdf_roads)
 
-    def download_building_data(self):
+    def download_building_data(self, bbox=None):
         """
-        Downloads building data and saves it as shapefiles and geojson
+        Downloads the building data around the point, or within the bbox (north, south, east, west) when given
         """
         print("Downloading buildings..")
-        self.buildings = self.dataDownloader.download_with_retry(tags={'building': True})
+        if bbox is None:
+            self.buildings = self.dataDownloader.download_with_retry(tags={'building': True})
+        else:
+            self.buildings = self.dataDownloader.download_bbox_with_retry(bbox, tags={'building': True})
         self.buildings = self.buildings[self.buildings.geometry.type == 'Polygon']
-        self.buildings.to_file(f'shpFiles/buildings_{self.name}.shp', driver='ESRI Shapefile')
-        self.buildings.to_file(f'geoJsonFiles/buildings_{self.name}.geojson', driver='GeoJSON')
+        self.buildings = self.attributeProjector.apply('buildings', self.buildings)
 
-    def download_waterway_data(self):
+    def download_waterway_data(self, bbox=None):
         """
-        Downloads waterway data and saves it as shapefiles and geojson
+        Downloads the waterway data around the point, or within the bbox (north, south, east, west) when given
         """
         print("Downloading waterways..")
-        self.waterways = self.dataDownloader.download_with_retry(tags={'waterway': True})
+        if bbox is None:
+            self.waterways = self.dataDownloader.download_with_retry(tags={'waterway': True})
+        else:
+            self.waterways = self.dataDownloader.download_bbox_with_retry(bbox, tags={'waterway': True})
         self.waterways = self.waterways[self.waterways.geometry.type == 'LineString']
-        self.waterways.to_file(f'shpFiles/waterways_{self.name}.shp', driver='ESRI Shapefile')
-        self.waterways.to_file(f'geoJsonFiles/waterways_{self.name}.geojson', driver='GeoJSON') 
+        self.waterways = self.attributeProjector.apply('waterways', self.waterways)
     
     def add_buildings_tooltips(self, buildings, buildings_fg, styler, extra_data=None):
         """
@@ -670,11 +1106,7 @@ class MapCreator:
         for _, building in buildings.iterrows():
             geometry = building.geometry
             properties = building.drop('geometry').to_dict() # gets properties
-
-            tooltip_content = "<br>".join([f"{key}: {value}" for key, value in properties.items() if value is not None and value is not np.nan]) #lists all data not None in popup/tooltip
-            if extra_data is not None:
-                tooltip_content += "<br>" + "<br>".join([f"{key}: {value}" for key, value in extra_data.items() if value is not None and value is not np.nan])
-            tooltip = folium.Tooltip(tooltip_content)
+            tooltip = folium.Tooltip(tooltip_content(properties, extra_data))
 
             folium.GeoJson(
                 geometry,
@@ -684,22 +1116,32 @@ class MapCreator:
         
         return buildings_fg
     
-    def render_altitude_heatmap(self):
-        """Renders altitude heatmap of the area with the use of SRTM data, 
-        heatmap will be drawn only to the edges of the loaded infrastructure"""
-        self.elevation_data = srtm.get_data()
-        # set bound to the outer part of the loaded infrastructure
+    def get_elevation_grid(self):
+        """Returns the ElevationGrid of the map, the srtm files are read once and shared by the heatmap, the viewsheds, the contour lines and the flood exposure"""
+        if self.elevation_grid is None:
+            self.elevation_data = get_elevation_data()
+            self.elevation_grid = ElevationGrid(self.elevation_data)
+        return self.elevation_grid
+
+    def elevation_bounds(self):
+        """Returns the lat_min, lat_max, lon_min and lon_max of the loaded infrastructure, the elevation is shown up to these edges"""
         self.lat_min = min(self.buildings.geometry.bounds.miny.min(), self.roads.geometry.bounds.miny.min())
         self.lat_max = max(self.buildings.geometry.bounds.maxy.max(), self.roads.geometry.bounds.maxy.max())
         self.lon_min = min(self.buildings.geometry.bounds.minx.min(), self.roads.geometry.bounds.minx.min())
         self.lon_max = max(self.buildings.geometry.bounds.maxx.max(), self.roads.geometry.bounds.maxx.max())
+        return self.lat_min, self.lat_max, self.lon_min, self.lon_max
+
+    def render_altitude_heatmap(self):
+        """Renders altitude heatmap of the area with the use of SRTM data, 
+        heatmap will be drawn only to the edges of the loaded infrastructure"""
+        # set bound to the outer part of the loaded infrastructure
+        self.elevation_bounds()
 
-        self.heatmap_data = []
-        for lat in np.arange(self.lat_min, self.lat_max, 0.00005):
-            for lon in np.arange(self.lon_min, self.lon_max, 0.00005):
-                altitude = self.elevation_data.get_elevation(lat, lon)
-                if altitude is not None:
-                    self.heatmap_data.append([lat, lon, altitude])
+        # the whole grid is looked up at once, missing values are left out like before
+        self.get_elevation_grid()
+        self.elevation_latitudes, self.elevation_longitudes, self.elevations = self.elevation_grid.sample_grid(self.lat_min, self.lat_max, self.lon_min, self.lon_max, self.heatmap_step)
+        self.instrumentation.parameters['heatmap_cells'] = int(self.elevations.size)
+        self.heatmap_data = self.grid_to_heatmap_data(self.elevation_latitudes, self.elevation_longitudes, self.elevations)
 
         gradient = {0.2: 'blue', 0.4: 'lime', 0.6: 'yellow', 0.8: 'orange', 1.0: 'red'}
         self.heatmap = HeatMap(self.heatmap_data, min_opacity=0.05, radius=15, blur=20, max_zoom=1, gradient=gradient)
@@ -715,14 +1157,248 @@ class MapCreator:
         # self.gdf_elevation_heatmap.to_file(f'geoJsonFiles/elevation_heatmap_{self.name}.geojson', driver='GeoJSON')
         # print(f"Heatmap creaated and also saved as GeoJSON as geoJsonFiles/elevation_heatmap_{self.name}.geojson ")
 
-    def render_buffer_area_road(self):
-        """Renders buffer area around roads and buildings nearby roads"""
+    def render_altitude_raster(self, bounds=None):
+        """
+        Renders the elevation as one png image with a pixel per srtm point, with the colors of the heatmap and transparent where the elevation is missing
+
+        Parameters:
+        bounds: tuple, lat_min, lat_max, lon_min, lon_max of the image, None uses the edges of the loaded infrastructure
+        """
+        grid = self.get_elevation_grid().sample_native(*(bounds if bounds is not None else self.elevation_bounds()))
+        if grid is None:
+            return
+        latitudes, longitudes, elevations = grid
+        self.instrumentation.parameters['raster_cells'] = int(elevations.size)
+        half_step = self.elevation_grid.resolution(self.latitude, self.longitude) / 2
+        bounds = [[latitudes[0] - half_step, longitudes[0] - half_step], [latitudes[-1] + half_step, longitudes[-1] + half_step]]
+        self.elevation_raster = folium.FeatureGroup(name="Elevation raster")
+        # the first row is the most southern one, the image is stretched from lat/lon to web mercator like the map
+        folium.raster_layers.ImageOverlay(self.elevation_image(elevations), bounds=bounds, origin='lower', mercator_project=True, opacity=0.5).add_to(self.elevation_raster)
+        self.elevation_raster.add_to(self.m)
+
+    @staticmethod
+    def elevation_image(elevations):
+        """Returns an rgba image of an elevation grid from blue (lowest) to red (highest), like the gradient of the heatmap"""
+        finite = np.isfinite(elevations)
+        low, high = (np.nanmin(elevations), np.nanmax(elevations)) if finite.any() else (0, 1)
+        scaled = np.where(finite, (elevations - low) / ((high - low) or 1), 0)
+        stops = [0, 0.25, 0.5, 0.75, 1]
+        colors = np.array([[0, 0, 255], [0, 255, 0], [255, 255, 0], [255, 165, 0], [255, 0, 0]], dtype=float) # blue, lime, yellow, orange, red
+        image = np.zeros(elevations.shape + (4,), dtype=np.uint8)
+        for channel in range(3):
+            image[..., channel] = np.interp(scaled, stops, colors[:, channel])
+        image[..., 3] = np.where(finite, 255, 0)
+        return image
+
+    def display_layer(self, layer):
+        """Returns a layer (GeoDataFrame, GeoSeries or geometry in lat/lon) to draw, simplified with simplify_tolerance meters when it is set"""
+        if self.simplify_tolerance is None or layer is None:
+            return layer
+        # a degree of latitude is 111 km, the tolerance is kept in meters in the north-south direction
+        tolerance = self.simplify_tolerance / 111320
+        if isinstance(layer, gpd.GeoDataFrame):
+            return layer.set_geometry(layer.geometry.simplify(tolerance, preserve_topology=True))
+        if isinstance(layer, gpd.GeoSeries):
+            return layer.simplify(tolerance, preserve_topology=True)
+        return shapely.simplify(layer, tolerance, preserve_topology=True)
+
+    def compute_contours(self):
+        """
+        Computes the elevation contour lines every contour_interval meters up to the edges of the loaded infrastructure.
+        The grid is sampled once per srtm point (finer samples only repeat the same values), with the srtm files the map already read
+        """
+        self.contours = None
+        if self.contour_interval is None:
+            return
+        start = time.perf_counter()
+        grid = self.get_elevation_grid().sample_native(*self.elevation_bounds())
+        if grid is None:
+            return
+        self.contours = elevation_contours(*grid, interval=self.contour_interval)
+        print(f"{len(self.contours)} contour lines computed in {time.perf_counter() - start:.2f} seconds")
+
+    def render_contours(self):
+        """Renders the contour lines as one GeoJson layer with the elevation as tooltip, every fifth line is thicker"""
+        if self.contours is None or len(self.contours) == 0:
+            return
+        self.contours_fg = folium.FeatureGroup(name='Elevation contours')
+        folium.GeoJson(self.contours, style_function=self.mapStyler.style_contours,
+                       tooltip=folium.GeoJsonTooltip(fields=['elevation'], aliases=['Elevation (m)'])).add_to(self.contours_fg)
+        self.contours_fg.add_to(self.m)
+
+    def save_contour_files(self):
+        """Saves the contour lines in the workspace, needed when the contour stage came from the cache"""
+        if self.contours is not None and len(self.contours) > 0 and not os.path.exists(self.layer_path('contours', 'geojson')):
+            self.contours.to_file(self.layer_path('contours', 'geojson'), driver='GeoJSON')
+
+    def compute_flood_exposure(self):
+        """Scores all buildings by their height above the nearest waterway and their distance to it, see FloodExposure"""
+        if not self.flood_exposure or len(self.waterways) == 0:
+            self.flood_exposure_buildings = None
+            return
+        start = time.perf_counter()
+        self.flood_exposure_buildings = FloodExposure(self.all_buildings, self.waterways, self.epsg_code, self.get_elevation_grid().get_elevations, **self.flood_options).analyze()
+        summary = FloodExposure.summary(self.flood_exposure_buildings)
+        print(f"Flood exposure of {len(self.flood_exposure_buildings)} buildings computed in {time.perf_counter() - start:.2f} seconds: "
+              f"{summary['high']} high, {summary['medium']} medium and {summary['low']} low")
+
+    def exposed_buildings(self):
+        """Returns the buildings with a flood exposure (or an unknown one) by rank, the buildings without exposure are left out of the map and the export"""
+        return self.flood_exposure_buildings[self.flood_exposure_buildings['exposure'] != 'none']
+
+    def render_flood_exposure(self):
+        """Renders the exposed buildings as one GeoJson layer colored by their exposure, with the score and its parts as tooltip"""
+        if self.flood_exposure_buildings is None or len(self.exposed_buildings()) == 0:
+            return
+        fields = ['rank', 'exposure', 'score', 'height_m', 'water_m', 'waterway']
+        self.flood_exposure_fg = folium.FeatureGroup(name='Flood exposure')
+        folium.GeoJson(self.exposed_buildings()[fields + ['geometry']], style_function=self.mapStyler.style_flood_exposure,
+                       tooltip=folium.GeoJsonTooltip(fields=fields, aliases=['Rank', 'Exposure', 'Score', 'Above water (m)', 'To water (m)', 'Waterway'])).add_to(self.flood_exposure_fg)
+        self.flood_exposure_fg.add_to(self.m)
+
+    def save_flood_files(self):
+        """Saves the ranked exposed buildings as geojson and csv in the workspace, needed when the flood stage came from the cache"""
+        if self.flood_exposure_buildings is None or len(self.exposed_buildings()) == 0 or os.path.exists(self.layer_path('floodExposure', 'geojson')):
+            return
+        exposed = self.exposed_buildings()
+        AttributeProjector.for_file(exposed).to_file(self.layer_path('floodExposure', 'geojson'), driver='GeoJSON')
+        # the csv has the location of every building instead of its outline, to open it in a spreadsheet
+        points = exposed.geometry.representative_point()
+        exposed.drop(columns=exposed.geometry.name).assign(latitude=points.y.round(6), longitude=points.x.round(6)).to_csv(
+            os.path.join(self.workspace, 'geoJsonFiles', f'floodExposure_{self.name}.csv'), index=False)
+
+    @staticmethod
+    def grid_to_heatmap_data(latitudes, longitudes, elevations):
+        """Turns a sampled elevation grid into the [lat, lon, altitude] list the heatmap uses, points without elevation are left out"""
+        lat_grid, lon_grid = np.meshgrid(latitudes, longitudes, indexing='ij')
+        found = ~np.isnan(elevations)
+        return np.column_stack([lat_grid[found], lon_grid[found], elevations[found].astype(float)]).tolist()
+
+    def calculate_epsg_code(self):
+        """Calculates the EPSG code of the UTM zone of the location, this projection is used to make buffers in meters"""
+        self.utm_zone = int((self.longitude + 180) // 6) + 1 # calculate UTM zone
+        self.is_northern_hemisphere = self.latitude >= 0 # check if in northern hemisphere
+        self.epsg_code = 32600 + self.utm_zone if self.is_northern_hemisphere else 32700 + self.utm_zone # calculate EPSG code
+        return self.epsg_code
+
+    def project_layers(self):
+        """Projects the roads and waterways to the UTM zone of the location"""
+        self.calculate_epsg_code()
         self.projected_roads = self.roads.to_crs(epsg=self.epsg_code)
+        self.projected_waterways = self.waterways.to_crs(epsg=self.epsg_code)
+
+    def compute_buffer_areas(self):
+        """Makes the buffer areas around the projected roads and waterways, the buffers are converted back to the crs of the layers"""
         self.road_buffer = self.projected_roads.buffer(self.road_buffer_size)
         self.road_buffer = self.road_buffer.to_crs(self.roads.crs)
         self.road_buffer_union = self.road_buffer.unary_union
 
-        self.buffer_geojson_road = gpd.GeoSeries([self.road_buffer_union]).__geo_interface__
+        self.water_buffer = self.projected_waterways.buffer(self.water_buffer_size)
+        self.water_buffer = self.water_buffer.to_crs(self.waterways.crs)
+        self.water_buffer_union = self.water_buffer.unary_union
+
+    def classify_nearby_buildings(self):
+        """Selects the buildings that lie within the road buffer and the water buffer"""
+        self.nearby_buildings_road = self.buildings[self.buildings.intersects(self.road_buffer_union)]
+        self.nearby_buildings_water = self.buildings[self.buildings.intersects(self.water_buffer_union)]
+
+    def isochrone_points(self):
+        """Returns the lat, lon of the points the isochrones start from, following isochrone_sources"""
+        points = []
+        if self.isochrone_sources in ('passage_points', 'both'):
+            points.extend(tuple(point) for point in self.passage_points)
+        if self.isochrone_sources in ('cameras', 'both'):
+            points.extend((camera['latitude'], camera['longitude']) for camera in self.cameras)
+        return points
+
+    def compute_isochrones(self):
+        """Computes the areas that can be reached over the roads within the isochrone minutes from the nearest isochrone point"""
+        points = self.isochrone_points()
+        if len(points) == 0 or len(self.isochrone_minutes) == 0:
+            self.isochrone_areas = gpd.GeoDataFrame({'minutes': []}, geometry=[], crs='EPSG:4326')
+            return
+        start = time.perf_counter()
+        self.isochrone_areas = self.road_graph.isochrones(points, self.isochrone_minutes, speed_kph=self.isochrone_speed_kph)
+        print(f"Isochrones from {len(points)} points computed in {time.perf_counter() - start:.2f} seconds")
+
+    def isochrones_geojson(self):
+        """Returns the isochrones as geojson with a style and tooltip per area, the shortest time is red and the longest is green"""
+        colors = ['#d7191c', '#fdae61', '#ffffbf', '#a6d96a', '#1a9641']
+        minutes = sorted(self.isochrone_areas['minutes'])
+        areas = self.isochrone_areas[~self.isochrone_areas.geometry.is_empty]
+        features = []
+        for area_minutes, geometry in zip(areas['minutes'], areas.geometry):
+            color = colors[min(minutes.index(area_minutes) * (len(colors) - 1) // max(len(minutes) - 1, 1), len(colors) - 1)]
+            features.append({
+                'type': 'Feature',
+                'geometry': shapely.geometry.mapping(geometry),
+                'properties': {
+                    'tooltip': f'Reachable within {area_minutes} minutes',
+                    'style': {'color': color, 'fillColor': color, 'weight': 1, 'fillOpacity': 0.25}
+                }
+            })
+        return {'type': 'FeatureCollection', 'features': features}
+
+    def place_cameras(self):
+        """Places camera_budget cameras on the road graph so they see as much of the roads and passage points as possible"""
+        if self.camera_budget is None or self.camera_budget <= 0:
+            self.placed_cameras = []
+            return
+        self.placed_cameras = CameraPlacement(self.road_graph, self.passage_points, **self.placement_options).solve(self.camera_budget, name_prefix='placed camera')
+
+    def compute_camera_viewsheds(self):
+        """Computes per camera the part of its cone that is not hidden behind buildings (with their OpenStreetMap heights) and the SRTM terrain"""
+        if len(self.cameras) == 0 or not self.use_viewsheds:
+            self.camera_viewsheds = None
+            return
+        start = time.perf_counter()
+        self.camera_viewsheds = camera_viewsheds(self.cameras, self.all_buildings, self.epsg_code, elevation_function=self.get_elevation_grid().get_elevations)
+        print(f"Viewsheds of {len(self.cameras)} cameras computed in {time.perf_counter() - start:.2f} seconds")
+
+    def camera_viewshed_latlngs(self):
+        """Returns the viewsheds of the cameras as [lat, lng] rings for the camera scripts, None per camera when there are no viewsheds"""
+        if self.camera_viewsheds is None:
+            return [None] * len(self.cameras)
+        transformer = Transformer.from_crs(self.epsg_code, 4326, always_xy=True)
+        return [polygon_to_latlngs(viewshed, transformer) for viewshed in self.camera_viewsheds]
+
+    def compute_camera_coverage(self):
+        """Computes what the cameras see of the roads and buildings, with the overlap between cameras and the blind spots on the roads"""
+        if len(self.cameras) == 0:
+            self.camera_coverage = None
+            return
+        start = time.perf_counter()
+        self.camera_coverage = CameraCoverage(self.cameras, self.roads, self.all_buildings, self.epsg_code, cones=self.camera_viewsheds).analyze()
+        summary = self.camera_coverage['summary']
+        print(f"Camera coverage computed in {time.perf_counter() - start:.2f} seconds: {summary['covered_road_ratio']:.1%} of the roads "
+              f"and {summary['covered_buildings']} of {summary['buildings']} buildings are seen by {summary['cameras']} cameras")
+
+    def save_coverage_files(self):
+        """Saves the blind spots and the coverage per camera in the workspace, needed when the coverage stage came from the cache"""
+        if self.camera_coverage is None:
+            return
+        if len(self.camera_coverage['blind_spots']) > 0 and not os.path.exists(self.layer_path('blindSpots', 'geojson')):
+            self.camera_coverage['blind_spots'].to_file(self.layer_path('blindSpots', 'geojson'), driver='GeoJSON')
+        with open(os.path.join(self.workspace, 'geoJsonFiles', f'coverage_{self.name}.json'), 'w', encoding='utf-8') as f:
+            json.dump({'summary': self.camera_coverage['summary'], 'cameras': self.camera_coverage['per_camera'].to_dict(orient='records')}, f, indent=4, default=float)
+
+    def camera_coverage_geojson(self):
+        """Returns the blind spots as geojson with a tooltip per road part"""
+        features = []
+        for length, geometry in zip(self.camera_coverage['blind_spots']['length_m'], self.camera_coverage['blind_spots'].geometry):
+            features.append({
+                'type': 'Feature',
+                'geometry': shapely.geometry.mapping(geometry),
+                'properties': {
+                    'tooltip': f'Not seen by any camera: {length:.0f} m of road',
+                    'style': {'color': 'red', 'weight': 4, 'opacity': 0.8, 'dashArray': '6 6'}
+                }
+            })
+        return {'type': 'FeatureCollection', 'features': features}
+
+    def render_buffer_area_road(self):
+        """Renders buffer area around roads and buildings nearby roads"""
+        self.buffer_geojson_road = gpd.GeoSeries([self.display_layer(self.road_buffer_union)]).__geo_interface__
 
         # create FeatureGroup for the buffer area road
         self.buffer_area_road_fg = folium.FeatureGroup(name="Buffer area road")
@@ -730,21 +1406,15 @@ class MapCreator:
         self.buffer_area_road_fg.add_to(self.m)
 
         # buildings nearby roads
-        self.nearby_buildings_road = self.buildings[self.buildings.intersects(self.road_buffer_union)]
-
         self.nearby_buildings_road_fg = folium.FeatureGroup(name="Buildings nearby roads")
-        folium.GeoJson(self.nearby_buildings_road, style_function=self.mapStyler.style_nearby_buildings_road).add_to(self.nearby_buildings_road_fg)
-        self.nearby_buildings_road_fg = self.add_buildings_tooltips(self.nearby_buildings_road, self.nearby_buildings_road_fg, styler=self.mapStyler.style_nearby_buildings_road, extra_data = {'Digital Twin Name': self.name, 'Building Type': 'within road buffer'})
+        nearby_buildings_road = self.display_layer(self.nearby_buildings_road)
+        folium.GeoJson(nearby_buildings_road, style_function=self.mapStyler.style_nearby_buildings_road).add_to(self.nearby_buildings_road_fg)
+        self.nearby_buildings_road_fg = self.add_buildings_tooltips(nearby_buildings_road, self.nearby_buildings_road_fg, styler=self.mapStyler.style_nearby_buildings_road, extra_data = {'Digital Twin Name': self.name, 'Building Type': 'within road buffer'})
         self.nearby_buildings_road_fg.add_to(self.m)
 
     def render_buffer_area_water(self):
         """Renders buffer area around waterways and buildings nearby waterways"""
-        self.projected_waterways = self.waterways.to_crs(epsg=self.epsg_code)
-        self.water_buffer = self.projected_waterways.buffer(self.water_buffer_size)
-        self.water_buffer = self.water_buffer.to_crs(self.waterways.crs)
-        self.water_buffer_union = self.water_buffer.unary_union
-
-        self.buffer_geojson_water = gpd.GeoSeries([self.water_buffer_union]).__geo_interface__
+        self.buffer_geojson_water = gpd.GeoSeries([self.display_layer(self.water_buffer_union)]).__geo_interface__
 
         # create FeatureGroup for the buffer area water
         self.buffer_area_water_fg = folium.FeatureGroup(name="Buffer area waterways")
@@ -752,41 +1422,78 @@ class MapCreator:
         self.buffer_area_water_fg.add_to(self.m)
 
         # buildings nearby water
-        self.nearby_buildings_water = self.buildings[self.buildings.intersects(self.water_buffer_union)]
-
         self.nearby_buildings_water_fg = folium.FeatureGroup(name="Buildings nearby waterways")
-        folium.GeoJson(self.nearby_buildings_water, style_function=self.mapStyler.style_nearby_buildings_water).add_to(self.nearby_buildings_water_fg)
-        self.nearby_buildings_water_fg = self.add_buildings_tooltips(self.nearby_buildings_water, self.nearby_buildings_water_fg, styler=self.mapStyler.style_nearby_buildings_water, extra_data = {'Digital Twin Name': self.name, 'Building Type': 'within water buffer'})
+        nearby_buildings_water = self.display_layer(self.nearby_buildings_water)
+        folium.GeoJson(nearby_buildings_water, style_function=self.mapStyler.style_nearby_buildings_water).add_to(self.nearby_buildings_water_fg)
+        self.nearby_buildings_water_fg = self.add_buildings_tooltips(nearby_buildings_water, self.nearby_buildings_water_fg, styler=self.mapStyler.style_nearby_buildings_water, extra_data = {'Digital Twin Name': self.name, 'Building Type': 'within water buffer'})
         self.nearby_buildings_water_fg.add_to(self.m)
 
     def render_buffer_areas(self, water_buffer=True, road_buffer=True):
-        """Calls buffer area functions to render buffer areas"""
-        self.utm_zone = int((self.longitude + 180) // 6) + 1 # calculate UTM zone
-        self.is_northern_hemisphere = self.latitude >= 0 # check if in northern hemisphere
-        self.epsg_code = 32600 + self.utm_zone if self.is_northern_hemisphere else 32700 + self.utm_zone # calculate EPSG code
+        """Calls buffer area functions to render buffer areas, the buffers and nearby buildings are computed first when that did not happen yet"""
+        if not hasattr(self, 'projected_roads'):
+            self.project_layers()
+        if not hasattr(self, 'road_buffer_union'):
+            self.compute_buffer_areas()
+        if not hasattr(self, 'nearby_buildings_road'):
+            self.classify_nearby_buildings()
 
         if water_buffer==True:
             self.render_buffer_area_water()
         if road_buffer==True:
             self.render_buffer_area_road()
 
-    def save_map(self, interactive_marker=True, camera_simulation=True, weather_report=True, passage_simulation=True):
+    def render_layers(self):
+        """Renders all static layers on the map, after this the map only misses the injected javascript"""
+        # add roads to a featuregroup
+        self.roads_fg = folium.FeatureGroup(name='Roads') # create featuregroup
+        folium.GeoJson(self.display_layer(self.roads),style_function=self.mapStyler.style_roads).add_to(self.roads_fg) # add roads to featuregroup
+        self.roads_fg.add_to(self.m) # add featuregroup to map
+
+        # add waterways to a featuregroup
+        self.waterways_fg = folium.FeatureGroup(name='Waterways') # create featuregroup
+        folium.GeoJson(self.display_layer(self.waterways),style_function=self.mapStyler.style_waterways).add_to(self.waterways_fg) # add waterways to featuregroup
+        self.waterways_fg.add_to(self.m) # add featuregroup to map
+
+        # add all buildings to featuregroup
+        self.all_buildings_fg = folium.FeatureGroup(name="All buildings") # create featuregroup
+        all_buildings = self.display_layer(self.all_buildings)
+        folium.GeoJson(all_buildings, style_function=self.mapStyler.style_buildings).add_to(self.all_buildings_fg) # add buildings to featuregroup
+        self.all_buildings_fg = self.add_buildings_tooltips(all_buildings, self.all_buildings_fg, styler=self.mapStyler.style_buildings, extra_data = {'Digital Twin Name': self.name, 'Building Type': 'general'}) # add tooltips to buildings
+        self.all_buildings_fg.add_to(self.m) # add featuregroup to map
+
+        self.render_buffer_areas(water_buffer=True, road_buffer=True) # render buffer areas
+        if self.altitude_heatmap:
+            self.render_altitude_heatmap() #render altitude heatmap, BE CAUTIOUS, at large area options this will use a LOT of storage
+        if self.altitude_raster:
+            self.render_altitude_raster()
+        self.render_contours()
+        self.render_flood_exposure()
+
+        folium.LayerControl(collapsed=False, draggable=True).add_to(self.m) # add layer control to map
+
+        self.base_html = self.m.get_root().render() # the html of the map with static info, this is what folium would save
+
+    def inject_scripts(self, interactive_marker=True, camera_simulation=True, weather_report=True, passage_simulation=True, isochrones=True, camera_coverage=True):
         """
-        Saves barebones map with static info
-        
+        Injects the interactive javascript into the saved map file
+
         Parameters:
         interactive_marker: bool, if True, interactive marker will be added
         camera_simulation: bool, if True, camera simulation will be added
         weather_report: bool, if True, weather report will be added
+        passage_simulation: bool, if True, passage simulation will be added
+        isochrones: bool, if True, the isochrones will be added (when they were computed)
+        camera_coverage: bool, if True, the blind spots of the cameras will be added (when they were computed)
         """
-        self.m.save(self.map_name)
-
-        # these NEED to take place AFTER saving the base html with static info
         if interactive_marker == True:
             self.javaScriptInjector.inject_interactive_marker(self.map_name)
         if camera_simulation == True:
             # Adds camera simulation scripts
-            for camera in self.cameras:
+            for camera, cone_latlngs in zip(self.cameras, self.camera_viewshed_latlngs()):
+                if cone_latlngs == []:
+                    # leaflet would draw an empty polygon, a camera that sees nothing is left out
+                    print(f"Camera {camera['name']} sees nothing past the buildings and the terrain, it is not drawn")
+                    continue
                 self.javaScriptInjector.inject_camera_simulation_script(
                     self.map_name,
                     camera_latitude=camera['latitude'],
@@ -799,7 +1506,8 @@ class MapCreator:
                     cone_outline_color=camera.get('cone_outline_color', 'red'),
                     cone_fill_color=camera.get('cone_fill_color', 'orange'),
                     camera_outline_color=camera.get('camera_outline_color', 'blue'),
-                    camera_fill_color=camera.get('camera_fill_color', 'lightblue')
+                    camera_fill_color=camera.get('camera_fill_color', 'lightblue'),
+                    cone_latlngs=cone_latlngs
                 )
         if weather_report == True:
             # Should be changed to a more secure way of storing the API key when fully released
@@ -808,50 +1516,323 @@ class MapCreator:
         if passage_simulation == True:
             for point in self.passage_points:
                 self.javaScriptInjector.inject_passage_simulation_script(self.map_name, point)
+        if isochrones == True and self.isochrone_areas is not None and len(self.isochrone_areas) > 0:
+            self.javaScriptInjector.inject_geojson_layer(self.map_name, self.isochrones_geojson(), 'Isochrones')
+        if camera_coverage == True and self.camera_coverage is not None:
+            self.javaScriptInjector.inject_geojson_layer(self.map_name, self.camera_coverage_geojson(), 'Camera blind spots')
+
+    def save_map(self, interactive_marker=True, camera_simulation=True, weather_report=True, passage_simulation=True):
+        """
+        Saves barebones map with static info
+        
+        Parameters:
+        interactive_marker: bool, if True, interactive marker will be added
+        camera_simulation: bool, if True, camera simulation will be added
+        weather_report: bool, if True, weather report will be added
+        """
+        self.m.save(self.map_name)
+
+        # these NEED to take place AFTER saving the base html with static info
+        self.inject_scripts(interactive_marker, camera_simulation, weather_report, passage_simulation)
         
         return self.map_name
 
-    def create_detailed_map(self):
+    def run_stage(self, stage, inputs, compute, outputs, parents=()):
         """
-        Creates detailed map with all the data and saves it as a static html
+        Runs one stage of the map generation through the stage cache and sets the outputs of the stage as attributes
+
+        Parameters:
+        stage: str, name of the stage
+        inputs: dict, inputs of the stage that are not already covered by the parent stages
+        compute: function, computes the stage and sets the outputs as attributes
+        outputs: list, names of the attributes that are the result of the stage
+        parents: list, keys of the stages this stage depends on
+        """
+        with self.writing_span(stage, cached=True) as span:
+            def compute_outputs():
+                span['cached'] = False
+                compute()
+                return {output: getattr(self, output) for output in outputs}
+
+            key, result = self.stageCache.run(stage, inputs, compute_outputs, parents)
+            for output, value in result.items():
+                setattr(self, output, value)
+            # the features of the layers the stage made, a layer that is set under two names (like buildings and all_buildings) counts once
+            layers = {}
+            for output, value in result.items():
+                if isinstance(value, (gpd.GeoDataFrame, gpd.GeoSeries)) and id(value) not in layers:
+                    layers[id(value)] = (output, len(value))
+            if layers:
+                span['features'] = sum(count for _, count in layers.values())
+                span['layers'] = dict(layers.values())
+        return key
+
+    def download_layers(self, bbox=None):
+        """
+        Downloads all layers, the attribute schemas keep the column names within the 10 characters of a shapefile,
+        so the downloaded layers are used directly instead of reading the saved shapefiles back.
+        The layers are saved by save_layer_files, also when they come from the cache
+
+        Parameters:
+        bbox: tuple, (north, south, east, west) to download instead of load_dist around the point, used for the sites of a multi-site map
         """
         #download data with downloader
-        self.download_building_data()
-        self.download_road_network_data()
-        self.download_waterway_data()
-        
-        #read saved files
-        self.roads = gpd.read_file(f'shpFiles/roads_{self.name}.shp') # read roads
-        self.all_buildings = gpd.read_file(f'shpFiles/buildings_{self.name}.shp') # read buildings
-        self.waterways = gpd.read_file(f'shpFiles/waterways_{self.name}.shp') # read waterways
-        
-        # add roads to a featuregroup
-        self.roads_fg = folium.FeatureGroup(name='Roads') # create featuregroup
-        folium.GeoJson(self.roads,style_function=self.mapStyler.style_roads).add_to(self.roads_fg) # add roads to featuregroup
-        self.roads_fg.add_to(self.m) # add featuregroup to map
+        self.download_building_data(bbox)
+        self.download_road_network_data(bbox)
+        self.download_waterway_data(bbox)
 
-        # add waterways to a featuregroup
-        self.waterways_fg = folium.FeatureGroup(name='Waterways') # create featuregroup
-        folium.GeoJson(self.waterways,style_function=self.mapStyler.style_waterways).add_to(self.waterways_fg) # add waterways to featuregroup
-        self.waterways_fg.add_to(self.m) # add featuregroup to map
+        self.roads = self.gdf_roads
+        self.all_buildings = self.buildings
+        self.attribute_reports = self.attributeProjector.reports
 
-        # add all buildings to featuregroup
-        self.all_buildings_fg = folium.FeatureGroup(name="All buildings") # create featuregroup
-        folium.GeoJson(self.all_buildings, style_function=self.mapStyler.style_buildings).add_to(self.all_buildings_fg) # add buildings to featuregroup
-        self.all_buildings_fg = self.add_buildings_tooltips(self.all_buildings, self.all_buildings_fg, styler=self.mapStyler.style_buildings, extra_data = {'Digital Twin Name': self.name, 'Building Type': 'general'}) # add tooltips to buildings
-        self.all_buildings_fg.add_to(self.m) # add featuregroup to map
-        
-        self.render_buffer_areas(water_buffer=True, road_buffer=True) # render buffer areas
-        self.render_altitude_heatmap() #render altitude heatmap, BE CAUTIOUS, at large area options this will use a LOT of storage
+    def workspace_bytes(self):
+        """Returns the total size of the files in the workspace, the difference before and after a step is what the step wrote"""
+        return sum(os.path.getsize(os.path.join(folder, file_name)) for folder, _, file_names in os.walk(self.workspace) for file_name in file_names)
 
-        folium.LayerControl(collapsed=False, draggable=True).add_to(self.m) # add layer control to map
+    @contextmanager
+    def writing_span(self, name, **attributes):
+        """
+        Runs the with block in a span with the bytes it wrote in the workspace.
+        The workspace is only walked at the end of the span, the size at the start is the one of the end of the span before
+        """
+        with self.instrumentation.span(name, **attributes) as span:
+            before = self.workspace_size
+            yield span
+            self.workspace_size = self.workspace_bytes()
+            span['bytes_written'] = self.workspace_size - before
+
+    def save_layer_files(self):
+        """Saves the layers as shapefiles and geojson in the workspace, after the download stage (also when it came from the cache)"""
+        layers = {'roads': self.roads, 'buildings': self.all_buildings, 'waterways': self.waterways}
+        with self.writing_span('save_layer_files'):
+            for layer_name, layer in layers.items():
+                if not os.path.exists(self.layer_path(layer_name, 'shp')):
+                    AttributeProjector.for_file(layer).to_file(self.layer_path(layer_name, 'shp'), driver='ESRI Shapefile')
+                if not os.path.exists(self.layer_path(layer_name, 'geojson')):
+                    AttributeProjector.for_file(layer).to_file(self.layer_path(layer_name, 'geojson'), driver='GeoJSON')
+
+    def render_map_html(self):
+        """Writes the rendered base html to the map file and injects the javascript, the final html is kept in map_html"""
+        with open(self.map_name, 'w', encoding='utf-8') as f:
+            f.write(self.base_html)
 
-        self.save_map() # save map with static info
-        
-        saved_map_name = f'maps/map_{self.name}.html' # name of the saved map WITHIN the static folder
-        print(f"Map saved under {saved_map_name} in the static folder.") # print where the map is saved
+        # these NEED to take place AFTER saving the base html with static info
+        self.inject_scripts()
 
-        return saved_map_name # return the name of the saved map within the static folder
+        with open(self.map_name, 'r', encoding='utf-8') as f:
+            self.map_html = f.read()
+
+    def layer_path(self, layer_name, extension):
+        """
+        Returns the path of a layer file in the workspace of the job
+
+        Parameters:
+        layer_name: str, name of the layer, for example roads
+        extension: str, shp or geojson
+        """
+        folder = 'shpFiles' if extension == 'shp' else 'geoJsonFiles'
+        return os.path.join(self.workspace, folder, f'{layer_name}_{self.name}.{extension}')
+
+    @staticmethod
+    def publish_file(source, destination):
+        """
+        Copies a file to its destination under a temporary name in the destination folder and renames it afterwards.
+        The rename is atomic, so readers (and other jobs) only ever see the old or the complete new file
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(destination), suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, destination)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def publish(self):
+        """
+        Publishes the finished files of the workspace and removes the older versions of the map beyond versions_kept.
+        The map and the geojson (and json) files are published under a versioned name (with the job id) and also replace the
+        unversioned name, which always points at the latest complete version. An unversioned optional layer that this generation did not write is removed.
+        Shapefiles consist of several files that can not be replaced at once, so they are only published under the versioned name.
+        Returns the name of the versioned map within the static folder
+        """
+        with self.instrumentation.span('publish') as span:
+            versioned_map_name = self.publish_files()
+            self.prune_versions()
+            # the published files are copies of what the stages wrote, so they are not bytes_written again
+            span['output_bytes'] = sum(os.path.getsize(path) for path in self.output_files())
+        return versioned_map_name
+
+    def publish_files(self):
+        """Copies the files of the workspace to the shared folders for publish and returns the name of the versioned map"""
+        versioned_map_name = f'maps/map_{self.name}_{self.job_id}.html'
+        self.publish_file(self.map_name, os.path.join('static', versioned_map_name))
+        self.publish_file(self.map_name, os.path.join('static', 'maps', f'map_{self.name}.html'))
+        self.published_files = [os.path.join('static', versioned_map_name), os.path.join('static', 'maps', f'map_{self.name}.html')]
+
+        for folder in ('shpFiles', 'geoJsonFiles'):
+            for file_name in sorted(os.listdir(os.path.join(self.workspace, folder))):
+                base, extension = os.path.splitext(file_name)
+                destination = os.path.join(folder, f'{base}_{self.job_id}{extension}')
+                self.publish_file(os.path.join(self.workspace, folder, file_name), destination)
+                self.published_files.append(destination)
+                if extension in ('.geojson', '.json'):
+                    self.publish_file(os.path.join(self.workspace, folder, file_name), os.path.join(folder, file_name))
+                    self.published_files.append(os.path.join(folder, file_name))
+
+        written = set(os.listdir(os.path.join(self.workspace, 'geoJsonFiles')))
+        for layer_name, extension in OPTIONAL_OUTPUTS:
+            file_name = f'{layer_name}_{self.name}.{extension}'
+            if file_name not in written:
+                try:
+                    os.remove(os.path.join('geoJsonFiles', file_name))
+                    print(f"Removed {file_name} of an earlier generation, this generation has no {layer_name}")
+                except FileNotFoundError:
+                    pass
+
+        print(f"Map saved under {versioned_map_name} in the static folder.") # print where the map is saved
+        return versioned_map_name
+
+    def prune_versions(self):
+        """
+        Removes the versioned files of the older generations of this map, only the newest versions_kept versions are kept (0 keeps all).
+        The versions are found by their versioned map static/maps/map_<name>_<job_id>.html, the unversioned files and generations with a job id
+        that was given instead of generated are not touched
+        """
+        if not self.versions_kept:
+            return
+        maps_folder = os.path.join('static', 'maps')
+        # only map_<name>_<job_id>.html with a generated job id, so the maps of a name that starts with this one are not taken for versions
+        version_pattern = re.compile(re.escape(f'map_{self.name}_') + r'(' + JOB_ID_PATTERN + r')\.html')
+        versions = []
+        for file_name in os.listdir(maps_folder):
+            match = version_pattern.fullmatch(file_name)
+            if match is None:
+                continue
+            try:
+                versions.append((os.path.getmtime(os.path.join(maps_folder, file_name)), match.group(1)))
+            except FileNotFoundError:
+                pass # pruned by another generation at the same time
+        versions.sort(reverse=True)
+        old_job_ids = {job_id for _, job_id in versions[self.versions_kept:]} - {self.job_id}
+        if not old_job_ids:
+            return
+        removed = 0
+        job_id_suffix = re.compile(r'_(' + JOB_ID_PATTERN + r')$')
+        for folder in (maps_folder, 'shpFiles', 'geoJsonFiles'):
+            for file_name in os.listdir(folder):
+                match = job_id_suffix.search(os.path.splitext(file_name)[0])
+                if match is not None and match.group(1) in old_job_ids:
+                    try:
+                        os.remove(os.path.join(folder, file_name))
+                        removed += 1
+                    except FileNotFoundError:
+                        pass # removed by another generation at the same time
+        print(f"Removed {removed} files of {len(old_job_ids)} older versions of map {self.name}")
+
+    def remove_workspace(self):
+        """Removes the workspace of the job unless keep_workspace is set, called when the generation is finished, also when it failed"""
+        if not self.keep_workspace:
+            shutil.rmtree(self.workspace, ignore_errors=True)
+
+    def output_files(self):
+        """Returns the paths of all files published for this map"""
+        return [path for path in self.published_files if os.path.exists(path)]
+
+    def job_files(self):
+        """Returns the published files that belong to this generation only (the job id is in their name), the unversioned files are shared with later generations"""
+        return [path for path in self.output_files() if self.job_id in os.path.basename(path)]
+
+    def create_tiled_map(self):
+        """
+        Large area mode, the area is split into tiles that are downloaded and processed in a pool of processes.
+        The peak memory of the processing depends on the tile size instead of on the area
+        """
+        from tiledProcessing import TiledMapProcessor # imported here because tiledProcessing itself imports this module
+
+        TiledMapProcessor(self, tile_size=self.tile_size, max_workers=self.max_workers, heatmap_step=self.heatmap_step if self.altitude_heatmap else None).create_map()
+
+        return self.publish() # return the name of the saved map within the static folder
+
+    def create_detailed_map(self):
+        """
+        Creates detailed map with all the data and saves it as a static html, with create_staged_map or with create_tiled_map for large areas.
+        Every stage is measured (wall time, memory, features, bytes written, download retries), the measurements are kept in self.metrics,
+        published as geoJsonFiles/metrics_<name>_<job_id>.json and added to the metrics of the process that the Flask app serves on /metrics
+        """
+        status = 'failed'
+        try:
+            with self.instrumentation.profiling():
+                if self.tile_size is not None and 2 * self.load_dist > self.tile_size:
+                    map_name = self.create_tiled_map()
+                else:
+                    map_name = self.create_staged_map()
+            status = 'succeeded'
+            return map_name
+        finally:
+            try:
+                self.finish_instrumentation(status)
+            finally:
+                self.remove_workspace()
+
+    def finish_instrumentation(self, status):
+        """Keeps the measurements of the generation in self.metrics, adds them to the metrics of the process and publishes them when the map succeeded"""
+        self.instrumentation.status = status
+        self.metrics = self.instrumentation.to_dict()
+        METRICS.observe_job(self.instrumentation)
+        if status == 'succeeded':
+            metrics_path = os.path.join('geoJsonFiles', f'metrics_{self.name}_{self.job_id}.json')
+            self.instrumentation.save(metrics_path)
+            self.published_files.append(metrics_path)
+        print(f"Generation {status} in {self.metrics['total_seconds']:.2f} seconds, slowest stages: " +
+              ', '.join(f"{span['name']} {span['seconds']:.2f}s" for span in sorted(self.instrumentation.spans, key=lambda span: -span['seconds'])[:3]))
+
+    def create_staged_map(self):
+        """
+        Creates detailed map with all the data and saves it as a static html
+        The map is made in stages (download -> project -> buffer -> classify -> render, download -> contour -> render, project -> flood -> render, download -> placement, download -> isochrone, project -> viewshed -> coverage, and all into inject),
+        every stage is cached on disk and only reruns when its inputs or the stages before it changed.
+        So changing a camera only reruns the viewshed, coverage and inject stages.
+        """
+        download_key = self.run_stage('download', {'latitude': self.latitude, 'longitude': self.longitude, 'load_dist': self.load_dist, 'attribute_schemas': self.attribute_schemas,
+                                                  'data_source': self.data_source.cache_id()},
+                                      self.download_layers, ['buildings', 'all_buildings', 'roads', 'waterways', 'attribute_reports', 'road_graph'])
+        self.save_layer_files()
+        self.run_stage('placement', {'camera_budget': self.camera_budget, 'placement_options': self.placement_options, 'passage_points': self.passage_points},
+                       self.place_cameras, ['placed_cameras'], parents=[download_key])
+        # the placed cameras are used like the given ones by all next stages
+        self.cameras = list(self.given_cameras) + self.placed_cameras
+
+        project_key = self.run_stage('project', {}, self.project_layers,
+                                     ['projected_roads', 'projected_waterways', 'utm_zone', 'is_northern_hemisphere', 'epsg_code'], parents=[download_key])
+        buffer_key = self.run_stage('buffer', {'water_buffer_size': self.water_buffer_size, 'road_buffer_size': self.road_buffer_size},
+                                    self.compute_buffer_areas, ['road_buffer', 'road_buffer_union', 'water_buffer', 'water_buffer_union'], parents=[project_key])
+        classify_key = self.run_stage('classify', {}, self.classify_nearby_buildings,
+                                      ['nearby_buildings_road', 'nearby_buildings_water'], parents=[download_key, buffer_key])
+        contour_key = self.run_stage('contour', {'interval': self.contour_interval}, self.compute_contours, ['contours'], parents=[download_key])
+        self.save_contour_files()
+        flood_key = self.run_stage('flood', {'flood_exposure': self.flood_exposure, 'flood_options': self.flood_options}, self.compute_flood_exposure,
+                                   ['flood_exposure_buildings'], parents=[download_key, project_key])
+        self.save_flood_files()
+        render_key = self.run_stage('render', {'name': self.name, 'altitude_heatmap': self.altitude_heatmap, 'heatmap_step': self.heatmap_step,
+                                              'altitude_raster': self.altitude_raster, 'simplify_tolerance': self.simplify_tolerance, 'tile_url': self.tile_url}, self.render_layers,
+                                    ['base_html'], parents=[download_key, classify_key, contour_key, flood_key])
+        isochrone_key = self.run_stage('isochrone', {'points': self.isochrone_points(), 'minutes': self.isochrone_minutes, 'speed_kph': self.isochrone_speed_kph},
+                                       self.compute_isochrones, ['isochrone_areas'], parents=[download_key])
+        viewshed_key = self.run_stage('viewshed', {'cameras': self.cameras, 'use_viewsheds': self.use_viewsheds}, self.compute_camera_viewsheds,
+                                      ['camera_viewsheds'], parents=[download_key, project_key])
+        coverage_key = self.run_stage('coverage', {'cameras': self.cameras}, self.compute_camera_coverage,
+                                      ['camera_coverage'], parents=[download_key, project_key, viewshed_key])
+        self.save_coverage_files()
+        self.run_stage('inject', {'cameras': self.cameras, 'passage_points': self.passage_points},
+                       self.render_map_html, ['map_html'], parents=[render_key, isochrone_key, coverage_key])
+
+        # the inject stage may come from the cache, so the final html is always written
+        with open(self.map_name, 'w', encoding='utf-8') as f:
+            f.write(self.map_html)
+
+        return self.publish() # return the name of the saved map within the static folder
     
 # This is for testing it standalone without any flask app
 # if __name__ == "__main__":
@@ -0,0 +1,171 @@
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+class MockServer:
+    """
+    Base of the local stand-ins for the web services, runs a threaded http server with the handler of make_handler in a background thread.
+    Can be used as context manager, the server runs within the with block
+
+    Parameters:
+    host: str, host to listen on
+    port: int, port to listen on, 0 picks a free port
+    """
+    def __init__(self, host='127.0.0.1', port=0):
+        self.requests = [] # what was asked, in order
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def make_handler(self):
+        """Returns the BaseHTTPRequestHandler class that answers the requests"""
+        raise NotImplementedError
+
+    def start(self):
+        """Starts answering in a background thread and returns the url of the server"""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        """Stops the server"""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+class MockOverpassServer(MockServer):
+    """
+    Small local Overpass api to test the downloads against without internet, it can be slow and fail on purpose.
+    Every request takes the next behaviour of the script, when the script is used up the default behaviour is used.
+    A behaviour is a dict with 'status' (http status code, default 200), 'delay' (seconds before answering, default 0),
+    'retry_after' (value of the Retry-After header) and 'body' (raw text to answer instead of the json)
+
+    Parameters:
+    elements: list, Overpass json elements that are answered to every query
+    script: list, behaviours of the first requests, in order
+    default: dict, behaviour of the requests after the script
+    host: str, host to listen on
+    port: int, port to listen on, 0 picks a free port
+    """
+    def __init__(self, elements=None, script=None, default=None, host='127.0.0.1', port=0):
+        self.elements = elements if elements is not None else []
+        self.script = list(script) if script is not None else []
+        self.default = default if default is not None else {}
+        super().__init__(host, port) # self.requests holds the queries that were received
+
+    @property
+    def url(self):
+        """Url of the api, to use as Overpass endpoint"""
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/api'
+
+    def next_behaviour(self, query):
+        """Registers the query and returns the behaviour to answer it with"""
+        with self.lock:
+            self.requests.append(query)
+            return self.script.pop(0) if self.script else self.default
+
+    def answer(self, query):
+        """Returns the json answer to a query, override this to answer per query"""
+        return {'version': 0.6, 'generator': 'MockOverpassServer', 'elements': self.elements}
+
+    def make_handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                query = parse_qs(self.rfile.read(length).decode('utf-8')).get('data', [''])[0]
+                behaviour = mock.next_behaviour(query)
+                time.sleep(behaviour.get('delay', 0))
+
+                status = behaviour.get('status', 200)
+                body = behaviour.get('body')
+                if body is None:
+                    body = json.dumps(mock.answer(query)) if status == 200 else f'mock error {status}'
+                body = body.encode('utf-8')
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json' if status == 200 else 'text/plain')
+                    self.send_header('Content-Length', str(len(body)))
+                    if 'retry_after' in behaviour:
+                        self.send_header('Retry-After', str(behaviour['retry_after']))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass # the client stopped waiting, like a hedged request that lost
+
+            def do_GET(self):
+                # the status endpoint osmnx uses to check for a free slot
+                body = b'Connected as: 0\nCurrent time: 2024-01-01T00:00:00Z\nAnnounced endpoint: none\nRate limit: 0\n2 slots available now.\nCurrently running queries (pid, space limit, time limit, start time):\n'
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+class MockTileServer(MockServer):
+    """
+    Small local stand-in for the basemap tile servers, to test the TileProxy without internet.
+    Answers every /<source>/<z>/<x>/<y>.png with a small png (or with the status and delay of the behaviour) and counts the requests per tile
+
+    Parameters:
+    default: dict, behaviour of every request, 'status' (http status code, default 200), 'delay' (seconds before answering, default 0)
+             and 'content_type' with 'body' (to answer something else than a tile, like the html error page of a server)
+    host: str, host to listen on
+    port: int, port to listen on, 0 picks a free port
+    """
+    # a 1x1 half transparent blue png
+    TILE = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==')
+
+    def __init__(self, default=None, host='127.0.0.1', port=0):
+        self.default = default if default is not None else {}
+        super().__init__(host, port) # self.requests holds the paths that were asked
+
+    @property
+    def url(self):
+        """Url template of the tiles, to use as TILE_UPSTREAM"""
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/{{source}}/{{z}}/{{x}}/{{y}}.png'
+
+    def make_handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with mock.lock:
+                    mock.requests.append(self.path)
+                time.sleep(mock.default.get('delay', 0))
+                status = mock.default.get('status', 200)
+                body = mock.TILE if status == 200 else f'mock error {status}'.encode('utf-8')
+                content_type = 'image/png' if status == 200 else 'text/plain'
+                if 'body' in mock.default:
+                    body = mock.default['body'].encode('utf-8')
+                    content_type = mock.default.get('content_type', 'text/html')
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
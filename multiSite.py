@@ -0,0 +1,407 @@
+import argparse
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import folium
+import geopandas as gpd
+import numpy as np
+import osmnx as ox
+import shapely
+from folium.plugins import GroupedLayerControl, HeatMap
+from shapely.geometry import box
+
+from batchGenerator import BatchGenerator
+from cameraCoverage import camera_cones
+from costEstimator import distance_km
+from mapGenerator import AttributeProjector, MapCreator
+from stageCache import StageCache
+
+def site_owners(longitudes, latitudes, sites, x_scale):
+    """
+    Returns per point the index of the site it belongs to, -1 for points outside every site.
+    A point belongs to the site with the nearest center among the sites whose area contains it, so where the areas overlap
+    every feature, grid point, camera and passage point belongs to exactly one site. Ties go to the first site
+
+    Parameters:
+    longitudes, latitudes: array, the points in lat/lon
+    sites: list, dicts with the latitude, longitude and bbox (north, south, east, west) of every site
+    x_scale: float, length of a degree of longitude in degrees of latitude, the same for the whole map
+    """
+    x = np.asarray(longitudes, dtype=float)
+    y = np.asarray(latitudes, dtype=float)
+    owners = np.full(len(x), -1)
+    best = np.full(len(x), np.inf)
+    for index, site in enumerate(sites):
+        north, south, east, west = site['bbox']
+        inside = (west <= x) & (x <= east) & (south <= y) & (y <= north)
+        distance = ((x - site['longitude']) * x_scale) ** 2 + (y - site['latitude']) ** 2
+        closer = inside & (distance < best)
+        owners[closer] = index
+        best[closer] = distance[closer]
+    return owners
+
+def closer_half_plane(own, other, x_scale, size=10):
+    """Returns the half plane of the points closer to the other center than to the own center as a (large) polygon in lat/lon, the centers are (lon, lat)"""
+    own = np.array([own[0] * x_scale, own[1]])
+    other = np.array([other[0] * x_scale, other[1]])
+    direction = (other - own) / np.linalg.norm(other - own)
+    normal = np.array([-direction[1], direction[0]])
+    middle = (own + other) / 2
+    corners = np.array([middle + normal * size, middle + normal * size + direction * size, middle - normal * size + direction * size, middle - normal * size])
+    corners[:, 0] /= x_scale
+    return shapely.Polygon(corners)
+
+def site_region(index, sites, x_scale):
+    """
+    Returns the area a site owns as a polygon in lat/lon: its bbox without the parts of the other bboxes that are closer to their center,
+    the same split as site_owners. The buffers of a site are clipped to it so the buffers of overlapping sites do not overlap
+
+    Parameters:
+    index: int, index of the site
+    sites: list, dicts with the latitude, longitude and bbox (north, south, east, west) of every site
+    x_scale: float, length of a degree of longitude in degrees of latitude, the same for the whole map
+    """
+    site = sites[index]
+    north, south, east, west = site['bbox']
+    region = box(west, south, east, north)
+    for other_index, other in enumerate(sites):
+        other_north, other_south, other_east, other_west = other['bbox']
+        other_box = box(other_west, other_south, other_east, other_north)
+        if other_index == index or not region.intersects(other_box):
+            continue
+        if (other['longitude'], other['latitude']) == (site['longitude'], site['latitude']):
+            # the same center, the first site gets the whole overlap
+            if other_index < index:
+                region = region.difference(other_box)
+            continue
+        closer = closer_half_plane((site['longitude'], site['latitude']), (other['longitude'], other['latitude']), x_scale)
+        region = region.difference(other_box.intersection(closer))
+    return region
+
+def compute_site(site):
+    """
+    Downloads and processes a single site with the stages of a MapCreator of the site, this runs in a worker process.
+    Everything in the bbox of the site is downloaded and buffered, afterwards only the features the site owns (see site_owners)
+    are kept and the buffers are clipped to the region of the site, so overlapping sites have no duplicates in the merged map.
+    The viewsheds of the cameras of the site use all buildings in its bbox, also the ones another site owns
+
+    Parameters:
+    site: dict, description of the site made by MultiSiteMapCreator.make_sites
+    """
+    north, south, east, west = site['bbox']
+    region = site_region(site['index'], site['sites'], site['x_scale'])
+    # the stage cache of the site is the one of process_site, the MapCreator of the site only runs the stages. It shares the workspace of the map
+    # but writes no files there, process_site saves the layers the site owns
+    mc = MapCreator(site['latitude'], site['longitude'], site['name'], site['radius'], site['water_buffer_size'], site['road_buffer_size'], cameras=site['cameras'],
+                    use_cache=False, job_id=site['job_id'], attribute_schemas=site['attribute_schemas'], data_source=site['data_source'],
+                    use_viewsheds=site['use_viewsheds'], heatmap_step=site['heatmap_step'])
+
+    def owned(points):
+        return site_owners(points.x.to_numpy(), points.y.to_numpy(), site['sites'], site['x_scale']) == site['index']
+
+    print(f"{site['name']}: downloading..")
+    mc.download_layers(site['bbox'])
+    # the buffers are made from all lines in the bbox and clipped to the region afterwards
+    mc.project_layers()
+    mc.compute_buffer_areas()
+    road_buffer_union = mc.road_buffer_union if mc.road_buffer_union is not None else shapely.Polygon()
+    water_buffer_union = mc.water_buffer_union if mc.water_buffer_union is not None else shapely.Polygon()
+
+    # only the buildings the site owns are classified, lines belong to the site their middle lies in
+    mc.buildings = mc.all_buildings[owned(mc.all_buildings.geometry.representative_point())]
+    mc.classify_nearby_buildings()
+    roads = mc.roads[owned(mc.roads.geometry.interpolate(0.5, normalized=True))]
+    waterways = mc.waterways[owned(mc.waterways.geometry.interpolate(0.5, normalized=True))]
+
+    print(f"{site['name']}: sampling elevation..")
+    latitudes, longitudes, elevations = mc.get_elevation_grid().sample_grid(south, north, west, east, site['heatmap_step'], origin=site['grid_origin'])
+    # the grid points another site owns are left out, like the points without elevation
+    lat_grid, lon_grid = np.meshgrid(latitudes, longitudes, indexing='ij')
+    elevations = np.where((site_owners(lon_grid.ravel(), lat_grid.ravel(), site['sites'], site['x_scale']) == site['index']).reshape(elevations.shape), elevations, np.nan)
+
+    mc.compute_camera_viewsheds()
+    viewsheds = []
+    if mc.camera_viewsheds is not None:
+        viewsheds = list(gpd.GeoSeries(list(mc.camera_viewsheds), crs=f"EPSG:{mc.epsg_code}").to_crs(epsg=4326))
+
+    return {
+        'region': region,
+        'buildings': mc.buildings,
+        'roads': roads,
+        'waterways': waterways,
+        'road_buffer': road_buffer_union.intersection(region),
+        'water_buffer': water_buffer_union.intersection(region),
+        'nearby_buildings_road': mc.nearby_buildings_road,
+        'nearby_buildings_water': mc.nearby_buildings_water,
+        'heatmap_data': MapCreator.grid_to_heatmap_data(latitudes, longitudes, elevations),
+        'viewsheds': viewsheds
+    }
+
+def process_site(site):
+    """
+    Processes a site through the stage cache and saves its layers, only a small summary is sent back
+    so the parent process never holds more than one site at a time. Without the stage cache the result is handed over through a file in the workspace
+
+    Parameters:
+    site: dict, description of the site made by MultiSiteMapCreator.make_sites
+    """
+    stageCache = StageCache(site['cache_dir'], enabled=site['use_cache'])
+    inputs = {key: site[key] for key in ('bbox', 'sites', 'x_scale', 'water_buffer_size', 'road_buffer_size', 'heatmap_step', 'grid_origin',
+                                         'attribute_schemas', 'cameras', 'use_viewsheds')}
+    inputs['data_source'] = site['data_source'].cache_id()
+    key, result, spill_path = stageCache.run_in_worker('site', inputs, lambda: compute_site(site), site['workspace'])
+
+    for layer_name in ('roads', 'buildings', 'waterways'):
+        layer = result[layer_name]
+        if len(layer) > 0:
+            AttributeProjector.for_file(layer).to_file(os.path.join(site['workspace'], 'shpFiles', f"{layer_name}_{site['map_name']}_{site['name']}.shp"), driver='ESRI Shapefile')
+            AttributeProjector.for_file(layer).to_file(os.path.join(site['workspace'], 'geoJsonFiles', f"{layer_name}_{site['map_name']}_{site['name']}.geojson"), driver='GeoJSON')
+
+    return {
+        'index': site['index'],
+        'name': site['name'],
+        'key': key,
+        'spill_path': spill_path,
+        'buildings': len(result['buildings']),
+        'roads': len(result['roads']),
+        'waterways': len(result['waterways'])
+    }
+
+class MultiSiteMapCreator:
+    """
+    Multi-site mode of the MapCreator: several sites (each with its own center and radius) in one map. The download, buffer,
+    elevation and viewshed work of every site runs in a pool of processes. Where the areas of the sites overlap, every feature
+    belongs to the site with the nearest center (see site_owners), so nothing is drawn twice. The layers of every site are a group
+    in the layer control, and the cameras and passage points are assigned to the site they lie in automatically
+
+    Parameters:
+    sites: list, site specs, every spec is a dict with latitude, longitude, name, radius and optionally water_buffer_size and road_buffer_size
+    name: str, name of the map
+    cameras: list, dicts with the properties of the to be simulated cameras, of all sites together
+    passage_points: list, tuples with lat, lon of the to be simulated passage sensors, of all sites together
+    max_workers: int, number of processes, None uses the number of cores
+    heatmap_step: float, distance between the points of the elevation heatmap in degrees
+    map_options: keyword arguments for the MapCreator of the map, like water_buffer_size, road_buffer_size, data_source, use_viewsheds, simplify_tolerance and tile_url
+    """
+    def __init__(self, sites, name, cameras=[], passage_points=[], max_workers=None, heatmap_step=0.00005, **map_options):
+        if len(sites) == 0:
+            raise ValueError("A multi-site map needs at least one site")
+        names = [site['name'] for site in sites]
+        duplicates = sorted(set(site_name for site_name in names if names.count(site_name) > 1))
+        if duplicates:
+            raise ValueError(f"Site names must be unique within a multi-site map, duplicates: {duplicates}")
+
+        self.sites = sites
+        self.max_workers = max_workers
+        self.heatmap_step = heatmap_step
+        latitude = sum(site['latitude'] for site in sites) / len(sites)
+        longitude = sum(site['longitude'] for site in sites) / len(sites)
+        # the distance from the middle to the furthest edge of a site, so the map covers every site
+        load_dist = int(max(distance_km(latitude, longitude, site['latitude'], site['longitude']) * 1000 + site['radius'] for site in sites))
+        self.map_creator = MapCreator(latitude, longitude, name, load_dist, cameras=cameras, passage_points=[tuple(point) for point in passage_points],
+                                      heatmap_step=heatmap_step, **map_options)
+        # one scale for the whole map, so the split between two sites is a straight line
+        self.x_scale = math.cos(math.radians(latitude))
+        self.site_areas = [{'latitude': site['latitude'], 'longitude': site['longitude'],
+                            'bbox': tuple(ox.utils_geo.bbox_from_point((site['latitude'], site['longitude']), dist=site['radius']))} for site in sites]
+        self.camera_owners = None # made by assign_sites, the index of the site of every camera
+        self.assignments = None # made by assign_sites
+
+    def owners(self, points):
+        """Returns per (lat, lon) point the index of the site it belongs to, -1 for points outside every site"""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        return site_owners(points[:, 1], points[:, 0], self.site_areas, self.x_scale)
+
+    def assign_sites(self):
+        """Assigns the cameras and passage points to the site they lie in, the ones outside every site are kept as unassigned"""
+        mc = self.map_creator
+        camera_owners = self.owners([(camera['latitude'], camera['longitude']) for camera in mc.cameras])
+        point_owners = self.owners(mc.passage_points)
+        self.camera_owners = camera_owners
+        self.assignments = {
+            'sites': [{
+                'name': site['name'],
+                'latitude': site['latitude'],
+                'longitude': site['longitude'],
+                'radius': site['radius'],
+                'cameras': [camera['name'] for camera, owner in zip(mc.cameras, camera_owners) if owner == index],
+                'passage_points': [list(point) for point, owner in zip(mc.passage_points, point_owners) if owner == index]
+            } for index, site in enumerate(self.sites)],
+            'unassigned_cameras': [camera['name'] for camera, owner in zip(mc.cameras, camera_owners) if owner == -1],
+            'unassigned_passage_points': [list(point) for point, owner in zip(mc.passage_points, point_owners) if owner == -1]
+        }
+        for site in self.assignments['sites']:
+            print(f"{site['name']}: {len(site['cameras'])} cameras and {len(site['passage_points'])} passage points")
+        if self.assignments['unassigned_cameras'] or self.assignments['unassigned_passage_points']:
+            print(f"{len(self.assignments['unassigned_cameras'])} cameras and {len(self.assignments['unassigned_passage_points'])} passage points lie outside every site")
+        return self.assignments
+
+    def make_sites(self):
+        """Makes the description of every site for the worker processes"""
+        mc = self.map_creator
+        mc.calculate_epsg_code() # the projection of the map, for the viewsheds of the cameras outside every site
+        grid_origin = (min(area['bbox'][1] for area in self.site_areas), min(area['bbox'][3] for area in self.site_areas))
+        return [{
+            'index': index,
+            'name': site['name'],
+            'map_name': mc.name,
+            'latitude': site['latitude'],
+            'longitude': site['longitude'],
+            'radius': site['radius'],
+            'bbox': self.site_areas[index]['bbox'],
+            'sites': self.site_areas,
+            'x_scale': self.x_scale,
+            'water_buffer_size': site.get('water_buffer_size', mc.water_buffer_size),
+            'road_buffer_size': site.get('road_buffer_size', mc.road_buffer_size),
+            'heatmap_step': self.heatmap_step,
+            'grid_origin': grid_origin, # one grid for all sites, so the grid points of overlapping sites are the same points
+            'attribute_schemas': mc.attribute_schemas,
+            'data_source': mc.data_source,
+            'cameras': [camera for camera, owner in zip(mc.cameras, self.camera_owners) if owner == index],
+            'use_viewsheds': mc.use_viewsheds,
+            'cache_dir': mc.stageCache.cache_dir,
+            'use_cache': mc.stageCache.enabled,
+            'job_id': mc.job_id,
+            'workspace': mc.workspace
+        } for index, site in enumerate(self.sites)]
+
+    def process_sites(self):
+        """Processes all sites in the process pool, returns the summaries of the sites ordered like the sites"""
+        sites = self.make_sites()
+        self.map_creator.data_source.prepare() # a local extract is indexed once here instead of in every worker
+        print(f"Processing {len(sites)} sites..")
+        summaries = []
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(process_site, site) for site in sites]
+            for future in as_completed(futures):
+                summary = future.result()
+                print(f"{summary['name']} done: {summary['buildings']} buildings, {summary['roads']} roads, {summary['waterways']} waterways")
+                summaries.append(summary)
+        return sorted(summaries, key=lambda summary: summary['index'])
+
+    def render(self, summaries):
+        """Adds the sites to the map one at a time, every site gets its own group of layers in the layer control"""
+        mc = self.map_creator
+        groups = {}
+        viewsheds = [None] * len(mc.cameras)
+        gradient = {0.2: 'blue', 0.4: 'lime', 0.6: 'yellow', 0.8: 'orange', 1.0: 'red'}
+
+        for summary in summaries:
+            result = mc.stageCache.load_from_worker('site', summary['key'], summary['spill_path'])
+            if result is None:
+                raise Exception(f"Result of site {summary['name']} is missing from the cache")
+            site_name = summary['name']
+
+            site_area_fg = folium.FeatureGroup(name='Site area')
+            folium.GeoJson(gpd.GeoSeries([result['region']]).__geo_interface__, style_function=mc.mapStyler.style_site_area, tooltip=site_name).add_to(site_area_fg)
+            roads_fg = folium.FeatureGroup(name='Roads')
+            waterways_fg = folium.FeatureGroup(name='Waterways')
+            all_buildings_fg = folium.FeatureGroup(name="All buildings")
+            buffer_area_water_fg = folium.FeatureGroup(name="Buffer area waterways")
+            nearby_buildings_water_fg = folium.FeatureGroup(name="Buildings nearby waterways")
+            buffer_area_road_fg = folium.FeatureGroup(name="Buffer area road")
+            nearby_buildings_road_fg = folium.FeatureGroup(name="Buildings nearby roads")
+            elevation_heatmap = folium.FeatureGroup(name="Elevation heatmap")
+
+            if len(result['roads']) > 0:
+                folium.GeoJson(mc.display_layer(result['roads']), style_function=mc.mapStyler.style_roads).add_to(roads_fg)
+            if len(result['waterways']) > 0:
+                folium.GeoJson(mc.display_layer(result['waterways']), style_function=mc.mapStyler.style_waterways).add_to(waterways_fg)
+            if len(result['buildings']) > 0:
+                buildings = mc.display_layer(result['buildings'])
+                folium.GeoJson(buildings, style_function=mc.mapStyler.style_buildings).add_to(all_buildings_fg)
+                mc.add_buildings_tooltips(buildings, all_buildings_fg, styler=mc.mapStyler.style_buildings, extra_data = {'Digital Twin Name': site_name, 'Building Type': 'general'})
+            if not result['water_buffer'].is_empty:
+                folium.GeoJson(gpd.GeoSeries([mc.display_layer(result['water_buffer'])]).__geo_interface__, style_function=mc.mapStyler.style_buffer_area_water).add_to(buffer_area_water_fg)
+            if len(result['nearby_buildings_water']) > 0:
+                nearby_buildings_water = mc.display_layer(result['nearby_buildings_water'])
+                folium.GeoJson(nearby_buildings_water, style_function=mc.mapStyler.style_nearby_buildings_water).add_to(nearby_buildings_water_fg)
+                mc.add_buildings_tooltips(nearby_buildings_water, nearby_buildings_water_fg, styler=mc.mapStyler.style_nearby_buildings_water, extra_data = {'Digital Twin Name': site_name, 'Building Type': 'within water buffer'})
+            if not result['road_buffer'].is_empty:
+                folium.GeoJson(gpd.GeoSeries([mc.display_layer(result['road_buffer'])]).__geo_interface__, style_function=mc.mapStyler.style_buffer_area_road).add_to(buffer_area_road_fg)
+            if len(result['nearby_buildings_road']) > 0:
+                nearby_buildings_road = mc.display_layer(result['nearby_buildings_road'])
+                folium.GeoJson(nearby_buildings_road, style_function=mc.mapStyler.style_nearby_buildings_road).add_to(nearby_buildings_road_fg)
+                mc.add_buildings_tooltips(nearby_buildings_road, nearby_buildings_road_fg, styler=mc.mapStyler.style_nearby_buildings_road, extra_data = {'Digital Twin Name': site_name, 'Building Type': 'within road buffer'})
+            if len(result['heatmap_data']) > 0:
+                HeatMap(result['heatmap_data'], min_opacity=0.05, radius=15, blur=20, max_zoom=1, gradient=gradient).add_to(elevation_heatmap)
+
+            # the viewsheds come back in the order of the cameras of the site
+            camera_indexes = [index for index, owner in enumerate(self.camera_owners) if owner == summary['index']]
+            for camera_index, viewshed in zip(camera_indexes, result['viewsheds']):
+                viewsheds[camera_index] = viewshed
+
+            groups[site_name] = [site_area_fg, roads_fg, waterways_fg, all_buildings_fg, buffer_area_water_fg, nearby_buildings_water_fg,
+                                 buffer_area_road_fg, nearby_buildings_road_fg, elevation_heatmap]
+            for feature_group in groups[site_name]:
+                feature_group.add_to(mc.m)
+            del result
+
+        self.set_camera_viewsheds(viewsheds)
+        # the site layers get their own control, the basemaps and the injected layers stay in the normal layer control
+        GroupedLayerControl(groups, exclusive_groups=False, collapsed=False).add_to(mc.m)
+        folium.LayerControl(collapsed=False, draggable=True).add_to(mc.m)
+
+    def set_camera_viewsheds(self, viewsheds):
+        """Gives the map creator the viewsheds in its projection for the camera scripts, a camera outside every site keeps its whole cone"""
+        mc = self.map_creator
+        if not mc.use_viewsheds or len(mc.cameras) == 0:
+            mc.camera_viewsheds = None
+            return
+        cones = camera_cones(mc.cameras, mc.epsg_code).to_numpy()
+        projected = gpd.GeoSeries(viewsheds, crs='EPSG:4326').to_crs(epsg=mc.epsg_code).to_numpy()
+        mc.camera_viewsheds = np.array([cone if viewshed is None else viewshed for cone, viewshed in zip(cones, projected)], dtype=object)
+
+    def save_assignments(self):
+        """Saves the sites with their cameras, passage points and feature counts as multiSite_<name>.json in the workspace"""
+        mc = self.map_creator
+        with open(os.path.join(mc.workspace, 'geoJsonFiles', f'multiSite_{mc.name}.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.assignments, f, indent=4)
+
+    def create_map(self):
+        """
+        Assigns the cameras and passage points, processes the sites, renders them and saves and publishes the map with the injected javascript.
+        Returns the name of the versioned map within the static folder
+        """
+        mc = self.map_creator
+        status = 'failed'
+        try:
+            with mc.instrumentation.profiling():
+                self.assign_sites()
+                with mc.writing_span('process_sites') as span:
+                    summaries = self.process_sites()
+                    span['sites'] = len(summaries)
+                for site, summary in zip(self.assignments['sites'], summaries):
+                    site.update({'buildings': summary['buildings'], 'roads': summary['roads'], 'waterways': summary['waterways']})
+                with mc.writing_span('render_sites'):
+                    self.render(summaries)
+                with mc.writing_span('save_map'):
+                    mc.save_map()
+                    self.save_assignments()
+                map_name = mc.publish()
+            status = 'succeeded'
+            return map_name
+        finally:
+            try:
+                mc.finish_instrumentation(status)
+            finally:
+                mc.remove_workspace()
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Generate one digital twin of several sites, the sites are processed in parallel")
+    parser.add_argument('sites_file', help="json file with a list of site specs (latitude, longitude, name, radius, and optionally water_buffer_size, road_buffer_size, cameras, passage_points), the cameras and passage points of all specs are assigned to the sites again")
+    parser.add_argument('--name', required=True, help="name of the map")
+    parser.add_argument('--workers', type=int, default=None, help="number of processes, defaults to the number of cores")
+    args = parser.parse_args(args)
+
+    sites = BatchGenerator.load_sites(args.sites_file)
+    cameras = [camera for site in sites for camera in site.get('cameras', [])]
+    passage_points = [tuple(point) for site in sites for point in site.get('passage_points', [])]
+    multiSiteMapCreator = MultiSiteMapCreator(sites, args.name, cameras, passage_points, max_workers=args.workers)
+    print("The name of the map is: ", multiSiteMapCreator.create_map())
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from stageCache import STAGE_CACHE_VERSION
+
+try:
+    import fcntl # not available on windows, the index is then only locked between the threads of one process
+except ImportError:
+    fcntl = None
+
+# bump this when the generated maps change (or the OpenStreetMap data should be downloaded again), so old maps are not served anymore
+DATA_VERSION = 1
+
+class ResultCache:
+    """
+    Index of the generated maps, so a request for a map that was made before returns the existing map right away.
+    A map is keyed by a hash of the parameters it was made with (location, name, area, buffers, cameras, passage points)
+    together with the data version. The index is capped in number of maps and in bytes, when it is full the least recently used maps
+    are evicted and their files are removed from disk. The index is a json file that is written atomically under a file lock,
+    so the workers of a server can share it
+
+    Parameters:
+    index_path: str, path of the json file of the index
+    max_maps: int, max number of maps in the index, None is no limit
+    max_bytes: int, max total size of the files of the maps in the index, None is no limit
+    """
+    def __init__(self, index_path='cache/results/index.json', max_maps=100, max_bytes=None):
+        self.index_path = index_path
+        self.max_maps = max_maps
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def make_key(parameters):
+        """
+        Makes the key of a map, the key changes whenever a parameter or the data version changes
+
+        Parameters:
+        parameters: dict, json serializable parameters the map is made with
+        """
+        payload = json.dumps({
+            'data_version': DATA_VERSION,
+            'stage_cache_version': STAGE_CACHE_VERSION,
+            'parameters': parameters
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+    @contextmanager
+    def locked(self):
+        """Holds the lock of the index for the with block, between threads and (where fcntl exists) between processes"""
+        with self.lock:
+            os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+            if fcntl is None:
+                yield
+                return
+            with open(self.index_path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_index(self):
+        """Returns the entries of the index, an empty index when the file does not exist (or is not readable)"""
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_index(self, entries):
+        """Writes the index under a temporary name and renames it afterwards, so a reader never sees a half written index"""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.index_path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, indent=4)
+            os.replace(tmp_path, self.index_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def lookup(self, key):
+        """
+        Returns the entry of a map (map_name, files, bytes, created, last_used) and marks it as used,
+        None when the map is not in the index or its map file is gone
+        """
+        with self.locked():
+            entries = self.read_index()
+            entry = entries.get(key)
+            if entry is None:
+                return None
+            if not os.path.exists(os.path.join('static', entry['map_name'])):
+                del entries[key] # removed by hand, the map is made again
+                self.write_index(entries)
+                return None
+            entry['last_used'] = time.time()
+            entry['hits'] = entry.get('hits', 0) + 1
+            self.write_index(entries)
+            return entry
+
+    def store(self, key, map_name, files, parameters=None):
+        """
+        Adds a generated map to the index and evicts the least recently used maps when the index is full.
+        Returns the entry of the map
+
+        Parameters:
+        key: str, key of the map from make_key
+        map_name: str, name of the map within the static folder
+        files: list, paths of all files of the map, these are removed when the map is evicted
+        parameters: dict, parameters the map was made with, kept in the index to see what it holds
+        """
+        now = time.time()
+        entry = {
+            'map_name': map_name,
+            'files': list(files),
+            'bytes': sum(os.path.getsize(path) for path in files if os.path.exists(path)),
+            'created': now,
+            'last_used': now,
+            'hits': 0,
+            'parameters': parameters
+        }
+        with self.locked():
+            entries = self.read_index()
+            previous = entries.pop(key, None)
+            if previous is not None and previous['map_name'] != map_name:
+                self.remove_files(previous) # the same map was made twice at once, the older one is not used anymore
+            entries[key] = entry
+            self.evict(entries, keep=key)
+            self.write_index(entries)
+        return entry
+
+    def evict(self, entries, keep=None):
+        """Removes the least recently used maps (and their files) from the entries until the limits are met, the map with key keep stays"""
+        evicted = []
+        while True:
+            too_many = self.max_maps is not None and len(entries) > self.max_maps
+            too_large = self.max_bytes is not None and sum(entry['bytes'] for entry in entries.values()) > self.max_bytes
+            candidates = [key for key in entries if key != keep]
+            if not (too_many or too_large) or not candidates:
+                break
+            oldest = min(candidates, key=lambda key: entries[key]['last_used'])
+            self.remove_files(entries.pop(oldest))
+            evicted.append(oldest)
+        if evicted:
+            print(f"Evicted {len(evicted)} maps from the result cache")
+        return evicted
+
+    @staticmethod
+    def remove_files(entry):
+        """Removes the files of a map from disk"""
+        for path in entry['files']:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def stats(self):
+        """Returns the number of maps, their total size and the number of hits in the index"""
+        with self.locked():
+            entries = self.read_index()
+        return {
+            'maps': len(entries),
+            'bytes': sum(entry['bytes'] for entry in entries.values()),
+            'hits': sum(entry.get('hits', 0) for entry in entries.values())
+        }
@@ -0,0 +1,258 @@
+import numpy as np
+import geopandas as gpd
+import shapely
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.ndimage import binary_dilation
+from scipy.spatial import cKDTree
+
+# speeds in km/h per highway type, used when a road has no (readable) maxspeed. links get the speed of their road type
+ROAD_SPEEDS_KPH = {
+    'motorway': 100, 'trunk': 80, 'primary': 60, 'secondary': 50, 'tertiary': 50,
+    'unclassified': 40, 'residential': 30, 'living_street': 15, 'service': 20, 'road': 30,
+    'track': 15, 'busway': 30, 'cycleway': 15, 'bridleway': 5, 'footway': 5, 'path': 5,
+    'pedestrian': 5, 'steps': 3, 'corridor': 5, 'elevator': 3
+}
+DEFAULT_SPEED_KPH = 30
+
+METERS_PER_DEGREE = 111320
+
+def parse_speed(value):
+    """Returns the speed in km/h of an osm maxspeed value (like '50', '30 mph' or a list of those), nan when it can not be read"""
+    if isinstance(value, list):
+        speeds = [parse_speed(item) for item in value]
+        speeds = [speed for speed in speeds if not np.isnan(speed)]
+        return min(speeds) if speeds else np.nan
+    if not isinstance(value, str):
+        return float(value) if isinstance(value, (int, float)) else np.nan
+    number = value.strip().split(' ')[0]
+    try:
+        speed = float(number)
+    except ValueError:
+        return np.nan
+    return speed * 1.609344 if 'mph' in value else speed
+
+def highway_speed(value, speeds):
+    """Returns the speed in km/h for an osm highway value (or a list of those) from the speeds per highway type"""
+    if isinstance(value, list):
+        return max(highway_speed(item, speeds) for item in value)
+    if not isinstance(value, str):
+        return DEFAULT_SPEED_KPH
+    return speeds.get(value.replace('_link', ''), DEFAULT_SPEED_KPH)
+
+def grid_to_polygon(grid, x0, y0, cell_size):
+    """
+    Returns the polygon of the True cells of a grid, every run of True cells in a row becomes one box before merging,
+    which is a lot faster than merging every cell or buffering and merging the lines the grid was made from
+
+    Parameters:
+    grid: array, 2d boolean grid, the first row is the lowest y
+    x0: float, x of the left side of the grid
+    y0: float, y of the bottom side of the grid
+    cell_size: float, size of the cells
+    """
+    changes = np.diff(np.pad(grid, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    run_rows, run_starts = np.nonzero(changes == 1)
+    _, run_ends = np.nonzero(changes == -1)
+    boxes = shapely.box(x0 + run_starts * cell_size, y0 + run_rows * cell_size, x0 + run_ends * cell_size, y0 + (run_rows + 1) * cell_size)
+    return shapely.simplify(shapely.union_all(boxes), cell_size / 2)
+
+class RoadGraph:
+    """
+    Compact array form of the osmnx road network, to compute travel times and isochrones without networkx.
+    The edges are kept as arrays (start node, end node, length, speed and the coordinates of the geometry) and are turned into
+    a CSR sparse matrix of travel times, on which a multi source dijkstra gives the travel time from the nearest source to every node
+
+    Parameters:
+    node_ids: array, osm ids of the nodes
+    latitudes: array, latitudes of the nodes
+    longitudes: array, longitudes of the nodes
+    edge_u: array, positions of the start nodes of the edges
+    edge_v: array, positions of the end nodes of the edges
+    lengths: array, lengths of the edges in meters
+    speeds: array, speeds of the edges in km/h
+    coordinates: array, (lon, lat) coordinates of the geometries of all edges after each other
+    offsets: array, start of the coordinates of every edge in coordinates, with the end as last value
+    """
+    def __init__(self, node_ids, latitudes, longitudes, edge_u, edge_v, lengths, speeds, coordinates, offsets):
+        self.node_ids = node_ids
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.edge_u = edge_u
+        self.edge_v = edge_v
+        self.lengths = lengths
+        self.speeds = speeds
+        self.coordinates = coordinates
+        self.offsets = offsets
+        self.origin = (float(np.mean(latitudes)), float(np.mean(longitudes))) if len(latitudes) > 0 else (0.0, 0.0)
+        self.matrices = {}
+        self.tree = None
+        self.lines = None
+
+    def __getstate__(self):
+        # the matrices, the tree and the lines are rebuilt when needed, so they are not stored
+        state = self.__dict__.copy()
+        state['matrices'] = {}
+        state['tree'] = None
+        state['lines'] = None
+        return state
+
+    @classmethod
+    def from_graph(cls, G, speeds=ROAD_SPEEDS_KPH):
+        """
+        Makes the RoadGraph of an osmnx graph
+
+        Parameters:
+        G: networkx.MultiDiGraph, graph from osmnx
+        speeds: dict, speed in km/h per highway type for the roads without maxspeed
+        """
+        node_ids = np.array(list(G.nodes), dtype=np.int64)
+        position = {node_id: index for index, node_id in enumerate(node_ids.tolist())}
+        latitudes = np.array([data['y'] for _, data in G.nodes(data=True)], dtype=float)
+        longitudes = np.array([data['x'] for _, data in G.nodes(data=True)], dtype=float)
+
+        edge_u, edge_v, lengths, edge_speeds, coordinates, counts = [], [], [], [], [], []
+        for u, v, data in G.edges(data=True):
+            edge_u.append(position[u])
+            edge_v.append(position[v])
+            lengths.append(data.get('length', 0.0))
+            speed = parse_speed(data.get('maxspeed'))
+            edge_speeds.append(speed if speed > 0 else highway_speed(data.get('highway'), speeds))
+            if 'geometry' in data:
+                edge_coordinates = shapely.get_coordinates(data['geometry'])
+            else:
+                edge_coordinates = np.array([[longitudes[position[u]], latitudes[position[u]]], [longitudes[position[v]], latitudes[position[v]]]])
+            coordinates.append(edge_coordinates)
+            counts.append(len(edge_coordinates))
+
+        return cls(
+            node_ids, latitudes, longitudes,
+            np.array(edge_u, dtype=np.int32), np.array(edge_v, dtype=np.int32),
+            np.array(lengths, dtype=float), np.array(edge_speeds, dtype=float),
+            np.concatenate(coordinates) if coordinates else np.zeros((0, 2)),
+            np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        )
+
+    def edge_times(self, speed_kph=None):
+        """Returns the travel time in seconds of every edge, with the speeds of the edges or with one speed for all edges"""
+        speeds = self.speeds if speed_kph is None else np.full(len(self.speeds), float(speed_kph))
+        # csgraph does not see zero weights as edges, so every edge takes at least a millisecond
+        return np.maximum(self.lengths / (speeds / 3.6), 0.001)
+
+    def travel_time_matrix(self, speed_kph=None):
+        """
+        Returns the CSR matrix of the travel times in seconds between the nodes, parallel edges keep the fastest one.
+        The matrix is made once per speed and kept
+
+        Parameters:
+        speed_kph: float, one speed for all edges (like 5 for walking), None uses the speeds of the edges
+        """
+        if speed_kph not in self.matrices:
+            times = self.edge_times(speed_kph)
+            # sort so the fastest of the parallel edges comes first, then drop the others
+            order = np.lexsort((times, self.edge_v, self.edge_u))
+            pairs = self.edge_u[order].astype(np.int64) * len(self.node_ids) + self.edge_v[order]
+            first = np.concatenate([[True], pairs[1:] != pairs[:-1]]) if len(pairs) > 0 else np.zeros(0, dtype=bool)
+            order = order[first]
+            self.matrices[speed_kph] = csr_matrix((times[order], (self.edge_u[order], self.edge_v[order])), shape=(len(self.node_ids), len(self.node_ids)))
+        return self.matrices[speed_kph]
+
+    def to_local(self, latitudes, longitudes):
+        """Returns x, y in meters around the center of the graph, accurate enough within a site of a few kilometers"""
+        lat0, lon0 = self.origin
+        x = (np.asarray(longitudes) - lon0) * METERS_PER_DEGREE * np.cos(np.radians(lat0))
+        y = (np.asarray(latitudes) - lat0) * METERS_PER_DEGREE
+        return x, y
+
+    def nearest_nodes(self, points):
+        """
+        Returns the positions of the nodes nearest to the points
+
+        Parameters:
+        points: list, tuples with lat, lon
+        """
+        if self.tree is None:
+            self.tree = cKDTree(np.column_stack(self.to_local(self.latitudes, self.longitudes)))
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        _, positions = self.tree.query(np.column_stack(self.to_local(points[:, 0], points[:, 1])))
+        return positions
+
+    def travel_times(self, sources, speed_kph=None, limit=np.inf):
+        """
+        Returns the travel time in seconds from the nearest source to every node, inf for the nodes that can not be reached within limit
+
+        Parameters:
+        sources: list, tuples with lat, lon of the starting points
+        speed_kph: float, one speed for all edges, None uses the speeds of the edges
+        limit: float, the search stops at this travel time in seconds, which makes small isochrones fast
+        """
+        if len(sources) == 0 or len(self.node_ids) == 0:
+            return np.full(len(self.node_ids), np.inf)
+        return dijkstra(self.travel_time_matrix(speed_kph), directed=True, indices=np.unique(self.nearest_nodes(sources)), min_only=True, limit=limit)
+
+    def edge_lines(self):
+        """Returns the edges as shapely lines in the local meters of to_local"""
+        if self.lines is None:
+            x, y = self.to_local(self.coordinates[:, 1], self.coordinates[:, 0])
+            edge_index = np.repeat(np.arange(len(self.edge_u)), np.diff(self.offsets))
+            self.lines = shapely.linestrings(np.column_stack([x, y]), indices=edge_index) if len(edge_index) > 0 else np.array([], dtype=object)
+        return self.lines
+
+    def isochrones(self, sources, minutes=(2, 5, 10), speed_kph=None, buffer_size=25, cell_size=10):
+        """
+        Returns the areas that can be reached from the nearest source within the minutes, as a GeoDataFrame with a polygon per number of minutes.
+        An area is the reached part of the roads with a buffer around it. Buffering and merging thousands of road lines is slow,
+        so the reached roads are sampled into a grid of cell_size meters instead, the grid is grown by the buffer and the rows of the grid
+        become the polygon. Points along an edge get the travel time of the part of the edge before them, so partly reached edges are cut off
+
+        Parameters:
+        sources: list, tuples with lat, lon of the starting points
+        minutes: list, travel times in minutes to make an area for
+        speed_kph: float, one speed for all edges (like 5 for walking), None uses the speeds of the edges
+        buffer_size: float, meters around the reached roads that count as reached
+        cell_size: float, size of the grid cells in meters, the edges of the areas are as precise as this
+        """
+        minutes = sorted(minutes)
+        max_seconds = max(minutes) * 60 if minutes else 0
+        times = self.travel_times(sources, speed_kph, limit=max_seconds)
+        reached = np.flatnonzero(times[self.edge_u] < max_seconds)
+
+        geometries = [shapely.Polygon()] * len(minutes)
+        if len(reached) > 0:
+            # points every half cell along the reached edges, with the travel time at every point
+            points, point_edge = shapely.get_coordinates(shapely.segmentize(self.edge_lines()[reached], cell_size / 2), return_index=True)
+            step = np.concatenate([[0], np.hypot(*np.diff(points, axis=0).T)])
+            first = np.concatenate([[True], point_edge[1:] != point_edge[:-1]])
+            step[first] = 0
+            along = np.cumsum(step)
+            along -= np.maximum.accumulate(np.where(first, along, 0))
+            edge_length = np.zeros(len(reached))
+            np.maximum.at(edge_length, point_edge, along)
+            fraction = along / np.maximum(edge_length[point_edge], 1e-9)
+            point_times = times[self.edge_u[reached]][point_edge] + fraction * self.edge_times(speed_kph)[reached][point_edge]
+
+            margin = int(np.ceil(buffer_size / cell_size)) + 1
+            x0, y0 = points.min(axis=0) - margin * cell_size
+            columns = ((points[:, 0] - x0) // cell_size).astype(int)
+            rows = ((points[:, 1] - y0) // cell_size).astype(int)
+            shape = (rows.max() + margin + 1, columns.max() + margin + 1)
+            radius = buffer_size / cell_size
+            offset_y, offset_x = np.mgrid[-margin:margin + 1, -margin:margin + 1]
+            disk = offset_x ** 2 + offset_y ** 2 <= radius ** 2
+
+            for position, cutoff in enumerate(minutes):
+                inside = point_times <= cutoff * 60
+                if not inside.any():
+                    continue
+                grid = np.zeros(shape, dtype=bool)
+                grid[rows[inside], columns[inside]] = True
+                grid = binary_dilation(grid, structure=disk)
+                geometries[position] = shapely.transform(grid_to_polygon(grid, x0, y0, cell_size), self.to_lonlat)
+
+        isochrones = gpd.GeoDataFrame({'minutes': minutes}, geometry=geometries, crs='EPSG:4326')
+        return isochrones.iloc[::-1].reset_index(drop=True) # the largest area first, so the smaller ones are drawn on top
+
+    def to_lonlat(self, coordinates):
+        """Returns (lon, lat) coordinates of (x, y) coordinates in the local meters of to_local"""
+        lat0, lon0 = self.origin
+        return np.column_stack([lon0 + coordinates[:, 0] / (METERS_PER_DEGREE * np.cos(np.radians(lat0))), lat0 + coordinates[:, 1] / METERS_PER_DEGREE])
@@ -0,0 +1,265 @@
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+
+# the layers of a site that can be queried, published by MapCreator as geoJsonFiles/<layer>_<name>.geojson
+SITE_LAYERS = ('buildings', 'roads', 'waterways', 'blindSpots', 'floodExposure')
+
+# versioned files end with the job id, like _20240101120000_1a2b3c4d, only the unversioned (latest) files are loaded
+_JOB_ID = re.compile(r'_\d{14}_[0-9a-f]{8}$')
+
+def is_missing(value):
+    """Returns True for None and nan values, these are left out of the properties"""
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+def plain_value(value):
+    """Returns numpy numbers as python numbers, so they can be turned into json"""
+    return value.item() if isinstance(value, np.generic) else value
+
+class SpatialLayer:
+    """
+    One layer of a site in memory: the features in lat/lon for the answers and in the UTM zone of the site for the queries,
+    with a shapely STRtree over the projected geometries so a query only tests the features near it
+
+    Parameters:
+    gdf: GeoDataFrame, the layer in EPSG:4326
+    crs: pyproj CRS, projection in meters to query in, like the UTM zone of the site
+    """
+    def __init__(self, gdf, crs):
+        self.gdf = gdf.reset_index(drop=True)
+        self.geometries = self.gdf.geometry.to_crs(crs).to_numpy()
+        self.tree = shapely.STRtree(self.geometries)
+        self.split_geometries = None # made by pieces on the first distance query
+
+    def __len__(self):
+        return len(self.gdf)
+
+    def filter_mask(self, filters):
+        """
+        Returns a mask of the features that match all filters, a filter is column=value (several values separated by commas)
+        or column__gte=number and column__lte=number for numeric comparisons. Unknown columns match nothing
+
+        Parameters:
+        filters: dict, filters as they come from the query string
+        """
+        mask = np.ones(len(self.gdf), dtype=bool)
+        for key, value in filters.items():
+            column, _, operator = key.partition('__')
+            if column not in self.gdf.columns or column == self.gdf.geometry.name:
+                return np.zeros(len(self.gdf), dtype=bool)
+            if operator in ('gte', 'lte'):
+                numbers = pd.to_numeric(self.gdf[column].astype(str).str.extract(r'(-?[0-9]+(?:\.[0-9]+)?)')[0], errors='coerce')
+                mask &= (numbers >= float(value)).to_numpy() if operator == 'gte' else (numbers <= float(value)).to_numpy()
+            else:
+                mask &= self.gdf[column].astype(str).isin(value.split(',')).to_numpy()
+        return mask
+
+    def features(self, indices, extra=None):
+        """
+        Returns the features as a GeoJSON FeatureCollection dict
+
+        Parameters:
+        indices: array, positions of the features in the layer
+        extra: dict, column name to an array of values (one per index) that is added to the properties, like the distance
+        """
+        subset = self.gdf.iloc[np.asarray(indices, dtype=np.int64)]
+        if extra:
+            subset = subset.assign(**extra)
+        # a few times faster than GeoDataFrame.to_json, the geometries are turned into geojson all at once
+        geometries = shapely.to_geojson(subset.geometry.to_numpy())
+        properties = subset.drop(columns=subset.geometry.name).astype(object).to_dict('records')
+        return {
+            'type': 'FeatureCollection',
+            'features': [{'type': 'Feature', 'properties': {key: plain_value(value) for key, value in feature_properties.items() if not is_missing(value)},
+                          'geometry': json.loads(geometry)} for feature_properties, geometry in zip(properties, geometries)]
+        }
+
+    def pieces(self):
+        """
+        Returns the geometries to measure distances to this layer with: lines are split into their segments, so the tree of another layer
+        only has to test what is near every segment instead of everything in the bounding box of a long line
+        """
+        if self.split_geometries is None:
+            is_line = np.isin(shapely.get_type_id(self.geometries), [1, 5]) # LineString and MultiLineString
+            coordinates, part = shapely.get_coordinates(shapely.get_parts(self.geometries[is_line]), return_index=True)
+            same_part = part[1:] == part[:-1]
+            segments = shapely.linestrings(np.stack([coordinates[:-1][same_part], coordinates[1:][same_part]], axis=1)) if same_part.any() else np.array([], dtype=object)
+            self.split_geometries = np.concatenate([self.geometries[~is_line], segments])
+        return self.split_geometries
+
+class SiteLayers:
+    """
+    The published layers of one generated site loaded in memory, the queries are answered in meters in the UTM zone of the site
+
+    Parameters:
+    name: str, name of the site (the name the map was generated with)
+    geojson_dir: str, directory the layers were published in
+    """
+    def __init__(self, name, geojson_dir='geoJsonFiles'):
+        self.name = name
+        self.geojson_dir = geojson_dir
+        self.paths = {layer: os.path.join(geojson_dir, f'{layer}_{name}.geojson') for layer in SITE_LAYERS}
+        self.paths = {layer: path for layer, path in self.paths.items() if os.path.exists(path)}
+        if not self.paths:
+            raise KeyError(f"No layers found for site {name} in {geojson_dir}")
+        self.mtimes = {layer: os.path.getmtime(path) for layer, path in self.paths.items()}
+        frames = {layer: gpd.read_file(path).to_crs(epsg=4326) for layer, path in self.paths.items()}
+        reference = next((frame for frame in frames.values() if len(frame) > 0), None)
+        self.crs = reference.estimate_utm_crs() if reference is not None else 'EPSG:3857'
+        self.to_projected = Transformer.from_crs(4326, self.crs, always_xy=True)
+        self.layers = {layer: SpatialLayer(frame, self.crs) for layer, frame in frames.items()}
+
+    def is_stale(self):
+        """Returns True when a layer file was published again (or removed) since it was loaded"""
+        return any(not os.path.exists(path) or os.path.getmtime(path) != self.mtimes[layer] for layer, path in self.paths.items())
+
+    def layer(self, name):
+        """Returns a SpatialLayer of the site, a KeyError when the site does not have it"""
+        if name not in self.layers:
+            raise KeyError(f"Site {self.name} has no layer {name}, it has {', '.join(self.layers)}")
+        return self.layers[name]
+
+    def project_point(self, latitude, longitude):
+        """Returns a point in the projection of the site"""
+        x, y = self.to_projected.transform(longitude, latitude)
+        return shapely.Point(x, y)
+
+    def query(self, layer_name, bbox=None, filters={}, limit=1000):
+        """
+        Returns the features of a layer that intersect a bounding box in lat/lon and match the filters
+
+        Parameters:
+        layer_name: str, name of the layer, like buildings
+        bbox: tuple, (min_lon, min_lat, max_lon, max_lat), None is the whole site
+        filters: dict, attribute filters, see SpatialLayer.filter_mask
+        limit: int, max number of features in the answer
+        """
+        layer = self.layer(layer_name)
+        if bbox is None:
+            indices = np.arange(len(layer))
+        else:
+            min_lon, min_lat, max_lon, max_lat = bbox
+            # the edges of the box are densified so the box keeps its shape in the projection
+            box = shapely.segmentize(shapely.box(min_lon, min_lat, max_lon, max_lat), max(max_lon - min_lon, max_lat - min_lat) / 16 or 1)
+            projected_box = shapely.transform(box, lambda coordinates: np.column_stack(self.to_projected.transform(coordinates[:, 0], coordinates[:, 1])))
+            indices = np.sort(layer.tree.query(projected_box, predicate='intersects'))
+        indices = indices[layer.filter_mask(filters)[indices]]
+        return self.answer(layer, indices, limit)
+
+    def nearest(self, layer_name, latitude, longitude, max_distance=None, filters={}, count=1):
+        """
+        Returns the features of a layer closest to a point, with their distance in meters
+
+        Parameters:
+        layer_name: str, name of the layer, like buildings or roads
+        latitude, longitude: float, the point
+        max_distance: float, only features within this many meters, None is no limit
+        filters: dict, attribute filters, see SpatialLayer.filter_mask
+        count: int, number of features, the closest first
+        """
+        layer = self.layer(layer_name)
+        point = self.project_point(latitude, longitude)
+        mask = layer.filter_mask(filters)
+        if count == 1 and mask.all():
+            indices = layer.tree.query_nearest(point, max_distance=max_distance, all_matches=False)
+        else:
+            # the filters and counts above one can not be given to the tree, the candidates grow until enough of them match
+            reach = max_distance if max_distance is not None else 100
+            while True:
+                indices = layer.tree.query(point, predicate='dwithin', distance=reach)
+                indices = indices[mask[indices]]
+                if len(indices) >= count or (max_distance is not None and reach >= max_distance) or reach > 1e6:
+                    break
+                reach *= 4
+        distances = shapely.distance(layer.geometries[indices], point)
+        order = np.argsort(distances, kind='stable')[:count]
+        return self.answer(layer, indices[order], count, {'distance_m': np.round(distances[order], 2)})
+
+    def within_distance(self, layer_name, other_layer_name, distance, filters={}, limit=1000):
+        """
+        Returns the features of a layer within a distance of any feature of another layer, like the buildings within 50 m of water
+
+        Parameters:
+        layer_name: str, name of the layer to return the features of, like buildings
+        other_layer_name: str, name of the layer to measure the distance to, like waterways
+        distance: float, distance in meters
+        filters: dict, attribute filters on the features of layer_name, see SpatialLayer.filter_mask
+        limit: int, max number of features in the answer
+        """
+        layer = self.layer(layer_name)
+        other = self.layer(other_layer_name)
+        if len(other.pieces()) == 0:
+            return self.answer(layer, np.zeros(0, dtype=np.int64), limit)
+        # every piece of the other layer is tested against the tree at once, a feature can be near several of them
+        _, indices = layer.tree.query(other.pieces(), predicate='dwithin', distance=distance)
+        indices = np.unique(indices)
+        indices = indices[layer.filter_mask(filters)[indices]]
+        return self.answer(layer, indices, limit)
+
+    @staticmethod
+    def answer(layer, indices, limit, extra=None):
+        """Returns the first limit features as a FeatureCollection dict, with the number of matches before the limit"""
+        limited = indices[:limit]
+        collection = layer.features(limited, {key: values[:limit] for key, values in extra.items()} if extra else None)
+        collection['matched'] = int(len(indices))
+        collection['returned'] = int(len(limited))
+        return collection
+
+    def summary(self):
+        """Returns the layers of the site with their number of features and columns"""
+        return {
+            'name': self.name,
+            'crs': str(self.crs),
+            'layers': {name: {'features': len(layer), 'columns': [column for column in layer.gdf.columns if column != layer.gdf.geometry.name]} for name, layer in self.layers.items()}
+        }
+
+class SpatialStore:
+    """
+    Keeps the layers of the generated sites in memory for the query api of the Flask app. A site is loaded on its first query
+    and loaded again when its files were published again, the least recently used sites are dropped when more than max_sites are loaded
+
+    Parameters:
+    geojson_dir: str, directory the layers are published in
+    max_sites: int, max number of sites kept in memory
+    """
+    def __init__(self, geojson_dir='geoJsonFiles', max_sites=8):
+        self.geojson_dir = geojson_dir
+        self.max_sites = max_sites
+        self.sites = OrderedDict()
+        self.lock = threading.Lock()
+
+    def site_names(self):
+        """Returns the names of the sites that have published layers"""
+        if not os.path.isdir(self.geojson_dir):
+            return []
+        names = set()
+        for file_name in os.listdir(self.geojson_dir):
+            base, extension = os.path.splitext(file_name)
+            layer, _, name = base.partition('_')
+            if extension == '.geojson' and layer in SITE_LAYERS and name and not _JOB_ID.search(name):
+                names.add(name)
+        return sorted(names)
+
+    def site(self, name):
+        """Returns the SiteLayers of a site, loads it when it is not in memory or its files changed"""
+        with self.lock:
+            site = self.sites.get(name)
+            if site is not None and not site.is_stale():
+                self.sites.move_to_end(name)
+                return site
+        # loading can take a while, other sites can be queried in the meantime
+        site = SiteLayers(name, self.geojson_dir)
+        with self.lock:
+            self.sites[name] = site
+            self.sites.move_to_end(name)
+            while len(self.sites) > self.max_sites:
+                self.sites.popitem(last=False)
+        return site
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+# bump this when the output of a stage changes shape, so old cached results are not reused
+STAGE_CACHE_VERSION = 3
+
+# the stages that hold downloaded OpenStreetMap data, they are downloaded again when they are older than max_download_age
+DOWNLOAD_STAGES = ('download', 'tile', 'site')
+
+class StageCache:
+    """
+    Memoizes the results of the map generation stages on disk.
+    Every stage is keyed by a hash of its own inputs together with the keys of the stages it depends on,
+    so a stage only reruns when something upstream of it changed.
+    The cache is a least recently used cache like the TileCache: the modification time of a file is its last use and when the results
+    take more than max_bytes the least recently used ones are removed, down to 90%. The stages in DOWNLOAD_STAGES are computed again
+    when they were stored longer than max_download_age ago, so the OpenStreetMap data is refreshed
+
+    Parameters:
+    cache_dir: str, directory where the stage results are stored
+    enabled: bool, if False every stage is recomputed and nothing is read from or written to disk
+    max_bytes: int, max total size of the stored results, None uses the STAGE_CACHE_MAX_MB environment variable (default 2000), 0 is no limit
+    max_download_age: float, seconds a downloaded stage is reused, None uses the STAGE_CACHE_DOWNLOAD_DAYS environment variable (default 30), 0 is no limit
+    """
+    def __init__(self, cache_dir='cache/stages', enabled=True, max_bytes=None, max_download_age=None):
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.max_bytes = max_bytes if max_bytes is not None else float(os.environ.get('STAGE_CACHE_MAX_MB', 2000)) * 1e6
+        self.max_download_age = max_download_age if max_download_age is not None else float(os.environ.get('STAGE_CACHE_DOWNLOAD_DAYS', 30)) * 24 * 3600
+        self.lock = threading.Lock()
+        self.total_bytes = None # counted on the first stored result, other processes can store results too so an eviction counts again
+        if self.enabled and not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def make_key(self, stage, inputs, parents=()):
+        """
+        Makes the key of a stage, the key changes whenever the inputs or any of the parent keys change
+
+        Parameters:
+        stage: str, name of the stage
+        inputs: dict, json serializable inputs of the stage
+        parents: iterable, keys of the stages this stage depends on
+        """
+        payload = json.dumps({
+            'version': STAGE_CACHE_VERSION,
+            'stage': stage,
+            'inputs': inputs,
+            'parents': list(parents)
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def path(self, stage, key):
+        """Returns the path of the file a stage result is stored in"""
+        return os.path.join(self.cache_dir, f'{stage}_{key}.pkl')
+
+    def load(self, stage, key):
+        """
+        Returns the stored result of a stage and marks it as used, None when it is not stored (or not readable)
+        or when it is a download that is older than max_download_age
+        """
+        if not self.enabled:
+            return None
+        path = self.path(stage, key)
+        try:
+            with open(path, 'rb') as f:
+                stored, result = pickle.load(f)
+            os.utime(path)
+        except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+            return None # not stored, or evicted by another process right now
+        if stage in DOWNLOAD_STAGES and self.max_download_age and time.time() - stored > self.max_download_age:
+            print(f"Cached result of stage '{stage}' is older than {self.max_download_age / 86400:.0f} days, downloading again")
+            return None
+        return result
+
+    def store(self, stage, key, result):
+        """
+        Stores the result of a stage with the time it was stored, the file is written under a temporary name and renamed afterwards
+        so a reader never sees a half written result, even with several generations running at once
+        """
+        if not self.enabled:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((time.time(), result), f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, self.path(stage, key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self.scan())
+            else:
+                self.total_bytes += size
+            if self.max_bytes and self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def scan(self):
+        """Returns the last use, size and path of every stored result"""
+        results = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith('.pkl'):
+                path = os.path.join(self.cache_dir, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                results.append((stat.st_mtime, stat.st_size, path))
+        return results
+
+    def evict(self):
+        """Removes the least recently used results until they take at most 90% of max_bytes, returns the number of removed results"""
+        results = sorted(self.scan())
+        self.total_bytes = sum(size for _, size, _ in results)
+        removed = 0
+        for _, size, path in results:
+            if self.total_bytes <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
+            removed += 1
+        if removed:
+            print(f"Evicted {removed} results from the stage cache")
+        return removed
+
+    def run(self, stage, inputs, compute, parents=()):
+        """
+        Returns the key and the result of a stage, compute is only called when there is no stored result for the key
+
+        Parameters:
+        stage: str, name of the stage
+        inputs: dict, json serializable inputs of the stage
+        compute: function without arguments that computes the result of the stage
+        parents: iterable, keys of the stages this stage depends on
+        """
+        key = self.make_key(stage, inputs, parents)
+        result = self.load(stage, key)
+        if result is not None:
+            print(f"Stage '{stage}' is up to date, using cached result")
+            return key, result
+
+        print(f"Running stage '{stage}'..")
+        result = compute()
+        self.store(stage, key, result)
+        return key, result
+
+    def run_in_worker(self, stage, inputs, compute, spill_dir, parents=()):
+        """
+        Like run, for a worker process whose result is read back by the parent process with load_from_worker.
+        The result is read back from the cache, so it never goes through the pipe of the pool. When the cache is disabled
+        the result is written to a temporary file in spill_dir instead. Returns the key, the result and the path of that file (None when it is in the cache)
+
+        Parameters:
+        stage: str, name of the stage
+        inputs: dict, json serializable inputs of the stage
+        compute: function without arguments that computes the result of the stage
+        spill_dir: str, directory for the result when the cache is disabled, like the workspace of the job
+        parents: iterable, keys of the stages this stage depends on
+        """
+        key, result = self.run(stage, inputs, compute, parents)
+        if self.enabled:
+            return key, result, None
+        fd, spill_path = tempfile.mkstemp(dir=spill_dir, prefix=f'{stage}_', suffix='.pkl')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return key, result, spill_path
+
+    def load_from_worker(self, stage, key, spill_path):
+        """Returns the result of a stage that ran in a worker with run_in_worker, a spilled result is removed after reading"""
+        if spill_path is None:
+            return self.load(stage, key)
+        try:
+            with open(spill_path, 'rb') as f:
+                return pickle.load(f)
+        finally:
+            os.remove(spill_path)
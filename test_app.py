@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+import app as application
+import mapGenerator
+
+FORM = {'latitude': '51.01', 'longitude': '5.01', 'name': 'Test', 'area': '300'}
+
+class FakeMapCreator:
+    """Stands in for the MapCreator, writes a small map instead of generating one and counts the generations"""
+    generations = 0
+
+    def __init__(self, name, **parameters):
+        self.map_path = os.path.join('static', 'maps', f'map_{name}_{FakeMapCreator.generations}.html')
+
+    def create_detailed_map(self):
+        FakeMapCreator.generations += 1
+        os.makedirs(os.path.dirname(self.map_path), exist_ok=True)
+        with open(self.map_path, 'w', encoding='utf-8') as f:
+            f.write('<html>map</html>')
+        return os.path.relpath(self.map_path, 'static')
+
+    def job_files(self):
+        return [self.map_path]
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # the result cache and the maps are relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(mapGenerator, 'MapCreator', FakeMapCreator)
+    monkeypatch.setattr(FakeMapCreator, 'generations', 0)
+    return application.app.test_client()
+
+def test_generates_a_map_only_on_post(client):
+    assert client.get('/generate_map', query_string=FORM).status_code == 405
+    assert FakeMapCreator.generations == 0
+
+def test_redirects_to_the_cached_map(client):
+    response = client.post('/generate_map', data=FORM)
+    assert response.status_code == 303 and response.location.startswith('/maps/')
+    # the same map again is not generated again
+    assert client.post('/generate_map', data=FORM).location == response.location
+    assert FakeMapCreator.generations == 1
+
+    page = client.get(response.location)
+    assert page.status_code == 200 and f'{response.location}/map' in page.get_data(as_text=True)
+    assert client.get(response.location, headers={'If-None-Match': page.headers['ETag']}).status_code == 304
+    assert client.get(f'{response.location}/map').get_data(as_text=True) == '<html>map</html>'
@@ -0,0 +1,18 @@
+from costEstimator import CostEstimator
+
+def metrics(download):
+    return {
+        'status': 'succeeded',
+        'total_seconds': 12.0,
+        'started': '2026-01-01T00:00:00',
+        'parameters': {'latitude': 51.0, 'longitude': 5.0, 'load_dist': 1000},
+        'spans': [{'name': 'download', **download}, {'name': 'render'}, {'name': 'publish', 'output_bytes': 5000}]
+    }
+
+def test_learns_the_features_of_a_download():
+    record = CostEstimator.record_from_metrics(metrics({'features': 300, 'layers': {'buildings': 200, 'roads': 80, 'waterways': 20}}))
+    assert record['features'] == 300
+    assert record['bytes'] == 5000
+
+def test_skips_a_download_that_counted_the_buildings_twice():
+    assert CostEstimator.record_from_metrics(metrics({'features': 500})) is None
@@ -0,0 +1,42 @@
+import networkx as nx
+import osmnx as ox
+import pandas as pd
+import pytest
+
+from conftest import SITE, site_elements
+from dataSources import LocalExtractSource, OverpassSource
+from downloadScheduler import DownloadScheduler
+from mockOverpassServer import MockOverpassServer
+
+@pytest.fixture(autouse=True)
+def osmnx_cache(tmp_path, monkeypatch):
+    """Every test gets its own empty osmnx cache, so every query reaches the mock server"""
+    monkeypatch.setattr(ox.settings, 'use_cache', True)
+    monkeypatch.setattr(ox.settings, 'cache_folder', str(tmp_path / 'osm'))
+    monkeypatch.setattr(ox.settings, 'requests_kwargs', {})
+
+class SiteOverpassServer(MockOverpassServer):
+    """Answers a query with the ways of the test site that have the key of the query, with their nodes, like Overpass does"""
+    def answer(self, query):
+        ways = [element for element in site_elements() if element['type'] == 'way' and any(f'["{key}"' in query or f"['{key}'" in query for key in element['tags'])]
+        refs = {ref for way in ways for ref in way['nodes']}
+        nodes = [element for element in site_elements() if element['type'] == 'node' and element['id'] in refs]
+        return {'version': 0.6, 'generator': 'MockOverpassServer', 'elements': nodes + ways}
+
+@pytest.fixture
+def sources(extract, tmp_path):
+    """The Overpass source (asking the mock server) and the local extract source of the same test site"""
+    with SiteOverpassServer() as server:
+        yield OverpassSource(DownloadScheduler(endpoints=[server.url], timeout=5)), LocalExtractSource(extract, index_dir=str(tmp_path / 'extracts'))
+
+@pytest.mark.parametrize('tags', [{'building': True}, {'waterway': True}, {'building': 'house'}])
+def test_extract_gives_the_same_features_as_overpass(sources, tags):
+    overpass, local = (source.features_from_point(SITE, 300, tags) for source in sources)
+    assert len(overpass) > 0
+    pd.testing.assert_frame_equal(local.sort_index(axis=0).sort_index(axis=1), overpass.sort_index(axis=0).sort_index(axis=1), check_like=True)
+    assert local.geometry.geom_equals(overpass.geometry.reindex(local.index)).all()
+
+def test_extract_gives_the_same_road_network_as_overpass(sources):
+    overpass, local = (source.graph_from_point(SITE, 300) for source in sources)
+    assert overpass.number_of_edges() > 0
+    assert nx.utils.graphs_equal(local, overpass)
@@ -0,0 +1,87 @@
+import threading
+import time
+
+import osmnx as ox
+import pytest
+
+from dataSources import OverpassSource
+from downloadScheduler import DownloadScheduler, PermanentDownloadError, TransientDownloadError
+from mockOverpassServer import MockOverpassServer
+
+ELEMENTS = [{'type': 'node', 'id': 1, 'lat': 51.18, 'lon': 5.88, 'tags': {'amenity': 'bench'}}]
+
+@pytest.fixture(autouse=True)
+def osmnx_cache(tmp_path, monkeypatch):
+    """Every test gets its own empty osmnx cache and the default requests_kwargs"""
+    monkeypatch.setattr(ox.settings, 'use_cache', True)
+    monkeypatch.setattr(ox.settings, 'cache_folder', str(tmp_path / 'osm'))
+    monkeypatch.setattr(ox.settings, 'requests_kwargs', {})
+
+def query(number=0):
+    return {'data': f'[out:json];node({number});out;'}
+
+def test_retries_a_busy_server():
+    with MockOverpassServer(ELEMENTS, script=[{'status': 504}, {'status': 429, 'retry_after': 0}]) as server:
+        scheduler = DownloadScheduler(endpoints=[server.url], base_delay=0.01, max_delay=0.05, timeout=5)
+        assert scheduler.request(query())['elements'] == ELEMENTS
+    assert len(server.requests) == 3
+    assert scheduler.stats['retries'] == 2
+
+def test_gives_up_after_max_retries():
+    with MockOverpassServer(ELEMENTS, default={'status': 503}) as server:
+        scheduler = DownloadScheduler(endpoints=[server.url], max_retries=3, base_delay=0.01, max_delay=0.05, timeout=5)
+        with pytest.raises(TransientDownloadError):
+            scheduler.request(query())
+    assert len(server.requests) == 3
+
+def test_does_not_retry_a_bad_query():
+    with MockOverpassServer(ELEMENTS, default={'status': 400}) as server:
+        scheduler = DownloadScheduler(endpoints=[server.url], base_delay=0.01, timeout=5)
+        with pytest.raises(PermanentDownloadError):
+            scheduler.request(query())
+    assert len(server.requests) == 1
+
+def test_hedges_to_a_mirror_when_the_main_endpoint_is_slow():
+    with MockOverpassServer(ELEMENTS, default={'delay': 2}) as main, MockOverpassServer(ELEMENTS) as mirror:
+        scheduler = DownloadScheduler(endpoints=[main.url, mirror.url], hedge_delay=0.1, timeout=5)
+        start = time.monotonic()
+        assert scheduler.request(query())['elements'] == ELEMENTS
+        assert time.monotonic() - start < 1.5
+    assert scheduler.stats['hedged'] == 1
+    assert scheduler.stats['answered_by'] == {mirror.url: 1}
+
+def test_caches_under_the_main_endpoint():
+    with MockOverpassServer(ELEMENTS, default={'status': 502}) as main, MockOverpassServer(ELEMENTS) as mirror:
+        scheduler = DownloadScheduler(endpoints=[main.url, mirror.url], hedge_delay=0.1, base_delay=0.01, timeout=5)
+        scheduler.request(query())
+        # the answer of the mirror is found again under the url of the main endpoint, whichever mirror comes first now
+        other_scheduler = DownloadScheduler(endpoints=[main.url], timeout=5)
+        assert other_scheduler.request(query())['elements'] == ELEMENTS
+    assert other_scheduler.stats['cache_hits'] == 1
+    assert len(mirror.requests) == 1
+
+def test_requests_kwargs_with_timeout_and_headers(monkeypatch):
+    monkeypatch.setattr(ox.settings, 'requests_kwargs', {'timeout': 1, 'headers': {'X-Test': '1'}, 'allow_redirects': True})
+    with MockOverpassServer(ELEMENTS) as server:
+        scheduler = DownloadScheduler(endpoints=[server.url], timeout=5)
+        assert scheduler.request(query())['elements'] == ELEMENTS
+
+def test_sources_serve_their_own_thread_at_the_same_time():
+    results = {}
+    with MockOverpassServer(ELEMENTS, default={'delay': 0.5}) as first, MockOverpassServer([], default={'delay': 0.5}) as second:
+        def download(name, server):
+            source = OverpassSource(DownloadScheduler(endpoints=[server.url], timeout=5))
+            with source.serving():
+                results[name] = ox._overpass._overpass_request(query())
+
+        threads = [threading.Thread(target=download, args=(name, server)) for name, server in (('first', first), ('second', second))]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the downloads do not wait for each other
+        assert time.monotonic() - start < 0.9
+    assert results['first']['elements'] == ELEMENTS
+    assert results['second']['elements'] == []
+    assert len(first.requests) == 1 and len(second.requests) == 1
@@ -0,0 +1,26 @@
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from floodExposure import FloodExposure
+
+def flat(latitudes, longitudes):
+    return np.zeros(np.shape(latitudes))
+
+def layers(building_longitude):
+    buildings = gpd.GeoDataFrame(geometry=[shapely.Point(building_longitude, 51.0).buffer(0.0001)], crs=4326)
+    waterways = gpd.GeoDataFrame({'name': ['Maas']}, geometry=[shapely.LineString([(5.0, 50.99), (5.0, 51.01)])], crs=4326)
+    return buildings, waterways
+
+def test_scores_a_building_next_to_the_water():
+    buildings, waterways = layers(5.001)
+    result = FloodExposure(buildings, waterways, 32631, flat).analyze()
+    assert result['exposure'].tolist() == ['high']
+    assert result['waterway'].tolist() == ['Maas']
+
+def test_no_building_near_the_water():
+    # about 5 km from the waterway, far past max_distance
+    buildings, waterways = layers(5.07)
+    result = FloodExposure(buildings, waterways, 32631, flat).analyze()
+    assert result['exposure'].tolist() == ['none']
+    assert np.isnan(result['water_m'].iloc[0])
@@ -0,0 +1,50 @@
+import os
+
+import geopandas as gpd
+import pytest
+import shapely
+
+from mapGenerator import MapCreator
+
+@pytest.fixture(autouse=True)
+def working_directory(tmp_path, monkeypatch):
+    """Every test publishes into its own empty folders"""
+    monkeypatch.chdir(tmp_path)
+
+def publish_version(name, job_id, modified):
+    """Writes the files a published generation leaves behind"""
+    paths = [os.path.join('static', 'maps', f'map_{name}_{job_id}.html'), os.path.join('geoJsonFiles', f'roads_{name}_{job_id}.geojson'),
+             os.path.join('shpFiles', f'roads_{name}_{job_id}.shp')]
+    for path in paths:
+        with open(path, 'w') as f:
+            f.write('x')
+        os.utime(path, (modified, modified))
+
+def test_prune_versions_keeps_the_newest_of_the_name_only():
+    map_creator = MapCreator(51.0, 5.0, 'Boschmolenplas', job_id='20260101000003_cccccccc', versions_kept=2)
+    for number, job_id in enumerate(['20260101000001_aaaaaaaa', '20260101000002_bbbbbbbb', '20260101000003_cccccccc']):
+        publish_version('Boschmolenplas', job_id, 1000 + number)
+        # a site whose name starts with the name of the map
+        publish_version('Boschmolenplas_Maasterp', job_id.replace('2026', '2025'), 1000 + number)
+    map_creator.prune_versions()
+
+    assert sorted(os.listdir(os.path.join('static', 'maps'))) == sorted(
+        [f'map_Boschmolenplas_{job_id}.html' for job_id in ('20260101000002_bbbbbbbb', '20260101000003_cccccccc')] +
+        [f'map_Boschmolenplas_Maasterp_2025010100000{number}_{letter * 8}.html' for number, letter in ((1, 'a'), (2, 'b'), (3, 'c'))])
+    assert 'roads_Boschmolenplas_20260101000001_aaaaaaaa.geojson' not in os.listdir('geoJsonFiles')
+    assert len(os.listdir('shpFiles')) == 5
+
+def test_run_stage_counts_a_layer_under_two_names_once():
+    map_creator = MapCreator(51.0, 5.0, 'Counts', use_cache=False)
+    buildings = gpd.GeoDataFrame(geometry=[shapely.Point(5.0, 51.0)] * 3, crs=4326)
+    roads = gpd.GeoDataFrame(geometry=[shapely.Point(5.0, 51.0)] * 2, crs=4326)
+
+    def compute():
+        map_creator.buildings = buildings
+        map_creator.all_buildings = buildings
+        map_creator.roads = roads
+    map_creator.run_stage('download', {}, compute, ['buildings', 'all_buildings', 'roads'])
+
+    span = map_creator.instrumentation.spans[-1]
+    assert span['features'] == 5
+    assert span['layers'] == {'buildings': 3, 'roads': 2}
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+from conftest import SITE
+from dataSources import LocalExtractSource
+from multiSite import MultiSiteMapCreator, compute_site
+
+@pytest.fixture(autouse=True)
+def working_directory(tmp_path, monkeypatch):
+    # the workspace of the map is relative to the working directory
+    monkeypatch.chdir(tmp_path)
+
+def test_overlapping_sites_share_no_features(extract, srtm, tmp_path):
+    latitude, longitude = SITE
+    sites = [{'latitude': latitude, 'longitude': longitude - 0.002, 'name': 'West', 'radius': 250},
+             {'latitude': latitude, 'longitude': longitude + 0.002, 'name': 'East', 'radius': 250}]
+    camera = {'latitude': latitude, 'longitude': longitude - 0.002, 'direction': 0, 'width': 60, 'reach': 100, 'name': 'camera 1', 'video_source': ''}
+    multiSiteMapCreator = MultiSiteMapCreator(sites, 'Twin', [camera], heatmap_step=0.0002, use_cache=False,
+                                              data_source=LocalExtractSource(extract, index_dir=str(tmp_path / 'extracts')))
+    multiSiteMapCreator.assign_sites()
+    results = [compute_site(site) for site in multiSiteMapCreator.make_sites()]
+
+    names = [set(result['buildings']['name']) for result in results]
+    assert names[0] and names[1] and not names[0] & names[1]
+    assert names[0] | names[1] == {f'huis {k}' for k in range(6)}
+    roads = [set(zip(result['roads']['u'], result['roads']['v'], result['roads']['key'])) for result in results]
+    assert not roads[0] & roads[1]
+    assert results[0]['road_buffer'].intersection(results[1]['road_buffer']).area < 1e-12
+    assert len(results[0]['viewsheds']) == 1 and len(results[1]['viewsheds']) == 0
+    # the stages of the sites write nothing in the workspace of the map, process_site saves the layers the site owns
+    workspace = multiSiteMapCreator.map_creator.workspace
+    assert not os.listdir(os.path.join(workspace, 'shpFiles')) and not os.listdir(os.path.join(workspace, 'geoJsonFiles'))
@@ -0,0 +1,51 @@
+import os
+import time
+
+import pytest
+
+from conftest import SITE
+from dataSources import LocalExtractSource
+from mapGenerator import MapCreator
+from stageCache import StageCache
+
+@pytest.fixture(autouse=True)
+def working_directory(tmp_path, monkeypatch):
+    # the maps are published relative to the working directory
+    monkeypatch.chdir(tmp_path)
+
+def test_evicts_the_least_recently_used_results(tmp_path):
+    cache = StageCache(str(tmp_path / 'stages'), max_bytes=3500)
+    for number in range(3):
+        cache.store('render', f'key{number}', b'x' * 1000)
+        # the modification time is the last use, so every result is used after the one before
+        os.utime(cache.path('render', f'key{number}'), (number, number))
+    assert cache.load('render', 'key0') == b'x' * 1000 # the first one is used again, so the second one is the least recently used
+    cache.store('render', 'key3', b'x' * 1000)
+    assert cache.load('render', 'key1') is None
+    assert all(cache.load('render', key) == b'x' * 1000 for key in ('key0', 'key2', 'key3'))
+
+def test_downloads_again_after_max_download_age(tmp_path, monkeypatch):
+    cache = StageCache(str(tmp_path / 'stages'), max_download_age=3600)
+    cache.store('download', 'key', 'layers')
+    cache.store('render', 'key', 'html')
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 7200)
+    assert cache.load('download', 'key') is None
+    # only the downloads get old, the other stages are derived from them and rerun when the download reruns
+    assert cache.load('render', 'key') == 'html'
+
+def generate(extract, cameras, index_dir):
+    map_creator = MapCreator(*SITE, 'Stages', load_dist=300, cameras=cameras, passage_points=[(SITE[0], SITE[1] + 0.001)],
+                             data_source=LocalExtractSource(extract, index_dir=index_dir), flood_exposure=False)
+    map_creator.create_detailed_map()
+    return {span['name']: span['cached'] for span in map_creator.metrics['spans'] if 'cached' in span}
+
+def test_changing_a_camera_reruns_only_the_camera_stages(extract, srtm, tmp_path):
+    camera = {'latitude': SITE[0], 'longitude': SITE[1], 'direction': 90, 'width': 60, 'reach': 100, 'name': 'camera 1', 'video_source': ''}
+    first = generate(extract, [camera], str(tmp_path / 'extracts'))
+    assert not any(first.values())
+
+    second = generate(extract, [dict(camera, direction=180)], str(tmp_path / 'extracts'))
+    # the camera is only used by the stages that look through it and by the inject stage that puts it on the map
+    assert {stage for stage, cached in second.items() if not cached} == {'viewshed', 'coverage', 'inject'}
+    assert {'download', 'project', 'buffer', 'classify', 'render'} <= set(second)
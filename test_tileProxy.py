@@ -0,0 +1,26 @@
+import pytest
+import requests
+
+from mockOverpassServer import MockTileServer
+from tileProxy import TileCache, TileProxy
+
+def proxy(server, tmp_path):
+    return TileProxy(TileCache(str(tmp_path / 'tiles')), upstreams={'pdok_grijs': server.url}, timeout=5)
+
+def test_fetches_a_tile_once(tmp_path):
+    with MockTileServer() as server:
+        tile_proxy = proxy(server, tmp_path)
+        data, cached = tile_proxy.get('pdok_grijs', 14, 8450, 5480)
+        assert data == MockTileServer.TILE and not cached
+        assert tile_proxy.get('pdok_grijs', 14, 8450, 5480) == (MockTileServer.TILE, True)
+    assert len(server.requests) == 1
+
+def test_does_not_cache_an_error_page(tmp_path):
+    with MockTileServer(default={'body': '<html>Service unavailable</html>'}) as server:
+        tile_proxy = proxy(server, tmp_path)
+        for _ in range(2):
+            with pytest.raises(requests.RequestException):
+                tile_proxy.get('pdok_grijs', 14, 8450, 5480)
+    # the page was not kept as the tile, so the upstream was asked again
+    assert len(server.requests) == 2
+    assert tile_proxy.cache.get('pdok_grijs', 14, 8450, 5480) is None
@@ -0,0 +1,292 @@
+import argparse
+import json
+import math
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from flask import Blueprint, Response, jsonify, request
+
+from instrumentation import METRICS
+
+# the basemaps of the generated maps, the proxy serves them as /tiles/<source>/<z>/<x>/<y>.png
+TILE_SOURCES = {
+    'pdok_grijs': {'url': 'https://service.pdok.nl/brt/achtergrondkaart/wmts/v2_0/grijs/EPSG:3857/{z}/{x}/{y}.png', 'max_zoom': 19},
+    'pdok_pastel': {'url': 'https://service.pdok.nl/brt/achtergrondkaart/wmts/v2_0/pastel/EPSG:3857/{z}/{x}/{y}.png', 'max_zoom': 19},
+    'carto_voyager': {'url': 'https://{s}.basemaps.cartocdn.com/rastertiles/voyager/{z}/{x}/{y}.png', 'max_zoom': 20},
+    'carto_dark_matter': {'url': 'https://{s}.basemaps.cartocdn.com/dark_all/{z}/{x}/{y}.png', 'max_zoom': 20}
+}
+
+def default_upstreams():
+    """
+    Returns the url template of the upstream server per tile source. The TILE_UPSTREAM environment variable can hold one template
+    with {source}, {z}, {x} and {y} to use for all sources instead, for example a local tile server or the MockTileServer of a test
+    """
+    upstream = os.environ.get('TILE_UPSTREAM', '').strip()
+    return {source: upstream or spec['url'] for source, spec in TILE_SOURCES.items()}
+
+def tile_xy(latitude, longitude, zoom):
+    """Returns the x and y of the web mercator tile a point lies in at a zoom level"""
+    latitude = max(min(latitude, 85.0511), -85.0511)
+    count = 2 ** zoom
+    x = int((longitude + 180) / 360 * count)
+    y = int((1 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2 * count)
+    return min(max(x, 0), count - 1), min(max(y, 0), count - 1)
+
+def tiles_in_bbox(bbox, zoom):
+    """
+    Returns the x, y of the tiles that cover a bounding box at a zoom level
+
+    Parameters:
+    bbox: tuple, (min_lon, min_lat, max_lon, max_lat)
+    zoom: int, zoom level
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    min_x, min_y = tile_xy(max_lat, min_lon, zoom) # the tile rows count from the north
+    max_x, max_y = tile_xy(min_lat, max_lon, zoom)
+    return [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+
+def site_bbox(latitude, longitude, radius):
+    """Returns the bounding box (min_lon, min_lat, max_lon, max_lat) of a site, the square of radius meters around it that the map loads"""
+    lat_delta = radius / 111320
+    lon_delta = radius / (111320 * max(math.cos(math.radians(latitude)), 0.01))
+    return (longitude - lon_delta, latitude - lat_delta, longitude + lon_delta, latitude + lat_delta)
+
+class TileCache:
+    """
+    Disk backed LRU cache of tiles, every tile is one file under cache_dir/<source>/<z>/<x>/<y>.png.
+    The modification time of a file is its last use, so the workers of a server share the cache and its order.
+    When the tiles take more than max_bytes the least recently used ones are removed, down to 90% so this does not happen on every new tile
+
+    Parameters:
+    cache_dir: str, directory of the tiles
+    max_bytes: int, max total size of the tiles, None is no limit
+    """
+    def __init__(self, cache_dir='cache/tiles', max_bytes=500e6):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = None # counted on the first new tile, other processes can add tiles too so an eviction counts again
+
+    def path(self, source, z, x, y):
+        """Returns the path of a tile"""
+        return os.path.join(self.cache_dir, source, str(z), str(x), f'{y}.png')
+
+    def get(self, source, z, x, y):
+        """Returns the tile and marks it as used, None when it is not in the cache"""
+        path = self.path(source, z, x, y)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None # not cached, or evicted by another process right now
+        return data
+
+    def put(self, source, z, x, y, data):
+        """Stores a tile under a temporary name and renames it afterwards, so a reader never sees half a tile"""
+        path = self.path(source, z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self.scan())
+            else:
+                self.total_bytes += len(data)
+            if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def scan(self):
+        """Returns the last use, size and path of every tile in the cache"""
+        tiles = []
+        for folder, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if file_name.endswith('.png'):
+                    path = os.path.join(folder, file_name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    tiles.append((stat.st_mtime, stat.st_size, path))
+        return tiles
+
+    def evict(self):
+        """Removes the least recently used tiles until they take at most 90% of max_bytes, returns the number of removed tiles"""
+        tiles = sorted(self.scan())
+        self.total_bytes = sum(size for _, size, _ in tiles)
+        removed = 0
+        for _, size, path in tiles:
+            if self.total_bytes <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
+            removed += 1
+        if removed:
+            print(f"Evicted {removed} tiles from the tile cache")
+        return removed
+
+    def stats(self):
+        """Returns the number of tiles and their total size"""
+        tiles = self.scan()
+        return {'tiles': len(tiles), 'bytes': sum(size for _, size, _ in tiles)}
+
+class TileProxy:
+    """
+    Serves the basemap tiles from the TileCache and fetches the ones that are not cached from the upstream server,
+    so a map loads its basemaps from the app (fast on a slow link, and offline for the cached or prefetched areas)
+
+    Parameters:
+    cache: TileCache, where the tiles are kept, a TileCache in cache/tiles when None
+    upstreams: dict, url template per tile source, see default_upstreams
+    timeout: float, seconds to wait for the upstream server
+    """
+    def __init__(self, cache=None, upstreams=None, timeout=10):
+        self.cache = cache if cache is not None else TileCache()
+        self.upstreams = upstreams if upstreams is not None else default_upstreams()
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'digital-twin-tile-proxy'
+
+    def upstream_url(self, source, z, x, y):
+        """Returns the url of a tile on the upstream server, a KeyError for an unknown source or a tile outside the world"""
+        if source not in self.upstreams:
+            raise KeyError(f"Unknown tile source {source}, known are {', '.join(self.upstreams)}")
+        if not (0 <= z <= TILE_SOURCES.get(source, {}).get('max_zoom', 22) and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise KeyError(f"No tile {z}/{x}/{y}")
+        # the subdomain is fixed per tile, so the browser can cache it under one url
+        return self.upstreams[source].format(source=source, z=z, x=x, y=y, s='abc'[(x + y) % 3])
+
+    def get(self, source, z, x, y):
+        """
+        Returns the png of a tile and whether it came from the cache. Raises a KeyError when the tile does not exist
+        and a requests.RequestException when it is not cached and the upstream server can not be reached or answers something else than an image
+        """
+        url = self.upstream_url(source, z, x, y)
+        data = self.cache.get(source, z, x, y)
+        if data is not None:
+            return data, True
+        response = self.session.get(url, timeout=self.timeout)
+        if response.status_code == 404:
+            raise KeyError(f"No tile {z}/{x}/{y} on {source}")
+        response.raise_for_status()
+        # some servers answer an html error page with status 200, that must not be cached as the tile
+        content_type = response.headers.get('Content-Type', '')
+        if not content_type.startswith('image/'):
+            raise requests.RequestException(f"{source} answered {content_type or 'no content type'} instead of an image for tile {z}/{x}/{y}")
+        self.cache.put(source, z, x, y, response.content)
+        return response.content, False
+
+    def prefetch(self, bbox, zooms, sources=None, max_tiles=50000, max_workers=8):
+        """
+        Fetches the tiles that cover a bounding box at the zoom levels into the cache, so the area can be viewed offline.
+        Returns the number of tiles that were already cached, fetched and failed
+
+        Parameters:
+        bbox: tuple, (min_lon, min_lat, max_lon, max_lat)
+        zooms: list, zoom levels
+        sources: list, tile sources, all when None
+        max_tiles: int, a prefetch of more tiles is refused with a ValueError, every zoom level has four times the tiles of the one before
+        max_workers: int, number of tiles fetched at the same time
+        """
+        sources = list(sources) if sources is not None else list(self.upstreams)
+        tiles = [(source, zoom, x, y) for source in sources for zoom in zooms for x, y in tiles_in_bbox(bbox, zoom)]
+        if len(tiles) > max_tiles:
+            raise ValueError(f"Prefetching {len(tiles)} tiles is more than max_tiles ({max_tiles}), use fewer zoom levels or a smaller area")
+
+        def fetch(tile):
+            try:
+                return 'cached' if self.get(*tile)[1] else 'fetched'
+            except (KeyError, requests.RequestException):
+                return 'failed'
+
+        counts = {'cached': 0, 'fetched': 0, 'failed': 0}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for result in executor.map(fetch, tiles):
+                counts[result] += 1
+        print(f"Prefetched {len(tiles)} tiles of {', '.join(sources)} at zoom {', '.join(str(zoom) for zoom in zooms)}: "
+              f"{counts['fetched']} fetched, {counts['cached']} already cached, {counts['failed']} failed")
+        return counts
+
+# the tile proxy of the Flask app, made on the first tile
+tile_proxy = None
+
+def get_tile_proxy():
+    global tile_proxy
+    if tile_proxy is None:
+        tile_proxy = TileProxy(TileCache(os.environ.get('TILE_CACHE_DIR', 'cache/tiles'), float(os.environ.get('TILE_CACHE_MAX_MB', 500)) * 1e6))
+    return tile_proxy
+
+tile_blueprint = Blueprint('tiles', __name__)
+
+@tile_blueprint.route('/tiles/<source>/<int:z>/<int:x>/<int:y>.png')
+def tile(source, z, x, y):
+    # a basemap tile from the cache or the upstream server, a week in the browser cache and with an ETag for the tiles after that
+    try:
+        data, cached = get_tile_proxy().get(source, z, x, y)
+    except KeyError as e:
+        return Response(e.args[0], status=404, mimetype='text/plain')
+    except requests.RequestException as e:
+        METRICS.increment('tile_proxy_requests_total', {'source': source, 'result': 'error'})
+        return Response(f"Tile not cached and the upstream server failed: {e}", status=502, mimetype='text/plain')
+    METRICS.increment('tile_proxy_requests_total', {'source': source, 'result': 'hit' if cached else 'miss'})
+    response = Response(data, mimetype='image/png')
+    response.cache_control.public = True
+    response.cache_control.max_age = 7 * 24 * 3600
+    response.add_etag()
+    return response.make_conditional(request)
+
+@tile_blueprint.route('/tiles/stats')
+def tile_stats():
+    return jsonify(get_tile_proxy().cache.stats())
+
+def parse_zooms(text):
+    """Returns the zoom levels of a text like 12-16 or 12,14,16"""
+    zooms = []
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        zooms.extend(range(int(first), int(last or first) + 1))
+    return sorted(set(zooms))
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Prefetch the basemap tiles of sites into the tile cache of the app, so the maps can be viewed offline")
+    parser.add_argument('--sites', help="json file with a list of sites (latitude, longitude and radius), like the sites of batchGenerator.py")
+    parser.add_argument('--bbox', help="min_lon,min_lat,max_lon,max_lat to prefetch instead of the sites")
+    parser.add_argument('--zooms', default='12-16', help="zoom levels, like 12-16 or 12,14,16")
+    parser.add_argument('--sources', nargs='+', default=None, choices=list(TILE_SOURCES), help="tile sources, all by default")
+    parser.add_argument('--cache-dir', default=os.environ.get('TILE_CACHE_DIR', 'cache/tiles'), help="directory of the tile cache")
+    parser.add_argument('--max-mb', type=float, default=float(os.environ.get('TILE_CACHE_MAX_MB', 500)), help="max size of the tile cache in MB")
+    parser.add_argument('--max-tiles', type=int, default=50000, help="refuse to prefetch more tiles than this")
+    args = parser.parse_args(args)
+
+    if args.bbox:
+        bboxes = {'bbox': tuple(float(value) for value in args.bbox.split(','))}
+    elif args.sites:
+        with open(args.sites, 'r', encoding='utf-8') as f:
+            sites = json.load(f)
+        bboxes = {site['name']: site_bbox(site['latitude'], site['longitude'], site.get('radius', site.get('load_dist', 2000))) for site in sites}
+    else:
+        parser.error("give --sites or --bbox")
+
+    proxy = TileProxy(TileCache(args.cache_dir, args.max_mb * 1e6))
+    failed = 0
+    for name, bbox in bboxes.items():
+        print(f"Prefetching {name}..")
+        failed += proxy.prefetch(bbox, parse_zooms(args.zooms), args.sources, max_tiles=args.max_tiles)['failed']
+    print(f"Tile cache holds {proxy.cache.stats()['tiles']} tiles")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
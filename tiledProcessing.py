@@ -0,0 +1,345 @@
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import folium
+import geopandas as gpd
+import numpy as np
+import osmnx as ox
+import shapely
+from folium.plugins import HeatMap
+from shapely.geometry import box
+
+from mapGenerator import AttributeProjector, DataDownloader, ElevationGrid, MapCreator, grid_range, tooltip_content
+from stageCache import StageCache
+
+# the tiles are streamed into the map file at this marker, so they come before the javascript that is injected afterwards
+TILES_MARKER = '<!-- tiles -->'
+
+def owned_by_tile(points, bbox):
+    """
+    Returns a boolean array that is True for the points that belong to the tile.
+    The bounds are half open (south <= lat < north, west <= lon < east) so every point belongs to exactly one tile
+
+    Parameters:
+    points: GeoSeries, points in lat/lon
+    bbox: tuple, (north, south, east, west) of the tile
+    """
+    north, south, east, west = bbox
+    x = points.x.to_numpy()
+    y = points.y.to_numpy()
+    return (west <= x) & (x < east) & (south <= y) & (y < north)
+
+def features_geojson(geometries, style, tooltips=None):
+    """
+    Returns a geojson FeatureCollection as text with the style and the tooltip of every feature in its properties,
+    the other properties are left out to keep the map small
+
+    Parameters:
+    geometries: array, shapely geometries in lat/lon
+    style: dict, leaflet path options of every feature
+    tooltips: list, tooltip per feature, None has no tooltips
+    """
+    features = []
+    for index, geometry in enumerate(shapely.to_geojson(np.asarray(geometries))):
+        properties = {'style': style}
+        if tooltips is not None:
+            properties['tooltip'] = tooltips[index]
+        features.append(f'{{"type": "Feature", "geometry": {geometry}, "properties": {json.dumps(properties)}}}')
+    return '{"type": "FeatureCollection", "features": [' + ', '.join(features) + ']}'
+
+def layer_script(geojson, variable):
+    """Returns a script that adds a geojson FeatureCollection (text, see features_geojson) to the feature group with the javascript variable"""
+    # a tooltip can not end the script early
+    geojson = geojson.replace('</', '<\\/')
+    return f"""<script>
+    L.geoJSON({geojson}, {{
+        style: function(feature) {{
+            return feature.properties.style;
+        }},
+        onEachFeature: function(feature, featureLayer) {{
+            if (feature.properties.tooltip) {{
+                featureLayer.bindTooltip(feature.properties.tooltip, {{sticky: true}});
+            }}
+        }}
+    }}).addTo({variable});
+</script>
+"""
+
+def compute_tile(tile):
+    """
+    Downloads and processes a single tile, this runs in a worker process.
+    Everything is downloaded for the tile with a margin around it, so buffers of roads and waterways just across
+    the seam are still there. Afterwards only the features that belong to the tile are kept and the buffers are clipped
+    to the tile, so the merged tiles have no duplicates and no gaps.
+
+    Parameters:
+    tile: dict, description of the tile made by TiledMapProcessor.make_tiles
+    """
+    north, south, east, west = tile['bbox']
+    core = box(west, south, east, north)
+    downloader = DataDownloader((north + south) / 2, (east + west) / 2, source=tile['data_source'])
+    attributeProjector = AttributeProjector(tile['attribute_schemas'])
+
+    print(f"Tile {tile['index']}: downloading buildings..")
+    buildings = downloader.download_bbox_with_retry(tile['margin_bbox'], tags={'building': True})
+    buildings = buildings[buildings.geometry.type == 'Polygon']
+    buildings = buildings[owned_by_tile(buildings.geometry.representative_point(), tile['bbox'])]
+    buildings = attributeProjector.apply('buildings', buildings)
+
+    print(f"Tile {tile['index']}: downloading road network..")
+    try:
+        # retain_all, because the largest connected part of a tile is not the largest part of the whole area
+        G = tile['data_source'].graph_from_bbox(tile['margin_bbox'], network_type='all', retain_all=True, truncate_by_edge=True)
+        margin_roads = ox.graph_to_gdfs(G, nodes=False)
+        del G
+    except (ox._errors.InsufficientResponseError, ValueError):
+        margin_roads = gpd.GeoDataFrame(geometry=[], crs='EPSG:4326')
+    if 'nodes' in margin_roads.columns:
+        margin_roads = margin_roads.drop(columns=['nodes'])
+
+    print(f"Tile {tile['index']}: downloading waterways..")
+    margin_waterways = downloader.download_bbox_with_retry(tile['margin_bbox'], tags={'waterway': True})
+    margin_waterways = margin_waterways[margin_waterways.geometry.type == 'LineString']
+
+    # lines belong to the tile their middle lies in
+    roads = margin_roads[owned_by_tile(margin_roads.geometry.interpolate(0.5, normalized=True), tile['bbox'])]
+    waterways = margin_waterways[owned_by_tile(margin_waterways.geometry.interpolate(0.5, normalized=True), tile['bbox'])]
+    roads = attributeProjector.apply('roads', roads)
+    waterways = attributeProjector.apply('waterways', waterways)
+
+    # buffers are made from all lines in the margin, then clipped to the tile so they fit seamlessly against the neighbours
+    road_buffer_union = margin_roads.to_crs(epsg=tile['epsg_code']).buffer(tile['road_buffer_size']).to_crs(epsg=4326).unary_union
+    water_buffer_union = margin_waterways.to_crs(epsg=tile['epsg_code']).buffer(tile['water_buffer_size']).to_crs(epsg=4326).unary_union
+    road_buffer_union = road_buffer_union if road_buffer_union is not None else shapely.Polygon()
+    water_buffer_union = water_buffer_union if water_buffer_union is not None else shapely.Polygon()
+
+    nearby_buildings_road = buildings[buildings.intersects(road_buffer_union)]
+    nearby_buildings_water = buildings[buildings.intersects(water_buffer_union)]
+
+    heatmap_data = []
+    if tile['heatmap_step'] is not None: # None when the map has no elevation heatmap
+        print(f"Tile {tile['index']}: sampling elevation..")
+        elevation_grid = ElevationGrid()
+        grid_lat_origin, grid_lon_origin = tile['grid_origin']
+        latitudes = grid_range(grid_lat_origin, south, north, tile['heatmap_step'])
+        longitudes = grid_range(grid_lon_origin, west, east, tile['heatmap_step'])
+        elevations = elevation_grid.get_elevations(latitudes[:, None], longitudes[None, :])
+        heatmap_data = MapCreator.grid_to_heatmap_data(latitudes, longitudes, elevations)
+
+    return {
+        'buildings': buildings,
+        'roads': roads,
+        'waterways': waterways,
+        'road_buffer': road_buffer_union.intersection(core),
+        'water_buffer': water_buffer_union.intersection(core),
+        'nearby_buildings_road': nearby_buildings_road,
+        'nearby_buildings_water': nearby_buildings_water,
+        'heatmap_data': heatmap_data
+    }
+
+def process_tile(tile):
+    """
+    Processes a tile through the stage cache and saves its layers, only a small summary is sent back
+    so the parent process never holds more than one tile at a time
+
+    Parameters:
+    tile: dict, description of the tile made by TiledMapProcessor.make_tiles
+    """
+    stageCache = StageCache(tile['cache_dir'], enabled=tile['use_cache'])
+    inputs = {key: tile[key] for key in ('bbox', 'margin_bbox', 'epsg_code', 'water_buffer_size', 'road_buffer_size', 'heatmap_step', 'grid_origin', 'attribute_schemas')}
+    inputs['data_source'] = tile['data_source'].cache_id()
+    key, result, spill_path = stageCache.run_in_worker('tile', inputs, lambda: compute_tile(tile), tile['workspace'])
+
+    for layer_name in ('roads', 'buildings', 'waterways'):
+        layer = result[layer_name]
+        if len(layer) > 0:
+            AttributeProjector.for_file(layer).to_file(os.path.join(tile['workspace'], 'shpFiles', f"{layer_name}_{tile['name']}_tile_{tile['index']}.shp"), driver='ESRI Shapefile')
+            AttributeProjector.for_file(layer).to_file(os.path.join(tile['workspace'], 'geoJsonFiles', f"{layer_name}_{tile['name']}_tile_{tile['index']}.geojson"), driver='GeoJSON')
+
+    return {
+        'index': tile['index'],
+        'key': key,
+        'spill_path': spill_path,
+        'buildings': len(result['buildings']),
+        'roads': len(result['roads']),
+        'waterways': len(result['waterways']),
+        'heatmap_cells': len(result['heatmap_data'])
+    }
+
+class TiledMapProcessor:
+    """
+    Large area mode of the MapCreator. The area is split into tiles which are downloaded and processed
+    in a pool of processes, so the memory that is needed for the processing depends on the tile size and not on the area.
+    The map is saved without the tiles and the tiles are streamed into the map file one tile at a time, so rendering the map
+    does not depend on the area either. Without the stage cache the workers hand their results over through files in the workspace
+
+    Parameters:
+    map_creator: MapCreator, the map creator to render the tiles into
+    tile_size: int, size of the side of a tile in meters
+    max_workers: int, number of processes, None uses the number of cores
+    heatmap_step: float, distance between the points of the elevation heatmap in degrees, None shows no heatmap
+    The altitude_raster and simplify_tolerance of the map creator are used like in the normal mode
+    """
+    def __init__(self, map_creator, tile_size=1000, max_workers=None, heatmap_step=0.00005):
+        self.map_creator = map_creator
+        self.tile_size = tile_size
+        self.max_workers = max_workers
+        self.heatmap_step = heatmap_step
+
+    def make_tiles(self):
+        """Splits the bbox of the map creator into tiles, every tile also gets a margin as wide as the largest buffer"""
+        mc = self.map_creator
+        north, south, east, west = ox.utils_geo.bbox_from_point(mc.point, dist=mc.load_dist)
+        tiles_per_side = math.ceil(2 * mc.load_dist / self.tile_size)
+        lat_step = (north - south) / tiles_per_side
+        lon_step = (east - west) / tiles_per_side
+
+        margin = max(mc.water_buffer_size, mc.road_buffer_size) + 10 # meters
+        lat_margin = margin / 111320
+        lon_margin = margin / (111320 * math.cos(math.radians(mc.latitude)))
+
+        tiles = []
+        for row in range(tiles_per_side):
+            for column in range(tiles_per_side):
+                tile_south = south + row * lat_step
+                tile_west = west + column * lon_step
+                # the last row/column ends exactly on the bbox so rounding does not leave a gap
+                tile_north = north if row == tiles_per_side - 1 else tile_south + lat_step
+                tile_east = east if column == tiles_per_side - 1 else tile_west + lon_step
+                tiles.append({
+                    'index': len(tiles),
+                    'name': mc.name,
+                    'bbox': (tile_north, tile_south, tile_east, tile_west),
+                    'margin_bbox': (tile_north + lat_margin, tile_south - lat_margin, tile_east + lon_margin, tile_west - lon_margin),
+                    'epsg_code': mc.calculate_epsg_code(),
+                    'water_buffer_size': mc.water_buffer_size,
+                    'road_buffer_size': mc.road_buffer_size,
+                    'heatmap_step': self.heatmap_step,
+                    'grid_origin': (south, west),
+                    'attribute_schemas': mc.attribute_schemas,
+                    'data_source': mc.data_source,
+                    'cache_dir': mc.stageCache.cache_dir,
+                    'use_cache': mc.stageCache.enabled,
+                    'workspace': mc.workspace
+                })
+        return tiles
+
+    def process_tiles(self):
+        """Processes all tiles in the process pool, returns the summaries of the tiles ordered by tile index"""
+        tiles = self.make_tiles()
+        self.map_creator.data_source.prepare() # a local extract is indexed once here instead of in every worker
+        print(f"Processing {len(tiles)} tiles of {self.tile_size} meters..")
+        summaries = []
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(process_tile, tile) for tile in tiles]
+            for future in as_completed(futures):
+                summary = future.result()
+                print(f"Tile {summary['index']} done: {summary['buildings']} buildings, {summary['roads']} roads, {summary['waterways']} waterways")
+                summaries.append(summary)
+        return sorted(summaries, key=lambda summary: summary['index'])
+
+    def render_base(self):
+        """
+        Renders the map without the tiles: the basemaps, an empty feature group per layer, an empty heatmap and the layer control.
+        The tiles are streamed into the feature groups by stream_tiles, so the parent process never holds the layers of the whole area
+        """
+        mc = self.map_creator
+        self.feature_groups = {
+            'roads': folium.FeatureGroup(name='Roads'),
+            'waterways': folium.FeatureGroup(name='Waterways'),
+            'buildings': folium.FeatureGroup(name="All buildings"),
+            'water_buffer': folium.FeatureGroup(name="Buffer area waterways"),
+            'nearby_buildings_water': folium.FeatureGroup(name="Buildings nearby waterways"),
+            'road_buffer': folium.FeatureGroup(name="Buffer area road"),
+            'nearby_buildings_road': folium.FeatureGroup(name="Buildings nearby roads")
+        }
+        for feature_group in self.feature_groups.values():
+            feature_group.add_to(mc.m)
+
+        self.heatmap = None
+        if self.heatmap_step is not None:
+            gradient = {0.2: 'blue', 0.4: 'lime', 0.6: 'yellow', 0.8: 'orange', 1.0: 'red'}
+            elevation_heatmap = folium.FeatureGroup(name="Elevation heatmap")
+            self.heatmap = HeatMap([], min_opacity=0.05, radius=15, blur=20, max_zoom=1, gradient=gradient)
+            self.heatmap.add_to(elevation_heatmap)
+            elevation_heatmap.add_to(mc.m)
+        if mc.altitude_raster:
+            # one image over the whole area, a pixel per srtm point is small enough for large areas
+            north, south, east, west = ox.utils_geo.bbox_from_point(mc.point, dist=mc.load_dist)
+            mc.render_altitude_raster((south, north, west, east))
+
+        folium.LayerControl(collapsed=False, draggable=True).add_to(mc.m)
+
+        mc.base_html = mc.m.get_root().render().replace('</html>', TILES_MARKER + '\n</html>')
+
+    def tile_scripts(self, result):
+        """Returns the scripts that add the layers of one tile to the feature groups of render_base"""
+        mc = self.map_creator
+        styler = mc.mapStyler
+        scripts = []
+
+        def add_layer(layer_name, geometries, style, tooltips=None):
+            if len(geometries) > 0:
+                scripts.append(layer_script(features_geojson(geometries, style, tooltips), self.feature_groups[layer_name].get_name()))
+
+        def building_tooltips(buildings, building_type):
+            extra_data = {'Digital Twin Name': mc.name, 'Building Type': building_type}
+            return [tooltip_content(properties, extra_data) for properties in buildings.drop(columns='geometry').to_dict('records')]
+
+        add_layer('roads', mc.display_layer(result['roads'].geometry), styler.style_roads({}))
+        add_layer('waterways', mc.display_layer(result['waterways'].geometry), styler.style_waterways({}))
+        add_layer('buildings', mc.display_layer(result['buildings'].geometry), styler.style_buildings({}), building_tooltips(result['buildings'], 'general'))
+        if not result['water_buffer'].is_empty:
+            add_layer('water_buffer', [mc.display_layer(result['water_buffer'])], styler.style_buffer_area_water({}))
+        add_layer('nearby_buildings_water', mc.display_layer(result['nearby_buildings_water'].geometry), styler.style_nearby_buildings_water({}),
+                  building_tooltips(result['nearby_buildings_water'], 'within water buffer'))
+        if not result['road_buffer'].is_empty:
+            add_layer('road_buffer', [mc.display_layer(result['road_buffer'])], styler.style_buffer_area_road({}))
+        add_layer('nearby_buildings_road', mc.display_layer(result['nearby_buildings_road'].geometry), styler.style_nearby_buildings_road({}),
+                  building_tooltips(result['nearby_buildings_road'], 'within road buffer'))
+        if len(result['heatmap_data']) > 0:
+            scripts.append(f"<script>\n    tile_heatmap_data = tile_heatmap_data.concat({json.dumps(result['heatmap_data'])});\n</script>\n")
+        return scripts
+
+    def stream_tiles(self, summaries):
+        """
+        Writes the tiles into the saved map one tile at a time, at the marker of render_base. Only one tile is in memory at a time,
+        the heatmap points are gathered in the browser and given to the heatmap at the end
+        """
+        mc = self.map_creator
+        with open(mc.map_name, 'r', encoding='utf-8') as f:
+            head, tail = f.read().split(TILES_MARKER)
+        tmp_path = mc.map_name + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(head)
+            f.write("<script>\n    var tile_heatmap_data = [];\n</script>\n")
+            for summary in summaries:
+                result = mc.stageCache.load_from_worker('tile', summary['key'], summary['spill_path'])
+                if result is None:
+                    raise Exception(f"Result of tile {summary['index']} is missing from the cache")
+                for script in self.tile_scripts(result):
+                    f.write(script)
+                del result
+            if self.heatmap is not None:
+                f.write(f"<script>\n    {self.heatmap.get_name()}.setLatLngs(tile_heatmap_data);\n</script>\n")
+            f.write(tail)
+        os.replace(tmp_path, mc.map_name)
+
+    def create_map(self):
+        """Processes the tiles, saves the map without the tiles with the injected javascript and streams the tiles into it"""
+        mc = self.map_creator
+        with mc.writing_span('process_tiles') as span:
+            summaries = self.process_tiles()
+            span['tiles'] = len(summaries)
+            if self.heatmap_step is not None:
+                mc.instrumentation.parameters['heatmap_cells'] = sum(summary['heatmap_cells'] for summary in summaries)
+        with mc.writing_span('save_map'):
+            self.render_base()
+            with open(mc.map_name, 'w', encoding='utf-8') as f:
+                f.write(mc.base_html)
+            # these NEED to take place AFTER saving the base html with static info
+            mc.inject_scripts()
+        with mc.writing_span('render_tiles'):
+            self.stream_tiles(summaries)
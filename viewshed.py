@@ -0,0 +1,224 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+from scipy.ndimage import map_coordinates
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+from cameraCoverage import camera_cones
+from roadGraph import grid_to_polygon
+
+DEFAULT_BUILDING_HEIGHT = 10 # meters, for buildings without height and levels in OpenStreetMap
+LEVEL_HEIGHT = 3 # meters per building level
+DEFAULT_CAMERA_HEIGHT = 4 # meters above the ground (or roof) the camera is mounted at
+TERRAIN_CELL_SIZE = 30 # meters, the terrain is sampled at about the resolution of SRTM and interpolated in between
+
+def building_heights(buildings, default_height=DEFAULT_BUILDING_HEIGHT, level_height=LEVEL_HEIGHT):
+    """
+    Returns the height in meters of every building, from the height tag when OpenStreetMap has it,
+    otherwise from the number of levels and otherwise the default height
+
+    Parameters:
+    buildings: GeoDataFrame, building layer, with the columns of the attribute schema (height and levels) when they exist
+    default_height: float, height of a building without height and levels
+    level_height: float, height of one level
+    """
+    heights = pd.Series(np.nan, index=buildings.index)
+    if 'height' in buildings.columns:
+        heights = pd.to_numeric(buildings['height'].astype(str).str.extract(r'([0-9]+(?:\.[0-9]+)?)')[0], errors='coerce')
+    for levels_column in ('levels', 'building:levels'):
+        if levels_column in buildings.columns:
+            levels = pd.to_numeric(buildings[levels_column].astype(str).str.extract(r'([0-9]+(?:\.[0-9]+)?)')[0], errors='coerce')
+            heights = heights.fillna(levels * level_height)
+    return heights.fillna(default_height).to_numpy(dtype=float)
+
+class ObstacleGrid:
+    """
+    Raster of the surface height (terrain plus buildings) around the cameras, the ray casting of the viewsheds runs on it.
+    The buildings are rasterized all at once: the cells in the bounding box of every building are tested with one vectorized contains call
+
+    Parameters:
+    buildings: GeoDataFrame, building layer
+    epsg_code: int, epsg code of a projection in meters, like the UTM zone of the map
+    bounds: tuple, (minx, miny, maxx, maxy) of the grid in the projection
+    cell_size: float, size of the cells in meters
+    elevation_function: function, returns the elevations of arrays of latitudes and longitudes (like ElevationGrid.get_elevations), None is flat terrain
+    default_height: float, height of a building without height and levels
+    """
+    def __init__(self, buildings, epsg_code, bounds, cell_size=2, elevation_function=None, default_height=DEFAULT_BUILDING_HEIGHT):
+        self.epsg_code = epsg_code
+        self.cell_size = cell_size
+        minx, miny, maxx, maxy = bounds
+        self.x0 = minx
+        self.y0 = miny
+        self.shape = (int(np.ceil((maxy - miny) / cell_size)), int(np.ceil((maxx - minx) / cell_size)))
+        self.terrain = self.sample_terrain(elevation_function)
+        self.buildings = self.rasterize_buildings(buildings, default_height)
+        self.surface = self.terrain + self.buildings
+
+    def sample_terrain(self, elevation_function):
+        """Returns the terrain height of every cell, sampled on a coarse grid and interpolated linearly in between"""
+        if elevation_function is None:
+            return np.zeros(self.shape, dtype=np.float32)
+        factor = max(1, int(round(TERRAIN_CELL_SIZE / self.cell_size)))
+        coarse_rows = np.arange(0, self.shape[0] + factor, factor)
+        coarse_columns = np.arange(0, self.shape[1] + factor, factor)
+        x = self.x0 + (coarse_columns + 0.5) * self.cell_size
+        y = self.y0 + (coarse_rows + 0.5) * self.cell_size
+        grid_x, grid_y = np.meshgrid(x, y)
+        longitudes, latitudes = Transformer.from_crs(self.epsg_code, 4326, always_xy=True).transform(grid_x, grid_y)
+        coarse = np.asarray(elevation_function(latitudes, longitudes), dtype=float)
+        coarse = np.where(np.isnan(coarse), np.nanmean(coarse) if np.isfinite(coarse).any() else 0, coarse)
+
+        rows, columns = np.mgrid[0:self.shape[0], 0:self.shape[1]]
+        return map_coordinates(coarse, [rows / factor, columns / factor], order=1, mode='nearest').astype(np.float32)
+
+    def rasterize_buildings(self, buildings, default_height):
+        """Returns the building height of every cell, 0 outside the buildings"""
+        heights_grid = np.zeros(self.shape, dtype=np.float32)
+        if len(buildings) == 0:
+            return heights_grid
+        geometries = buildings.geometry.to_crs(epsg=self.epsg_code).to_numpy()
+        heights = building_heights(buildings, default_height)
+        bounds = shapely.bounds(geometries)
+
+        first_column = np.clip(np.floor((bounds[:, 0] - self.x0) / self.cell_size), 0, self.shape[1]).astype(np.int64)
+        last_column = np.clip(np.ceil((bounds[:, 2] - self.x0) / self.cell_size), 0, self.shape[1]).astype(np.int64)
+        first_row = np.clip(np.floor((bounds[:, 1] - self.y0) / self.cell_size), 0, self.shape[0]).astype(np.int64)
+        last_row = np.clip(np.ceil((bounds[:, 3] - self.y0) / self.cell_size), 0, self.shape[0]).astype(np.int64)
+        columns_per_building = last_column - first_column
+        counts = columns_per_building * (last_row - first_row)
+        if counts.sum() == 0:
+            return heights_grid
+
+        # every cell of the bounding box of every building, after each other
+        building = np.repeat(np.arange(len(geometries)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        rows = first_row[building] + local // columns_per_building[building]
+        columns = first_column[building] + local % columns_per_building[building]
+        inside = shapely.contains_xy(geometries[building], self.x0 + (columns + 0.5) * self.cell_size, self.y0 + (rows + 0.5) * self.cell_size)
+        np.maximum.at(heights_grid, (rows[inside], columns[inside]), heights[building[inside]])
+        return heights_grid
+
+    def cells(self, x, y):
+        """Returns the row and column of the cells of the points, clipped to the grid"""
+        rows = np.clip(((y - self.y0) // self.cell_size).astype(np.int64), 0, self.shape[0] - 1)
+        columns = np.clip(((x - self.x0) // self.cell_size).astype(np.int64), 0, self.shape[1] - 1)
+        return rows, columns
+
+    def viewshed(self, x, y, direction, width, reach, camera_height=DEFAULT_CAMERA_HEIGHT, target_height=1.5):
+        """
+        Returns the polygon of the part of the cone the camera can see, by casting rays over the grid.
+        All rays and all steps along them are computed at once: a point is visible when the line from the camera to the point
+        (target_height above the surface) is not below the steepest obstacle closer to the camera on the same ray
+
+        Parameters:
+        x: float, x of the camera in the projection
+        y: float, y of the camera in the projection
+        direction: float, direction the camera points in, degrees clockwise from north
+        width: float, width of the cone in degrees
+        reach: float, reach of the camera in meters
+        camera_height: float, meters above the surface (the roof when the camera is on a building) the camera is at
+        target_height: float, height above the surface that has to be visible, like a person
+        """
+        width = min(width, 360)
+        step = self.cell_size / 2
+        distances = np.arange(1, int(np.ceil(reach / step)) + 1) * step
+        # enough rays that neighbouring rays are less than a cell apart at the end of the reach
+        ray_count = max(8, int(np.ceil(np.radians(width) * reach / (self.cell_size * 0.75)))) + 1
+        angles = np.radians(direction - width / 2 + np.linspace(0, 1, ray_count) * width)
+        sample_x = x + np.sin(angles)[:, None] * distances[None, :]
+        sample_y = y + np.cos(angles)[:, None] * distances[None, :]
+        rows, columns = self.cells(sample_x, sample_y)
+
+        camera_row, camera_column = self.cells(np.array([x]), np.array([y]))
+        eye = self.surface[camera_row[0], camera_column[0]] + camera_height
+        surface = self.surface[rows, columns]
+        obstacle_slopes = (surface - eye) / distances[None, :]
+        # the steepest obstacle before every point on its ray
+        blocking = np.maximum.accumulate(obstacle_slopes, axis=1)
+        blocking = np.concatenate([np.full((ray_count, 1), -np.inf), blocking[:, :-1]], axis=1)
+        visible = (surface + target_height - eye) / distances[None, :] >= blocking
+
+        # the visible cells become the polygon, only the window of the grid the rays pass through is used
+        row_min, row_max = rows.min(), rows.max()
+        column_min, column_max = columns.min(), columns.max()
+        window = np.zeros((row_max - row_min + 1, column_max - column_min + 1), dtype=bool)
+        window[rows[visible] - row_min, columns[visible] - column_min] = True
+        polygon = grid_to_polygon(window, self.x0 + column_min * self.cell_size, self.y0 + row_min * self.cell_size, self.cell_size)
+        return polygon
+
+def camera_viewsheds(cameras, buildings, epsg_code, elevation_function=None, cell_size=2, max_workers=None, default_height=DEFAULT_BUILDING_HEIGHT):
+    """
+    Returns the viewsheds of the cameras, the part of every cone that is not hidden behind buildings or terrain, as polygons in the projection.
+    One obstacle grid is made per cluster of cameras with overlapping cones (see cone_clusters), so the grids stay as small as the cones.
+    The cameras of a cluster are computed in parallel threads (numpy and shapely release the GIL)
+
+    Parameters:
+    cameras: list, dicts with latitude, longitude, direction, width, reach and optionally height (meters above the surface)
+    buildings: GeoDataFrame, building layer
+    epsg_code: int, epsg code of a projection in meters, like the UTM zone of the map
+    elevation_function: function, returns the elevations of arrays of latitudes and longitudes, None is flat terrain
+    cell_size: float, size of the cells of the obstacle grid in meters
+    max_workers: int, number of threads, None lets python decide
+    default_height: float, height of a building without height and levels
+    """
+    if len(cameras) == 0:
+        return np.array([], dtype=object)
+    cones = camera_cones(cameras, epsg_code).to_numpy()
+    x, y = Transformer.from_crs(4326, epsg_code, always_xy=True).transform([camera['longitude'] for camera in cameras], [camera['latitude'] for camera in cameras])
+    buildings = buildings.to_crs(epsg=epsg_code) # projected once for all grids
+    viewsheds = np.empty(len(cameras), dtype=object)
+
+    for cluster in cone_clusters(cones, cell_size):
+        # the grids are aligned on multiples of the cell size, so a viewshed does not depend on the other cameras of its cluster
+        minx, miny, maxx, maxy = shapely.total_bounds(cones[cluster])
+        bounds = tuple(np.floor(np.array([minx, miny]) / cell_size - 1) * cell_size) + tuple(np.ceil(np.array([maxx, maxy]) / cell_size + 1) * cell_size)
+        nearby_buildings = buildings.iloc[buildings.sindex.query(shapely.box(*bounds))] if len(buildings) > 0 else buildings
+        grid = ObstacleGrid(nearby_buildings, epsg_code, bounds, cell_size, elevation_function, default_height)
+
+        def compute(index):
+            camera = cameras[index]
+            visible = grid.viewshed(x[index], y[index], camera['direction'], camera['width'], camera['reach'], camera.get('height', DEFAULT_CAMERA_HEIGHT))
+            # the cells stick out a little past the arc of the cone, so the polygon is cut to the cone
+            return shapely.intersection(visible, cones[index])
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            viewsheds[cluster] = list(executor.map(compute, cluster.tolist()))
+    return viewsheds
+
+def cone_clusters(cones, margin=0):
+    """
+    Returns the indexes of the cones per cluster, cones whose bounding boxes (grown by the margin) overlap, also through other cones, are in one cluster.
+    Every cluster gets its own obstacle grid, so cameras far apart do not make one grid over all the space between them
+
+    Parameters:
+    cones: array, cone polygons in the projection
+    margin: float, meters the bounding boxes are grown by before testing the overlap
+    """
+    boxes = shapely.buffer(shapely.envelope(cones), margin, join_style='mitre')
+    first, second = shapely.STRtree(boxes).query(boxes, predicate='intersects')
+    adjacency = csr_matrix((np.ones(len(first), dtype=bool), (first, second)), shape=(len(cones), len(cones)))
+    _, labels = connected_components(adjacency, directed=False)
+    order = np.argsort(labels, kind='stable')
+    return np.split(order, np.flatnonzero(np.diff(labels[order])) + 1)
+
+def polygon_to_latlngs(geometry, transformer):
+    """
+    Returns a polygon or multipolygon in the nested [lat, lng] lists leaflet's L.polygon takes (rings with holes, and a list of those for multipolygons)
+
+    Parameters:
+    geometry: shapely geometry, polygon or multipolygon in the projection
+    transformer: pyproj Transformer, from the projection to lat/lon (EPSG:4326 with always_xy)
+    """
+    def ring_latlngs(ring):
+        coordinates = np.asarray(ring.coords)
+        longitudes, latitudes = transformer.transform(coordinates[:, 0], coordinates[:, 1])
+        return np.round(np.column_stack([latitudes, longitudes]), 7).tolist()
+
+    polygons = [geometry] if geometry.geom_type == 'Polygon' else [part for part in getattr(geometry, 'geoms', []) if part.geom_type == 'Polygon']
+    latlngs = [[ring_latlngs(polygon.exterior)] + [ring_latlngs(interior) for interior in polygon.interiors] for polygon in polygons if not polygon.is_empty]
+    return latlngs[0] if len(latlngs) == 1 else latlngs